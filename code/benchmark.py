@@ -0,0 +1,425 @@
+import torch
+import torch.nn as nn
+import torchvision.models as models
+import numpy as np
+import PIL.Image
+import os, sys, argparse, datetime, json, platform, shutil, tempfile, time
+
+from generator import GENERATORS, get_generator, load_generator
+from discriminator import GAN
+from dataset import CocoStuffDataSet
+from utils import convert_to_mask, calc_pixel_accuracy, calc_mean_IoU, per_class_pixel_acc, ConfusionMatrix, time_fn, count_macs
+import style_transfer
+import inpainting
+
+BENCH_DIR = "../benchmarks" # Assuming this is launched from code/ subfolder.
+SAVE_DIR = "../checkpoints"
+NUM_CLASSES = 11 # 10 animal categories + background
+
+
+def bench_generators(sizes, batch_size, repeat):
+    results = {}
+    for name in sorted(GENERATORS):
+        model = get_generator(name, NUM_CLASSES, use_bn=True, pretrained=False)
+        for size in sizes:
+            data = torch.rand(batch_size, 3, size, size)
+            labels = torch.randint(0, NUM_CLASSES, (batch_size, size, size), dtype=torch.long)
+            criterion = nn.CrossEntropyLoss()
+
+            def forward():
+                with torch.no_grad():
+                    model(data)
+
+            def forward_backward():
+                model.zero_grad()
+                criterion(model(data), labels).backward()
+
+            model.eval()
+            res = time_fn(forward, repeat=repeat)
+            res['images_per_sec'] = 1000.0 * batch_size / res['mean_ms']
+            results['generator/{}/forward/{}'.format(name, size)] = res
+            model.train()
+            res = time_fn(forward_backward, repeat=repeat)
+            res['images_per_sec'] = 1000.0 * batch_size / res['mean_ms']
+            results['generator/{}/backward/{}'.format(name, size)] = res
+        del model
+    return results
+
+
+def bench_discriminator(sizes, batch_size, repeat):
+    results = {}
+    for size in sizes:
+        model = GAN(NUM_CLASSES, (NUM_CLASSES, size, size), (3, size, size))
+        images = torch.rand(batch_size, 3, size, size)
+        masks = torch.rand(batch_size, NUM_CLASSES, size, size)
+        targets = torch.ones(batch_size, 1)
+        criterion = nn.BCEWithLogitsLoss()
+
+        def forward():
+            with torch.no_grad():
+                model(images, masks)
+
+        def forward_backward():
+            model.zero_grad()
+            criterion(model(images, masks), targets).backward()
+
+        model.eval()
+        res = time_fn(forward, repeat=repeat)
+        res['images_per_sec'] = 1000.0 * batch_size / res['mean_ms']
+        results['discriminator/forward/{}'.format(size)] = res
+        model.train()
+        res = time_fn(forward_backward, repeat=repeat)
+        res['images_per_sec'] = 1000.0 * batch_size / res['mean_ms']
+        results['discriminator/backward/{}'.format(size)] = res
+    return results
+
+
+def make_synthetic_coco(root, num_images=16, image_size=(480, 640), num_cats=NUM_CLASSES - 1, seed=0):
+    """
+    Writes a small COCO-format fixture to disk (random images, rectangular polygon annotations)
+    Args:
+        root: (str) directory that will hold images/val2017 and annotations/instances_val2017.json
+        num_images: (int) number of images to generate
+        image_size: (tuple) (height, width) of the generated images
+        num_cats: (int) number of 'animal' categories
+    Return:
+        (img_dir, annot_dir) to be given to CocoStuffDataSet with mode='val'
+    """
+    rng = np.random.RandomState(seed)
+    img_dir = os.path.join(root, 'images', '')
+    annot_dir = os.path.join(root, 'annotations', '')
+    os.makedirs(os.path.join(img_dir, 'val2017'))
+    os.makedirs(annot_dir)
+    height, width = image_size
+    categories = [{'id': i + 1, 'name': 'animal{}'.format(i), 'supercategory': 'animal'} for i in range(num_cats)]
+    images, annotations = [], []
+    for img_id in range(1, num_images + 1):
+        file_name = '{:012d}.jpg'.format(img_id)
+        pixels = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        PIL.Image.fromarray(pixels).save(os.path.join(img_dir, 'val2017', file_name))
+        images.append({'id': img_id, 'file_name': file_name, 'height': height, 'width': width})
+        for _ in range(rng.randint(1, 4)):
+            x0, y0 = rng.randint(0, width // 2), rng.randint(0, height // 2)
+            w, h = rng.randint(16, width // 2), rng.randint(16, height // 2)
+            annotations.append({
+                'id': len(annotations) + 1,
+                'image_id': img_id,
+                'category_id': int(rng.randint(1, num_cats + 1)),
+                'segmentation': [[x0, y0, x0 + w, y0, x0 + w, y0 + h, x0, y0 + h]],
+                'area': float(w * h),
+                'bbox': [x0, y0, w, h],
+                'iscrowd': 0,
+            })
+    with open(os.path.join(annot_dir, 'instances_val2017.json'), 'w') as outfile:
+        json.dump({'images': images, 'annotations': annotations, 'categories': categories}, outfile)
+    return img_dir, annot_dir
+
+
+def bench_dataset(sizes, repeat):
+    results = {}
+    root = tempfile.mkdtemp()
+    try:
+        img_dir, annot_dir = make_synthetic_coco(root)
+        for size in sizes:
+            dataset = CocoStuffDataSet(img_dir=img_dir, annot_dir=annot_dir, mode='val',
+                                       height=size, width=size, supercategories=['animal'])
+            indices = list(range(len(dataset)))
+
+            def load_all():
+                for idx in indices:
+                    dataset[idx]
+
+            res = time_fn(load_all, warmup=1, repeat=repeat)
+            res['images_per_sec'] = 1000.0 * len(indices) / res['mean_ms']
+            results['dataset/getitem/{}'.format(size)] = res
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def bench_metrics(sizes, batch_size, repeat):
+    results = {}
+    for size in sizes:
+        scores = torch.randn(batch_size, NUM_CLASSES, size, size)
+        labels = convert_to_mask(torch.randn(batch_size, NUM_CLASSES, size, size))
+        preds = convert_to_mask(scores)
+        results['metrics/convert_to_mask/{}'.format(size)] = time_fn(lambda: convert_to_mask(scores), repeat=repeat)
+        for metric in [calc_pixel_accuracy, calc_mean_IoU, per_class_pixel_acc]:
+            results['metrics/{}/{}'.format(metric.__name__, size)] = \
+                time_fn(lambda: metric(labels, preds, None), repeat=repeat)
+
+        def confusion_matrix():
+            confusion = ConfusionMatrix(NUM_CLASSES)
+            confusion.update(torch.argmax(scores, 1), torch.argmax(labels, 1))
+            return confusion.pixel_accuracy(), confusion.mean_IoU(), confusion.per_class_accuracy()
+
+        results['metrics/ConfusionMatrix/{}'.format(size)] = time_fn(confusion_matrix, repeat=repeat)
+    return results
+
+
+def _per_iteration(run, few_iters, many_iters, repeat):
+    """ Cost of one iteration of run(max_iters), as the difference between two run lengths """
+    few = time_fn(lambda: run(few_iters), warmup=1, repeat=repeat)
+    many = time_fn(lambda: run(many_iters), warmup=0, repeat=repeat)
+    return {
+        'mean_ms': (many['mean_ms'] - few['mean_ms']) / (many_iters - few_iters),
+        'std_ms': float(np.sqrt(many['std_ms'] ** 2 + few['std_ms'] ** 2)) / (many_iters - few_iters),
+        'min_ms': (many['min_ms'] - few['min_ms']) / (many_iters - few_iters),
+        'repeat': repeat,
+    }
+
+
+def bench_style_transfer(sizes, batch_size, repeat):
+    """
+    Per-iteration cost of masked style transfer with a second (foreground) style, for one
+    image and for a batch of images (style_transfer_batch).
+    Measured as the difference between two runs so that the setup cost cancels out.
+    """
+    results = {}
+    cnn = models.vgg16(pretrained=False).features.to(style_transfer.device)
+    for param in cnn.parameters():
+        param.requires_grad = False
+    rng = np.random.RandomState(0)
+    style_layers = (0, 5, 10, 17, 24)
+    for size in sizes:
+        content = PIL.Image.fromarray(rng.randint(0, 256, (size, size, 3)).astype(np.uint8))
+        style = PIL.Image.fromarray(rng.randint(0, 256, (size, size, 3)).astype(np.uint8))
+        mask = torch.Tensor((rng.rand(size, size) > 0.5).astype(np.float32))
+        few_iters, many_iters = 2, 6
+
+        def run(max_iters):
+            style_transfer.style_transfer(cnn, content, style, mask, image_size=size, style_size=size,
+                                          content_layer=12, content_weight=1e-3,
+                                          style_layers=style_layers, style_weights=[1.0] * len(style_layers),
+                                          tv_weight=0, max_iters=max_iters, mask_layer=True,
+                                          second_style_image=style)
+
+        def run_batch(max_iters):
+            style_transfer.style_transfer_batch(cnn, [content] * batch_size, style, [mask] * batch_size,
+                                                image_size=size, style_size=size,
+                                                content_layer=12, content_weight=1e-3,
+                                                style_layers=style_layers, style_weights=[1.0] * len(style_layers),
+                                                tv_weight=0, max_iters=max_iters, mask_layer=True,
+                                                second_style_image=style)
+
+        res = _per_iteration(run, few_iters, many_iters, repeat)
+        res['images_per_sec'] = 1000.0 / res['mean_ms']
+        results['style_transfer/iteration/{}'.format(size)] = res
+        res = _per_iteration(run_batch, few_iters, many_iters, repeat)
+        res['images_per_sec'] = 1000.0 * batch_size / res['mean_ms']
+        results['style_transfer/batch_iteration/{}'.format(size)] = res
+    return results
+
+
+def bench_style_convergence(sizes, repeat, max_iters=200, tol=1e-3):
+    """
+    Wall time and iterations of masked style transfer stopped at a relative loss plateau, with
+    Adam and L-BFGS, and with the coarse-to-fine pyramid. The target loss is 1.05 times the loss reached by Adam in the fixed budget
+    of max_iters iterations, and the time to reach it is reported as well.
+    """
+    results = {}
+    cnn = models.vgg16(pretrained=False).features.to(style_transfer.device)
+    for param in cnn.parameters():
+        param.requires_grad = False
+    rng = np.random.RandomState(0)
+    style_layers = (0, 5, 10, 17, 24)
+    for size in sizes:
+        content = PIL.Image.fromarray(rng.randint(0, 256, (size, size, 3)).astype(np.uint8))
+        style = PIL.Image.fromarray(rng.randint(0, 256, (size, size, 3)).astype(np.uint8))
+        mask = torch.Tensor((rng.rand(size, size) > 0.5).astype(np.float32))
+
+        def run(**kwargs):
+            return style_transfer.style_transfer(cnn, content, style, mask, image_size=size, style_size=size,
+                                                 content_layer=12, content_weight=1e-3,
+                                                 style_layers=style_layers, style_weights=[1.0] * len(style_layers),
+                                                 tv_weight=0, max_iters=max_iters, mask_layer=True,
+                                                 second_style_image=style, return_stats=True, **kwargs)[3]
+
+        reference = run()
+        target_loss = 1.05 * reference['final_loss'][0]
+        results['style_transfer/fixed_budget/{}'.format(size)] = {
+            'mean_ms': 1000.0 * reference['time_s'], 'iterations': reference['iterations'], 'repeat': 1}
+        for optimizer in ['adam', 'lbfgs']:
+            runs = [run(optimizer=optimizer, tol=tol, target_loss=target_loss) for _ in range(repeat)]
+            reached = [r['time_to_target_s'] for r in runs if r['time_to_target_s'] is not None]
+            results['style_transfer/convergence/{}/{}'.format(optimizer, size)] = {
+                'mean_ms': 1000.0 * float(np.mean([r['time_s'] for r in runs])),
+                'iterations': float(np.mean([r['iterations'] for r in runs])),
+                'evaluations': float(np.mean([r['evaluations'] for r in runs])),
+                'time_to_target_ms': 1000.0 * float(np.mean(reached)) if reached else None,
+                'final_loss_ratio': float(np.mean([r['final_loss'][0] for r in runs])) / reference['final_loss'][0],
+                'repeat': repeat,
+            }
+        start = time.time()
+        pyramid = style_transfer.style_transfer_pyramid(cnn, content, style, mask, image_size=size, style_size=size,
+                                                        content_layer=12, content_weight=1e-3, style_layers=style_layers,
+                                                        style_weights=[1.0] * len(style_layers), tv_weight=0,
+                                                        max_iters=max_iters, mask_layer=True, second_style_image=style,
+                                                        tol=tol, return_stats=True)[3]
+        results['style_transfer/pyramid/{}'.format(size)] = {
+            'mean_ms': 1000.0 * (time.time() - start), 'iterations': pyramid['iterations'],
+            'iterations_per_scale': [st['iterations'] for st in pyramid['scales']], 'repeat': 1}
+    return results
+
+
+def bench_inpainting(sizes, batch_size, repeat):
+    results = {}
+    cnn = models.vgg11(pretrained=False).features
+    loss_dict = {'valid': 1, 'hole': 6, 'perceptual': 0.05, 'style': 120, 'tv': 0.1}
+    for size in sizes:
+        I_gt = torch.rand(batch_size, 3, size, size)
+        I_out = (I_gt + 0.1 * torch.randn(I_gt.size())).requires_grad_()
+        mask = (torch.rand(batch_size, 1, size, size) > 0.5).float()
+
+        def forward_backward():
+            inpainting.total_loss(loss_dict, cnn, I_out, I_gt, mask).backward()
+
+        results['inpainting/total_loss/{}'.format(size)] = time_fn(forward_backward, repeat=repeat)
+    return results
+
+
+def bench_menu(experiments, sizes, batch_size, repeat):
+    """
+    Speed/accuracy menu of trained generators: parameters, GMACs and forward latency on
+    synthetic input, with the best validation mIoU recorded in the checkpoint of each experiment
+    Args:
+        experiments: list of experiment names in ../checkpoints, or experiment directories
+    """
+    results = {}
+    for experiment in experiments:
+        experiment_dir = experiment if os.path.isdir(experiment) else os.path.join(SAVE_DIR, experiment)
+        checkpoint_path = os.path.join(experiment_dir, 'best.pth.tar')
+        model = load_generator(checkpoint_path, device='cpu')
+        best_mIOU = torch.load(checkpoint_path, map_location='cpu').get('best_mIOU')
+        name = os.path.basename(os.path.normpath(experiment_dir))
+        for size in sizes:
+            data = torch.rand(batch_size, 3, size, size)
+
+            def forward():
+                with torch.no_grad():
+                    model(data)
+
+            res = time_fn(forward, repeat=repeat)
+            res['images_per_sec'] = 1000.0 * batch_size / res['mean_ms']
+            res['params'] = sum(p.numel() for p in model.parameters())
+            res['gmacs'] = count_macs(model, size) / 1e9
+            res['mIOU'] = best_mIOU
+            results['menu/{}/{}'.format(name, size)] = res
+        del model
+    return results
+
+
+def print_menu(results):
+    print ("{:<40} {:>10} {:>8} {:>10} {:>8}".format('model/size', 'params (M)', 'GMACs', 'ms/batch', 'mIOU'))
+    for name in sorted(results):
+        if name.startswith('menu/'):
+            r = results[name]
+            print ("{:<40} {:>10.2f} {:>8.2f} {:>10.2f} {:>8}".format(
+                name[len('menu/'):], r['params'] / 1e6, r['gmacs'], r['mean_ms'],
+                '-' if r['mIOU'] is None else '{:.4f}'.format(r['mIOU'])))
+
+
+def run_benchmarks(args):
+    sizes = [64] if args.quick else args.sizes
+    suites = {
+        'generator': lambda: bench_generators(sizes, args.batch_size, args.repeat),
+        'discriminator': lambda: bench_discriminator(sizes, args.batch_size, args.repeat),
+        'dataset': lambda: bench_dataset(sizes, args.repeat),
+        'metrics': lambda: bench_metrics(sizes, args.batch_size, args.repeat),
+        'style_transfer': lambda: bench_style_transfer(sizes, args.batch_size, args.repeat),
+        'style_convergence': lambda: bench_style_convergence(sizes, args.repeat),
+        'inpainting': lambda: bench_inpainting(sizes, args.batch_size, args.repeat),
+    }
+    if args.menu:
+        suites = {'menu': lambda: bench_menu(args.menu, sizes, args.batch_size, args.repeat)}
+    results = {}
+    for name, suite in suites.items():
+        if args.only is not None and name not in args.only:
+            continue
+        print ("Running {} benchmarks".format(name))
+        torch.manual_seed(args.seed)
+        results.update(suite())
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'threads': torch.get_num_threads(),
+            'batch_size': args.batch_size,
+            'sizes': sizes,
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """
+    Compares two benchmark result dicts (as written by run_benchmarks)
+    Args:
+        current, baseline: (dict) benchmark outputs
+        tolerance: (float) allowed relative slowdown of the mean time before flagging a regression
+    Return:
+        list of names of the regressed benchmarks
+    """
+    regressions = []
+    print ("{:<55} {:>12} {:>12} {:>8}".format('benchmark', 'baseline ms', 'current ms', 'ratio'))
+    for name in sorted(current['results']):
+        if name not in baseline['results']:
+            print ("{:<55} {:>12} {:>12.2f} {:>8}".format(name, '-', current['results'][name]['mean_ms'], 'new'))
+            continue
+        old = baseline['results'][name]['mean_ms']
+        new = current['results'][name]['mean_ms']
+        ratio = new / max(old, 1e-12)
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print ("{:<55} {:>12.2f} {:>12.2f} {:>8.2f}{}".format(name, old, new, ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CPU benchmarks on synthetic data')
+    parser.add_argument('--output', '-o', default=os.path.join(BENCH_DIR, 'results.json'), type=str,
+                        help='where to write the results')
+    parser.add_argument('--compare', default=None, type=str,
+                        help='baseline results file to compare against')
+    parser.add_argument('--tolerance', default=0.15, type=float,
+                        help='relative slowdown flagged as a regression (default: 0.15)')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='subset of suites: generator discriminator dataset metrics style_transfer style_convergence inpainting')
+    parser.add_argument('--sizes', nargs='+', default=[64, 128], type=int,
+                        help='image sizes to benchmark (multiples of 32)')
+    parser.add_argument('-b', '--batch_size', default=4, type=int,
+                        help='batch size for models and metrics')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='number of timed repetitions')
+    parser.add_argument('--threads', default=1, type=int,
+                        help='number of CPU threads used by torch')
+    parser.add_argument('--seed', default=231, type=int)
+    parser.add_argument('--quick', type=bool, default=False,
+                        help='single small size, for smoke testing')
+    parser.add_argument('--menu', nargs='+', default=None,
+                        help='trained experiments (e.g. segnet16 mobile) to compare on params, latency and mIoU, '
+                             'instead of the suites')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    current = run_benchmarks(args)
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output, 'w') as outfile:
+        json.dump(current, outfile, sort_keys=True, indent=4)
+    print ("=> Saved benchmark results '{}'".format(args.output))
+    if args.menu:
+        print_menu(current['results'])
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(current, baseline, args.tolerance)
+        if regressions:
+            print ("{} regression(s) over {:.0f}%".format(len(regressions), 100 * args.tolerance))
+            sys.exit(1)
+        print ("No regression")
@@ -1,4 +1,6 @@
 import torch
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.sampler import Sampler
 import torchvision.datasets as dset
 import torchvision.transforms as transforms
 
@@ -7,7 +9,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from scipy import misc
 from PIL import Image
-import os
+import os, json
 from utils import discrete_cmap, normalize, de_normalize
 
 class CocoStuffDataSet(dset.CocoDetection):
@@ -141,6 +143,135 @@ class CocoStuffDataSet(dset.CocoDetection):
         plt.title('annotated image')
         plt.show()
 
+class ResumableRandomSampler(Sampler):
+    '''
+    Random sampler whose permutation is a function of (seed, epoch) so that it can be
+    checkpointed and fast-forwarded: on resume, the already seen indices of the current
+    epoch are skipped by position, without loading the corresponding samples. The skipped
+    position is only changed by set_epoch (back to 0 on a new epoch) and load_state_dict, so
+    iterating twice gives the same indices and len() always matches the iteration.
+    '''
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0 # Position in the permutation to resume from
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.start_index = 0
+        self.epoch = epoch
+
+    def _permutation(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return torch.randperm(len(self.data_source), generator=generator).tolist()
+
+    def __iter__(self):
+        return iter(self._permutation()[self.start_index:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start_index
+
+    def state_dict(self, epoch, num_seen):
+        '''
+        epoch: (int) current epoch
+        num_seen: (int) number of samples of this epoch already consumed by the model
+        '''
+        return {'seed': self.seed, 'epoch': epoch, 'start_index': num_seen}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start_index = min(state['start_index'], len(self.data_source))
+
+
+def cache_dataset(dataset, cache_dir, batch_size=64, num_workers=4):
+    '''
+    Preprocesses a CocoStuffDataSet once and stores it as memory-mapped arrays in cache_dir:
+        images.npy: uint8 (N, 3, H, W) resized images (lossless, ToTensor only divides by 255)
+        labels.npy: uint8 (N, H, W) flattened masks
+        masks.npy: uint16 (N, C - 1, W, H) class masks as built by CocoStuffDataSet (sums of the
+            0-255 resized annotations), the background channel being 1 - their sum
+        meta.json: numClasses, catIds, ids and size
+    The dataset must be built with do_normalize=False.
+    Return:
+        CachedDataSet reading the cache
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    N, H, W = len(dataset), dataset.height, dataset.width
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(N, 3, H, W))
+    labels = np.lib.format.open_memmap(os.path.join(cache_dir, 'labels.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(N, H, W))
+    masks = np.lib.format.open_memmap(os.path.join(cache_dir, 'masks.npy'), mode='w+',
+                                      dtype=np.uint16, shape=(N, dataset.numClasses - 1, dataset.width, dataset.height))
+    loader = DataLoader(dataset, batch_size, shuffle=False, num_workers=num_workers)
+    start = 0
+    for img, mask, mask_flat in loader:
+        end = start + img.size(0)
+        images[start:end] = (img * 255.0).round().byte().numpy()
+        labels[start:end] = mask_flat.numpy().astype(np.uint8)
+        masks[start:end] = mask[:, :-1].numpy().astype(np.uint16)
+        start = end
+        print ("Cached {}/{} images".format(end, N))
+    images.flush()
+    labels.flush()
+    masks.flush()
+    meta = {
+        'numClasses': dataset.numClasses,
+        'catIds': dataset.catIds,
+        'ids': dataset.ids,
+        'height': H,
+        'width': W,
+    }
+    # meta.json is written last: its presence marks a complete cache
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as outfile:
+        json.dump(meta, outfile)
+    return CachedDataSet(cache_dir)
+
+
+class CachedDataSet(Dataset):
+    '''
+    Read-only view over a cache written by cache_dataset. The arrays are memory-mapped so that
+    any number of processes share a single copy through the page cache, without parsing COCO.
+    Items are those of CocoStuffDataSet: the class masks keep their 0-255 scale and the
+    background channel is rebuilt as 1 - their sum, so the real masks given to the
+    discriminator are the same as in main.py.
+    '''
+    def __init__(self, cache_dir, do_normalize=False):
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as infile:
+            meta = json.load(infile)
+        self.numClasses = meta['numClasses']
+        self.catIds = meta['catIds']
+        self.ids = meta['ids']
+        self.height = meta['height']
+        self.width = meta['width']
+        self.images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(cache_dir, 'labels.npy'), mmap_mode='r')
+        self.masks = np.load(os.path.join(cache_dir, 'masks.npy'), mmap_mode='r')
+        self.normalize = normalize() if do_normalize else None
+
+    @staticmethod
+    def exists(cache_dir):
+        # Caches without masks.npy only stored the flattened labels and are rebuilt
+        return all(os.path.isfile(os.path.join(cache_dir, name)) for name in ['meta.json', 'masks.npy'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        img = torch.from_numpy(self.images[index].astype(np.float32) / 255.0)
+        if self.normalize is not None:
+            img = self.normalize(img)
+        mask_flat = self.labels[index].astype(np.int64)
+        masks = np.zeros((self.numClasses,) + self.masks.shape[2:])
+        masks[:-1] = self.masks[index]
+        masks[-1] = 1 - np.sum(masks[:-1], 0)
+        return img, masks, mask_flat
+
+
 def calculate_mean_and_std(supercategories=['animal'], height=128, width=128):
     height = width = 128
     train_dataset = CocoStuffDataSet(mode='train', supercategories=['animal'], height=height, width=width)
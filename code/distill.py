@@ -0,0 +1,66 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+import numpy as np
+import os
+
+from utils import inference_mode
+
+
+def distillation_loss(student_logits, teacher_logits, temperature=2.0):
+    """
+    Per pixel KL divergence between the softened teacher and student class distributions,
+    scaled by T^2 so that its gradients keep the magnitude of the cross entropy
+    Args:
+        student_logits, teacher_logits: (torch.Tensor) B x C x H x W
+    """
+    log_student = F.log_softmax(student_logits / temperature, dim=1)
+    teacher = F.softmax(teacher_logits / temperature, dim=1)
+    kl = F.kl_div(log_student, teacher, reduction='none').sum(1) # B x H x W
+    return kl.mean() * temperature ** 2
+
+
+def cache_teacher_logits(teacher, dataset, path, batch_size=32, device='cpu'):
+    """
+    Runs the teacher once over a dataset and stores its logits as a float16 (N, C, H, W)
+    memory-mapped array, in the order of the dataset. The dataset transforms must be
+    deterministic (no random augmentation), as in CocoStuffDataSet.
+    Return:
+        path
+    """
+    teacher = teacher.to(device).eval()
+    loader = DataLoader(dataset, batch_size, shuffle=False)
+    logits = None
+    start = 0
+    with inference_mode():
+        for data, _, _ in loader:
+            out = teacher(data.to(device))
+            if logits is None:
+                logits = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float16,
+                                                   shape=(len(dataset),) + tuple(out.shape[1:]))
+            logits[start:start + out.size(0)] = out.half().cpu().numpy()
+            start += out.size(0)
+            print ("Cached teacher logits {}/{}".format(start, len(dataset)))
+    logits.flush()
+    del logits
+    os.replace(path + '.tmp', path) # the final name marks a complete cache
+    return path
+
+
+class TeacherLogitsDataSet(Dataset):
+    '''
+    Wraps a dataset to also return the cached teacher logits of each item:
+    (img, mask, mask_flat, teacher_logits)
+    '''
+    def __init__(self, dataset, logits_path):
+        self.dataset = dataset
+        self.logits = np.load(logits_path, mmap_mode='r')
+        assert len(self.logits) == len(dataset), "Teacher logits cached for another dataset"
+        self.numClasses = dataset.numClasses
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img, mask, mask_flat = self.dataset[index]
+        return img, mask, mask_flat, torch.from_numpy(np.array(self.logits[index]))
@@ -0,0 +1,119 @@
+import torch
+import os, argparse, json
+
+from generator import load_generator, num_classes_from_state_dict
+from fuse import fold_batchnorm
+from utils import inference_mode, time_fn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Spatial sizes must be multiples of 32 (5 downsamplings)
+PARITY_SHAPES = [(1, 3, 128, 128), (3, 3, 96, 160), (2, 3, 256, 192)]
+
+
+def export_torchscript(model, path, size=128):
+    """
+    Traces the generator into a self-contained TorchScript file (torch.jit.load on the host,
+    without generator.py). The forward has no shape dependent Python code, so the trace is
+    valid for any batch size and any spatial size multiple of 32.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), torch.rand(1, 3, size, size))
+    torch.jit.save(traced, path)
+    return traced
+
+
+def export_onnx(model, path, size=128, opset_version=11):
+    """
+    Exports the generator to ONNX with dynamic batch, height and width dimensions
+    """
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), torch.rand(1, 3, size, size), path,
+                          input_names=['image'], output_names=['logits'],
+                          dynamic_axes={'image': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'logits': {0: 'batch', 2: 'height', 3: 'width'}},
+                          opset_version=opset_version)
+
+
+def load_exported(path):
+    """
+    Returns a callable mapping a B x 3 x H x W float tensor to B x C x H x W logits
+    """
+    if path.endswith('.onnx'):
+        assert onnxruntime is not None, "onnxruntime is needed to run ONNX models"
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return lambda x: torch.from_numpy(session.run(None, {'image': x.numpy()})[0])
+    module = torch.jit.load(path, map_location='cpu')
+    return lambda x: module(x)
+
+
+def parity_check(model, exported, shapes=PARITY_SHAPES, repeat=5):
+    """
+    Compares the exported model against eager on several dynamic shapes
+    Return:
+        list of dicts with the max abs logit difference, the label agreement and both latencies
+    """
+    results = []
+    model = model.eval()
+    with inference_mode():
+        for shape in shapes:
+            x = torch.rand(*shape)
+            reference = model(x)
+            output = exported(x)
+            results.append({
+                'shape': list(shape),
+                'max_abs_diff': (reference - output).abs().max().item(),
+                'label_agreement': (reference.argmax(1) == output.argmax(1)).float().mean().item(),
+                'eager_ms': time_fn(lambda: model(x), warmup=1, repeat=repeat)['mean_ms'],
+                'exported_ms': time_fn(lambda: exported(x), warmup=1, repeat=repeat)['mean_ms'],
+            })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a trained generator to a portable graph')
+    parser.add_argument('checkpoint', type=str,
+                        help='checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('--format', default='torchscript', type=str,
+                        help='torchscript or onnx')
+    parser.add_argument('--output', '-o', default=None, type=str,
+                        help='output file (default: <checkpoint dir>/generator.pt or .onnx)')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('--fold_bn', type=bool, default=False,
+                        help='fold BatchNorm layers into the convolutions before exporting')
+    parser.add_argument('--tolerance', default=1e-3, type=float,
+                        help='largest accepted logit difference with eager')
+    args = parser.parse_args()
+
+    extension = '.onnx' if args.format == 'onnx' else '.pt'
+    output = args.output or os.path.join(os.path.dirname(args.checkpoint), 'generator' + extension)
+    model = load_generator(args.checkpoint, args.generator_name, device='cpu')
+    eager = model
+    if args.fold_bn:
+        model = fold_batchnorm(model)
+
+    if args.format == 'onnx':
+        export_onnx(model, output)
+    else:
+        export_torchscript(model, output)
+    print ("=> Exported generator to '{}'".format(output))
+    with open(os.path.splitext(output)[0] + '.json', 'w') as outfile:
+        json.dump({
+            'num_classes': num_classes_from_state_dict(eager.state_dict()),
+            'input': 'B x 3 x H x W float RGB in [0, 1], H and W multiples of 32',
+            'output': 'B x C x H x W logits, the last class is the background',
+            'source_checkpoint': os.path.abspath(args.checkpoint),
+        }, outfile, indent=4)
+
+    if args.format == 'onnx' and onnxruntime is None:
+        print ("onnxruntime not installed, skipping the parity check")
+    else:
+        results = parity_check(eager, load_exported(output))
+        for r in results:
+            print ("{shape}: max abs diff {max_abs_diff:.2e}, label agreement {label_agreement:.4f}, "
+                   "eager {eager_ms:.1f}ms, exported {exported_ms:.1f}ms".format(**r))
+        assert all(r['max_abs_diff'] < args.tolerance for r in results), "Exported model differs from eager"
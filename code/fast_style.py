@@ -0,0 +1,218 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision
+import torchvision.transforms as T
+import PIL.Image
+from torch.utils.data import DataLoader
+import os, argparse, json, time
+
+from dataset import CocoStuffDataSet
+from generator import load_generator
+from style_transfer import (content_loss, style_loss, tv_loss, prep_style, FeatureExtractor, StyleTargetCache,
+                            COCO_ANIMAL_MEAN, COCO_ANIMAL_STD, device)
+from utils import inference_mode
+
+SAVE_DIR = "../checkpoints/fast_style" # Assuming this is launched from code/ subfolder.
+STYLE_DIR = "../styles/"
+
+
+class _ConvLayer(nn.Module):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, upsample=False, norm=True, relu=True):
+        super().__init__()
+        layers = []
+        if upsample:
+            layers.append(nn.Upsample(scale_factor=2, mode='nearest'))
+        layers += [nn.ReflectionPad2d(kernel_size // 2), nn.Conv2d(in_channels, out_channels, kernel_size, stride)]
+        if norm:
+            layers.append(nn.InstanceNorm2d(out_channels, affine=True))
+        if relu:
+            layers.append(nn.ReLU(inplace=True))
+        self.layer = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.layer(x)
+
+
+class _ResidualBlock(nn.Module):
+    def __init__(self, channels):
+        super().__init__()
+        self.block = nn.Sequential(_ConvLayer(channels, channels, 3), _ConvLayer(channels, channels, 3, relu=False))
+
+    def forward(self, x):
+        return x + self.block(x)
+
+
+class TransformerNet(nn.Module):
+    """
+    Feed-forward style network (Johnson et al. 2016): strided convolutions, residual blocks
+    and upsampling convolutions with instance normalization. Maps B x 3 x H x W images in
+    [0, 1] (H, W multiples of 4) to stylized images in [0, 1].
+    """
+    def __init__(self, channels=32, num_residual=5):
+        super().__init__()
+        self.net = nn.Sequential(
+            _ConvLayer(3, channels, 9),
+            _ConvLayer(channels, 2 * channels, 3, stride=2),
+            _ConvLayer(2 * channels, 4 * channels, 3, stride=2),
+            *[_ResidualBlock(4 * channels) for _ in range(num_residual)],
+            _ConvLayer(4 * channels, 2 * channels, 3, upsample=True),
+            _ConvLayer(2 * channels, channels, 3, upsample=True),
+            _ConvLayer(channels, 3, 9, norm=False, relu=False),
+        )
+
+    def forward(self, x):
+        return torch.sigmoid(self.net(x))
+
+
+def normalize_batch(images):
+    """ [0, 1] images to the normalization of style_transfer.preprocess (VGG input) """
+    mean = torch.tensor(COCO_ANIMAL_MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(COCO_ANIMAL_STD, device=images.device).view(1, 3, 1, 1)
+    return (images - mean) / std
+
+
+def train_style_network(cnn, style_image, loader, content_layer=12, content_weight=1e-3, style_layers=(0, 5, 10, 17, 24),
+                        style_weights=None, tv_weight=0, style_size=256, epochs=1, lr=1e-3, max_iters=None,
+                        print_every=100, style_cache=None):
+    """
+    Trains a TransformerNet for one style with the losses of style_transfer
+    Args:
+        cnn: VGG features (frozen)
+        style_image: PIL image
+        loader: DataLoader of (img, mask, mask_flat) with images in [0, 1] (do_normalize=False)
+    Return:
+        trained TransformerNet, list of losses
+    """
+    style_weights = style_weights or [1.0] * len(style_layers)
+    _, style_targets = prep_style(cnn, style_image, style_size, style_layers, style_cache)
+    extractor = FeatureExtractor(cnn, [content_layer] + list(style_layers))
+    net = TransformerNet().to(device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=lr)
+    losses = []
+    iters = 0
+    for epoch in range(epochs):
+        for data, _, _ in loader:
+            data = data.to(device)
+            with torch.no_grad():
+                content_target = extractor(normalize_batch(data))[content_layer]
+            stylized = net(data)
+            feats = extractor(normalize_batch(stylized))
+            loss = content_loss(content_weight, feats[content_layer], content_target)
+            loss = loss + style_loss(feats, style_layers, style_targets, style_weights, None)
+            loss = loss + tv_loss(stylized, tv_weight)
+            loss = loss / data.size(0)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if iters % print_every == 0:
+                losses.append(loss.item())
+                print ("Epoch {}, iteration {}: loss {}".format(epoch, iters, losses[-1]))
+            iters += 1
+            if max_iters is not None and iters >= max_iters:
+                return net, losses
+    return net, losses
+
+
+class MaskedStylizer():
+    """
+    Stylizes the background and the foreground (segmented by a generator) of images with two
+    feed-forward style networks, composited with the soft background probability:
+        out = p_bg * background_net(x) + (1 - p_bg) * foreground_net(x)
+    """
+    def __init__(self, generator, background_net, foreground_net=None, hard_mask=False):
+        self.generator = generator.to(device).eval()
+        self.background_net = background_net.to(device).eval()
+        self.foreground_net = foreground_net.to(device).eval() if foreground_net is not None else None
+        self.hard_mask = hard_mask
+
+    def background_probability(self, images):
+        """ B x 1 x H x W probability of the background class (the last one) """
+        probs = F.softmax(self.generator(images), dim=1)
+        if self.hard_mask:
+            return (probs.argmax(1, keepdim=True) == probs.size(1) - 1).float()
+        return probs[:, -1:]
+
+    def __call__(self, images):
+        """
+        Args:
+            images: B x 3 x H x W tensor in [0, 1], H and W multiples of 32
+        Return:
+            B x 3 x H x W stylized images in [0, 1]
+        """
+        with inference_mode():
+            images = images.to(device)
+            background = self.background_probability(images)
+            out = background * self.background_net(images)
+            if self.foreground_net is not None:
+                out = out + (1.0 - background) * self.foreground_net(images)
+            else:
+                out = out + (1.0 - background) * images
+        return out
+
+
+def load_style_network(path):
+    net = TransformerNet()
+    net.load_state_dict(torch.load(path, map_location='cpu'))
+    return net.to(device).eval()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Feed-forward style networks with segmentation masked compositing')
+    parser.add_argument('--mode', default='train', type=str,
+                        help='train (one network per style) / stylize (composite with a generator mask)')
+    parser.add_argument('--style', default='starry_night.jpg', type=str,
+                        help='style image in ../styles (train)')
+    parser.add_argument('--background_net', default=None, type=str, help='trained style network (stylize)')
+    parser.add_argument('--foreground_net', default=None, type=str, help='trained style network (stylize)')
+    parser.add_argument('--checkpoint', default=None, type=str, help='generator checkpoint (stylize)')
+    parser.add_argument('--input_dir', default=None, type=str, help='directory of images to stylize')
+    parser.add_argument('--output_dir', default='../stylized', type=str)
+    parser.add_argument('-s', '--size', default=256, type=int,
+                        help='size of the images (multiple of 32)')
+    parser.add_argument('-b', '--batch_size', default=8, type=int)
+    parser.add_argument('--epochs', default=2, type=int)
+    parser.add_argument('--max_iters', default=None, type=int)
+    parser.add_argument('--lr', default=1e-3, type=float)
+    parser.add_argument('--content_weight', default=1e-3, type=float)
+    parser.add_argument('--tv_weight', default=0, type=float)
+    parser.add_argument('--hard_mask', type=bool, default=False)
+    args = parser.parse_args()
+
+    if args.mode == 'train':
+        cnn = torchvision.models.vgg16(pretrained=True).features.to(device).eval()
+        for param in cnn.parameters():
+            param.requires_grad = False
+        dataset = CocoStuffDataSet(mode='train', supercategories=['animal'], height=args.size, width=args.size,
+                                   do_normalize=False)
+        loader = DataLoader(dataset, args.batch_size, shuffle=True, drop_last=True)
+        style_image = PIL.Image.open(os.path.join(STYLE_DIR, args.style)).convert('RGB')
+        net, losses = train_style_network(cnn, style_image, loader, content_weight=args.content_weight,
+                                          tv_weight=args.tv_weight, style_size=args.size, epochs=args.epochs,
+                                          lr=args.lr, max_iters=args.max_iters, style_cache=StyleTargetCache())
+        if not os.path.exists(SAVE_DIR):
+            os.makedirs(SAVE_DIR)
+        path = os.path.join(SAVE_DIR, os.path.splitext(args.style)[0] + '.pth')
+        torch.save(net.state_dict(), path)
+        with open(os.path.splitext(path)[0] + '.json', 'w') as outfile:
+            json.dump(dict(vars(args), losses=losses), outfile, indent=4)
+        print ("=> Saved style network '{}'".format(path))
+    elif args.mode == 'stylize':
+        from infer import list_images, load_image
+        assert args.checkpoint and args.background_net and args.input_dir, \
+            "stylize needs --checkpoint, --background_net and --input_dir"
+        stylizer = MaskedStylizer(load_generator(args.checkpoint, device=device), load_style_network(args.background_net),
+                                  load_style_network(args.foreground_net) if args.foreground_net else None,
+                                  args.hard_mask)
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        paths = list_images(args.input_dir)
+        start = time.time()
+        for i in range(0, len(paths), args.batch_size):
+            batch_paths = paths[i:i + args.batch_size]
+            images = torch.stack([load_image(path, args.size)[1] for path in batch_paths])
+            out = stylizer(images)
+            for path, img in zip(batch_paths, out.cpu()):
+                T.functional.to_pil_image(img).save(os.path.join(args.output_dir, os.path.basename(path)))
+        elapsed = time.time() - start
+        print ("Stylized {} images in {:.1f}s ({:.1f}ms per image)".format(len(paths), elapsed, 1000.0 * elapsed / max(len(paths), 1)))
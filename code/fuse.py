@@ -0,0 +1,134 @@
+import torch
+import torch.nn as nn
+from collections import OrderedDict
+import copy, os, argparse
+
+from generator import load_generator, num_classes_from_state_dict
+from discriminator import GAN
+from utils import inference_mode, time_fn
+
+CONVS = (nn.Conv2d, nn.ConvTranspose2d)
+ACTIVATIONS = (nn.ReLU, nn.ReLU6, nn.LeakyReLU) # ReLU6 in the MobileNetV2 blocks of MobileSegNet
+
+
+def fold_conv_bn(conv, bn):
+    """
+    Folds an eval-mode BatchNorm2d into the preceding convolution, in place:
+        bn(conv(x)) = (gamma / std) * (W x + b - mean) + beta
+    """
+    assert isinstance(conv, nn.Conv2d) or conv.groups == 1
+    std = torch.sqrt(bn.running_var + bn.eps)
+    gamma = bn.weight.data if bn.affine else torch.ones_like(std)
+    beta = bn.bias.data if bn.affine else torch.zeros_like(std)
+    scale = gamma / std
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(std)
+    if isinstance(conv, nn.ConvTranspose2d):
+        conv.weight.data *= scale.view(1, -1, 1, 1) # C_in x C_out x kH x kW
+    else:
+        conv.weight.data *= scale.view(-1, 1, 1, 1) # C_out x C_in x kH x kW
+    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + beta)
+
+
+def _sequentials(model):
+    return [m for m in model.modules() if isinstance(m, nn.Sequential)]
+
+
+def fold_batchnorm(model):
+    """
+    Returns a copy of the model for inference where every BatchNorm2d directly following a
+    Conv2d / ConvTranspose2d in an nn.Sequential is folded into the convolution and removed,
+    and the activations following a convolution are made in-place (no extra memory pass).
+    Convolutions reused at several places (e.g. dec5) are only folded if every use is
+    followed by the same BatchNorm.
+    """
+    model = copy.deepcopy(model).eval()
+    # Follower of each use of each convolution
+    followers = {}
+    for seq in _sequentials(model):
+        children = list(seq._modules.values()) # children() skips the repeated layers
+        for i, module in enumerate(children):
+            if isinstance(module, CONVS):
+                follower = children[i + 1] if i + 1 < len(children) else None
+                followers.setdefault(id(module), []).append(follower)
+    foldable = set(conv_id for conv_id, fs in followers.items()
+                   if isinstance(fs[0], nn.BatchNorm2d) and all(f is fs[0] for f in fs))
+
+    folded = set()
+    for seq in _sequentials(model):
+        children = list(seq._modules.values()) # children() skips the repeated layers
+        kept = []
+        for i, module in enumerate(children):
+            previous = children[i - 1] if i > 0 else None
+            if isinstance(module, nn.BatchNorm2d) and isinstance(previous, CONVS) and id(previous) in foldable:
+                if id(previous) not in folded:
+                    fold_conv_bn(previous, module)
+                    folded.add(id(previous))
+                continue
+            if isinstance(module, ACTIVATIONS) and isinstance(previous, CONVS + (nn.BatchNorm2d,)):
+                # The input of the activation is a temporary of this Sequential
+                module.inplace = True
+            kept.append(module)
+        seq._modules = OrderedDict((str(j), m) for j, m in enumerate(kept))
+    print ("Folded {} BatchNorm layers".format(len(folded)))
+    return model
+
+
+def freeze_for_inference(model, example):
+    """
+    Traces and freezes the model; when available, optimize_for_inference also fuses
+    convolutions with the following ReLU for the CPU backend.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+    if hasattr(torch.jit, 'optimize_for_inference'):
+        traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
+def compare_outputs(model, fused, inputs, repeat=10):
+    """ Max absolute difference and latency of the fused model against the original """
+    with inference_mode():
+        reference = model.eval()(*inputs)
+        output = fused(*inputs)
+        original_time = time_fn(lambda: model(*inputs), repeat=repeat)
+        fused_time = time_fn(lambda: fused(*inputs), repeat=repeat)
+    return {
+        'max_abs_diff': (reference - output).abs().max().item(),
+        'original_ms': original_time['mean_ms'],
+        'fused_ms': fused_time['mean_ms'],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fold BatchNorm into convolutions for inference')
+    parser.add_argument('checkpoint', type=str,
+                        help='checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('--output', '-o', default=None, type=str,
+                        help='TorchScript output (default: <checkpoint dir>/fused.pt)')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('--discriminator', type=bool, default=False,
+                        help='fold the discriminator of the checkpoint instead of the generator')
+    parser.add_argument('-s', '--size', default=128, type=int)
+    parser.add_argument('-b', '--batch_size', default=8, type=int)
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(os.path.dirname(args.checkpoint),
+                                         'fused_disc.pt' if args.discriminator else 'fused.pt')
+    generator = load_generator(args.checkpoint, args.generator_name, device='cpu')
+    image = torch.rand(args.batch_size, 3, args.size, args.size)
+    if args.discriminator:
+        num_classes = num_classes_from_state_dict(generator.state_dict())
+        model = GAN(num_classes, (num_classes, args.size, args.size), (3, args.size, args.size))
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu')['disc_dict'])
+        inputs = (image, torch.softmax(generator(image), 1).detach())
+    else:
+        model = generator
+        inputs = (image,)
+
+    fused = freeze_for_inference(fold_batchnorm(model), inputs)
+    torch.jit.save(fused, output)
+    print ("=> Saved fused model '{}'".format(output))
+    print (compare_outputs(model, fused, inputs))
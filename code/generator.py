@@ -2,16 +2,75 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
+import os, json
 from utils import *
 
-def get_generator(generator_name, num_classes, use_bn=True):
-    name_to_model = {
-        'VerySmallNet':VerySmallNet,
-        'SegNetSmaller':SegNetSmaller,
-        'SegNetSmall':SegNetSmall,
-        'SegNet16':SegNet16
-    }
-    return name_to_model[generator_name](num_classes, use_bn=use_bn)
+def get_generator(generator_name, num_classes, use_bn=True, pretrained=True):
+    """
+    Args:
+        generator_name: (str) key of GENERATORS
+        num_classes: (int) number of output classes to be predicted
+        use_bn: (bool) use batch norm in the decoder blocks
+        pretrained: (bool) if False the VGG encoders are randomly initialized
+            instead of downloading the ImageNet weights (benchmarks, loading checkpoints)
+    """
+    return GENERATORS[generator_name](num_classes, pretrained=pretrained, use_bn=use_bn)
+
+def num_classes_from_state_dict(state_dict):
+    """
+    Number of output classes of a generator state dict: out channels of its last convolution
+    """
+    weights = [v for k, v in state_dict.items() if k.endswith('weight') and v.dim() == 4]
+    return weights[-1].size(0)
+
+def load_generator(checkpoint_path, generator_name=None, use_bn=None, num_classes=None, device='cpu'):
+    """
+    Builds a generator from a Trainer checkpoint without downloading the VGG weights
+    Args:
+        checkpoint_path: (str) path to a checkpoint saved by Trainer.save_model
+        generator_name, use_bn: (str, bool) architecture. If None, read from the args.json
+            saved by main.py next to the checkpoint
+        num_classes: (int) if None, inferred from the checkpoint
+        device: device to load the model on
+    Return:
+        generator in eval mode
+    """
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    if generator_name is None or use_bn is None:
+        with open(os.path.join(os.path.dirname(checkpoint_path), 'args.json'), 'r') as infile:
+            args_dict = json.load(infile)
+        generator_name = generator_name or args_dict['generator_name']
+        use_bn = args_dict.get('use_bn', True) if use_bn is None else use_bn
+    state_dict = checkpoint.get('gen_dict', checkpoint)
+    if num_classes is None:
+        num_classes = num_classes_from_state_dict(state_dict)
+    model = get_generator(generator_name, num_classes, use_bn, pretrained=False)
+    resize_to_state_dict(model, state_dict)
+    model.load_state_dict(state_dict)
+    return model.to(device).eval()
+
+def resize_to_state_dict(model, state_dict):
+    """
+    Shrinks the convolutions and batch norms of a model, in place, to the shapes of a state dict
+    (decoders whose channels were removed by prune.py). The values are left uninitialized.
+    """
+    for name, module in model.named_modules():
+        prefix = name + '.' if name else ''
+        weight = state_dict.get(prefix + 'weight')
+        if weight is None or not hasattr(module, 'weight') or weight.shape == module.weight.shape:
+            continue
+        if isinstance(module, nn.ConvTranspose2d):
+            module.in_channels, module.out_channels = weight.size(0), weight.size(1)
+        elif isinstance(module, nn.Conv2d):
+            module.out_channels, module.in_channels = weight.size(0), weight.size(1)
+        elif isinstance(module, nn.BatchNorm2d):
+            module.num_features = weight.size(0)
+            module.running_mean = torch.zeros(weight.size(0))
+            module.running_var = torch.ones(weight.size(0))
+        module.weight = nn.Parameter(torch.empty(weight.shape))
+        if module.bias is not None:
+            module.bias = nn.Parameter(torch.empty(state_dict[prefix + 'bias'].shape))
+
 
 class _DecoderBlock(nn.Module):
     """
@@ -55,7 +114,7 @@ class _DecoderBlock(nn.Module):
 
 
 class VerySmallNet(nn.Module):
-    def __init__(self, num_classes, use_bn=False):
+    def __init__(self, num_classes, pretrained=False, use_bn=False):
         super().__init__()
         self.net = nn.Conv2d(3, num_classes, kernel_size=3, padding=1)
 
@@ -207,3 +266,130 @@ class SegNet16(nn.Module):
         enc4 = self.enc4(enc3)
         enc5 = self.enc5(enc4)
         return flatten(enc5)
+
+
+def _separable_conv(in_channels, out_channels, stride=1, use_bn=True):
+    """
+    Depthwise 3x3 convolution then pointwise 1x1 convolution, each followed by BatchNorm
+    (if use_bn, otherwise the convolutions have a bias) and ReLU6
+    """
+    layers = [nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=stride, padding=1, groups=in_channels, bias=not use_bn)]
+    if use_bn:
+        layers.append(nn.BatchNorm2d(in_channels))
+    layers += [nn.ReLU6(inplace=True), nn.Conv2d(in_channels, out_channels, kernel_size=1, bias=not use_bn)]
+    if use_bn:
+        layers.append(nn.BatchNorm2d(out_channels))
+    layers.append(nn.ReLU6(inplace=True))
+    return layers
+
+
+class _SeparableDecoderBlock(nn.Module):
+    """
+    Light decoder block: x2 nearest upsampling then depthwise separable convolutions.
+    The last block ends with a 1x1 convolution producing the class scores.
+    """
+    def __init__(self, in_channels, out_channels, final=False, use_bn=True):
+        """
+        Args:
+            in_channels: (int) number of input channels to this block (skip + decoder)
+            out_channels: (int) number of out_channels from this block
+            final: (bool) if True the outputs are logits (no BatchNorm or activation)
+            use_bn: (bool) if True BatchNorm is applied after the convolutions
+        """
+        super().__init__()
+        middle_channels = max(in_channels // 2, out_channels)
+        layers = [nn.Upsample(scale_factor=2, mode='nearest'), *_separable_conv(in_channels, middle_channels, use_bn=use_bn)]
+        if final:
+            layers.append(nn.Conv2d(middle_channels, out_channels, kernel_size=1))
+        else:
+            layers += _separable_conv(middle_channels, out_channels, use_bn=use_bn)
+        self.decode = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.decode(x)
+
+
+class MobileSegNet(nn.Module):
+    """
+    Encoder-decoder on a MobileNetV2 encoder (inverted residual blocks) with
+    depthwise separable decoder blocks, and the skip connections of SegNet16
+    """
+    def __init__(self, num_classes, pretrained=True, use_bn=True):
+        """
+        Args:
+            num_classes: (int) number of output classes to be predicted
+            pretrained: (bool) if True loads MobileNetV2 ImageNet weights. default=True
+            use_bn: (bool) BatchNorm in the decoder blocks (the MobileNetV2 encoder always has it)
+        """
+        super().__init__()
+        features = list(models.mobilenet_v2(pretrained).features.children())
+        self.enc1 = nn.Sequential(*features[:2]) # C_out 16, 1/2
+        self.enc2 = nn.Sequential(*features[2:4]) # C_out 24, 1/4
+        self.enc3 = nn.Sequential(*features[4:7]) # C_out 32, 1/8
+        self.enc4 = nn.Sequential(*features[7:14]) # C_out 96, 1/16
+        self.enc5 = nn.Sequential(*features[14:18]) # C_out 320, 1/32
+
+        self.dec5 = _SeparableDecoderBlock(320, 96, use_bn=use_bn)
+        self.dec4 = _SeparableDecoderBlock(96 + 96, 32, use_bn=use_bn)
+        self.dec3 = _SeparableDecoderBlock(32 + 32, 24, use_bn=use_bn)
+        self.dec2 = _SeparableDecoderBlock(24 + 24, 16, use_bn=use_bn)
+        self.dec1 = _SeparableDecoderBlock(16 + 16, num_classes, final=True, use_bn=use_bn)
+        initialize_weights(self.dec5, self.dec4, self.dec3, self.dec2, self.dec1)
+
+    def forward(self, x):
+        enc1 = self.enc1(x)
+        enc2 = self.enc2(enc1)
+        enc3 = self.enc3(enc2)
+        enc4 = self.enc4(enc3)
+        enc5 = self.enc5(enc4)
+        dec5 = self.dec5(enc5)
+        dec4 = self.dec4(torch.cat([enc4, dec5], 1))
+        dec3 = self.dec3(torch.cat([enc3, dec4], 1))
+        dec2 = self.dec2(torch.cat([enc2, dec3], 1))
+        dec1 = self.dec1(torch.cat([enc1, dec2], 1))
+        return dec1
+
+
+class SeparableSegNet(nn.Module):
+    """
+    Encoder-decoder made only of depthwise separable convolutions (MobileNetV1 style),
+    trained from scratch, with the skip connections of SegNet16
+    """
+    def __init__(self, num_classes, pretrained=False, use_bn=True):
+        super().__init__()
+        self.enc1 = nn.Sequential(*Conv2d_BatchNorm2d(3, 32, kernel_size=3, padding=1, use_bn=use_bn),
+                                  nn.ReLU6(inplace=True), *_separable_conv(32, 32, stride=2, use_bn=use_bn)) # C_out 32, 1/2
+        self.enc2 = nn.Sequential(*_separable_conv(32, 64, stride=2, use_bn=use_bn), *_separable_conv(64, 64, use_bn=use_bn)) # 1/4
+        self.enc3 = nn.Sequential(*_separable_conv(64, 128, stride=2, use_bn=use_bn), *_separable_conv(128, 128, use_bn=use_bn)) # 1/8
+        self.enc4 = nn.Sequential(*_separable_conv(128, 256, stride=2, use_bn=use_bn), *_separable_conv(256, 256, use_bn=use_bn)) # 1/16
+        self.enc5 = nn.Sequential(*_separable_conv(256, 256, stride=2, use_bn=use_bn), *_separable_conv(256, 256, use_bn=use_bn)) # 1/32
+
+        self.dec5 = _SeparableDecoderBlock(256, 256, use_bn=use_bn)
+        self.dec4 = _SeparableDecoderBlock(256 + 256, 128, use_bn=use_bn)
+        self.dec3 = _SeparableDecoderBlock(128 + 128, 64, use_bn=use_bn)
+        self.dec2 = _SeparableDecoderBlock(64 + 64, 32, use_bn=use_bn)
+        self.dec1 = _SeparableDecoderBlock(32 + 32, num_classes, final=True, use_bn=use_bn)
+        initialize_weights(self)
+
+    def forward(self, x):
+        enc1 = self.enc1(x)
+        enc2 = self.enc2(enc1)
+        enc3 = self.enc3(enc2)
+        enc4 = self.enc4(enc3)
+        enc5 = self.enc5(enc4)
+        dec5 = self.dec5(enc5)
+        dec4 = self.dec4(torch.cat([enc4, dec5], 1))
+        dec3 = self.dec3(torch.cat([enc3, dec4], 1))
+        dec2 = self.dec2(torch.cat([enc2, dec3], 1))
+        dec1 = self.dec1(torch.cat([enc1, dec2], 1))
+        return dec1
+
+
+GENERATORS = {
+    'VerySmallNet':VerySmallNet,
+    'SegNetSmaller':SegNetSmaller,
+    'SegNetSmall':SegNetSmall,
+    'SegNet16':SegNet16,
+    'MobileSegNet':MobileSegNet,
+    'SeparableSegNet':SeparableSegNet,
+}
@@ -0,0 +1,213 @@
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as T
+import numpy as np
+from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import os, argparse, time
+
+from generator import load_generator, num_classes_from_state_dict
+from fuse import fold_batchnorm
+from tiling import TiledPredictor
+from prediction_store import PredictionStoreWriter, image_id_from_path, coco_cat_ids
+from prediction_cache import PredictionCache
+from utils import inference_mode, label_map_to_rle
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def list_images(input_dir):
+    """ Sorted image paths of a directory, for a deterministic output order """
+    return sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir)
+                  if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def load_image(path, size=None):
+    """
+    Decodes an image (run in a thread pool: PIL releases the GIL while decoding)
+    Args:
+        path: (str) image file
+        size: (int) side of the square input of the generator, None to keep the full resolution
+    Return:
+        (path, 3 x H x W tensor in [0, 1], (height, width) of the original image)
+    """
+    img = Image.open(path).convert('RGB')
+    original_size = (img.height, img.width)
+    if size is not None:
+        img = img.resize((size, size), Image.BILINEAR)
+    return path, T.functional.to_tensor(img), original_size
+
+
+def save_label_png(label_map, path):
+    """ Encodes a H x W uint8 map of classes as a PNG (run in a process pool) """
+    Image.fromarray(label_map, mode='L').save(path)
+    return path
+
+
+class BatchSegmenter():
+    """
+    Predicts label maps at the original resolution of each image, either from a batched forward
+    at a fixed size followed by bilinear upsampling of the logits, or by tiled inference.
+    With a prediction_cache.PredictionCache and the checkpoint of the model, the logits of
+    inputs already segmented with the same checkpoint content are read from the cache.
+    """
+    def __init__(self, model, device, tiled_predictor=None, cache=None, checkpoint_path=None):
+        self.model = model.to(device).eval()
+        self.device = torch.device(device)
+        self.tiled_predictor = tiled_predictor
+        self.cache = cache
+        self.content = cache.register_checkpoint(checkpoint_path) if cache is not None else None
+
+    def __call__(self, images, original_sizes, image_ids=None):
+        """
+        Args:
+            images: list of 3 x H x W tensors (all of the same size unless tiled)
+            original_sizes: list of (height, width) to produce the label maps at
+            image_ids: ids of the images, recorded with their cache entries
+        Return:
+            list of H x W uint8 numpy arrays
+        """
+        if self.tiled_predictor is not None:
+            return [self.tiled_predictor.predict_labels(img).byte().cpu().numpy() for img in images]
+        data = torch.stack(images).to(self.device)
+        if self.cache is not None:
+            logits = self.cache.cached_forward(self.model, self.content, image_ids, data, tuple(data.shape[2:]))
+        else:
+            with inference_mode():
+                logits = self.model(data)
+        with inference_mode():
+            label_maps = []
+            for i, (height, width) in enumerate(original_sizes):
+                upsampled = F.interpolate(logits[i:i + 1], size=(height, width), mode='bilinear', align_corners=False)
+                label_maps.append(torch.argmax(upsampled[0], 0).byte().cpu().numpy())
+        return label_maps
+
+
+def _finish(encoded, store):
+    path, future = encoded
+    result = future.result()
+    if store is not None:
+        store.add_encoded(image_id_from_path(path), result)
+
+
+def segment_directory(segmenter, paths, output_dir, size, batch_size=16, decode_workers=4,
+                      encode_workers=2, prefetch_batches=2, store=None):
+    """
+    Segments images with overlapping stages: JPEG decode in a thread pool, batched forward
+    in the calling thread, PNG encode in a process pool. Outputs keep the input file names.
+    If store (prediction_store.PredictionStoreWriter) is given, the label maps are RLE encoded
+    in the process pool and appended to the store instead of being written as PNGs.
+    Return:
+        dict of timings and throughput
+    """
+    start = time.time()
+    forward_time = 0.0
+    decode_pool = ThreadPoolExecutor(decode_workers)
+    encode_pool = ProcessPoolExecutor(encode_workers)
+    max_in_flight = prefetch_batches * batch_size
+    decoding = deque(decode_pool.submit(load_image, path, size) for path in paths[:max_in_flight])
+    paths_iter = iter(paths[max_in_flight:])
+    encoding = deque()
+    batch = []
+    num_done = 0
+    while decoding:
+        batch.append(decoding.popleft().result())
+        next_path = next(paths_iter, None)
+        if next_path is not None:
+            decoding.append(decode_pool.submit(load_image, next_path, size))
+        if len(batch) == batch_size or not decoding:
+            batch_paths, images, original_sizes = zip(*batch)
+            forward_start = time.time()
+            label_maps = segmenter(list(images), list(original_sizes), [image_id_from_path(p) for p in batch_paths])
+            forward_time += time.time() - forward_start
+            for path, label_map in zip(batch_paths, label_maps):
+                if store is not None:
+                    encoding.append((path, encode_pool.submit(label_map_to_rle, label_map)))
+                else:
+                    name = os.path.splitext(os.path.basename(path))[0] + '.png'
+                    encoding.append((path, encode_pool.submit(save_label_png, label_map, os.path.join(output_dir, name))))
+            batch = []
+            # Bound the number of label maps waiting to be encoded
+            while len(encoding) > max_in_flight:
+                _finish(encoding.popleft(), store)
+                num_done += 1
+    for encoded in encoding:
+        _finish(encoded, store)
+        num_done += 1
+    decode_pool.shutdown()
+    encode_pool.shutdown()
+    total_time = time.time() - start
+    return {
+        'images': num_done,
+        'seconds': total_time,
+        'forward_seconds': forward_time,
+        'images_per_sec': num_done / max(total_time, 1e-12),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Segment a directory of images')
+    parser.add_argument('checkpoint', type=str,
+                        help='checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('input_dir', type=str, help='directory of JPEG/PNG images')
+    parser.add_argument('output_dir', type=str, help='directory of the label PNGs or of the prediction store')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('-s', '--size', default=128, type=int,
+                        help='size of the generator input (default:128)')
+    parser.add_argument('-b', '--batch_size', default=16, type=int)
+    parser.add_argument('--decode_workers', default=4, type=int)
+    parser.add_argument('--encode_workers', default=2, type=int)
+    parser.add_argument('--tiled', type=bool, default=False,
+                        help='full resolution tiled inference instead of resizing')
+    parser.add_argument('--tile_size', default=256, type=int)
+    parser.add_argument('--overlap', default=64, type=int)
+    parser.add_argument('--memory_budget_mb', default=512, type=float)
+    parser.add_argument('--store', type=bool, default=False,
+                        help='write a single RLE prediction store (<output_dir>/predictions.segrle) instead of PNGs')
+    parser.add_argument('--annotations', default='../cocostuff/annotations/instances_val2017.json', type=str,
+                        help='COCO annotation file giving the category ids recorded in the store (with --store)')
+    parser.add_argument('--supercategories', nargs='+', default=['animal'],
+                        help='supercategories the generator was trained on (with --store)')
+    parser.add_argument('--cache', type=bool, default=False,
+                        help='reuse the logits of images already segmented with the same checkpoint')
+    parser.add_argument('--cache_size_mb', default=2048, type=float)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--fold_bn', type=bool, default=False,
+                        help='fold BatchNorm layers into the convolutions before serving')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    model = load_generator(args.checkpoint, args.generator_name, device=args.device)
+    if args.fold_bn:
+        model = fold_batchnorm(model)
+    tiled_predictor = None
+    if args.tiled:
+        tiled_predictor = TiledPredictor(model, args.tile_size, args.overlap, args.memory_budget_mb, args.device)
+    cache = PredictionCache(max_size_mb=args.cache_size_mb) if args.cache else None
+    segmenter = BatchSegmenter(model, args.device, tiled_predictor, cache, args.checkpoint)
+
+    paths = list_images(args.input_dir)
+    print ("Segmenting {} images".format(len(paths)))
+    store = None
+    if args.store:
+        assert os.path.exists(args.annotations), \
+            "--store records the COCO category ids of the classes: --annotations {} not found".format(args.annotations)
+        cat_ids = coco_cat_ids(args.annotations, args.supercategories)
+        num_classes = num_classes_from_state_dict(model.state_dict())
+        assert len(cat_ids) + 1 == num_classes, \
+            "{} categories in {} for a generator with {} classes".format(len(cat_ids), args.supercategories, num_classes)
+        store = PredictionStoreWriter(os.path.join(args.output_dir, 'predictions.segrle'),
+                                      {'checkpoint': os.path.abspath(args.checkpoint), 'input_dir': args.input_dir,
+                                       'catIds': cat_ids, 'numClasses': num_classes,
+                                       'supercategories': args.supercategories})
+    stats = segment_directory(segmenter, paths, args.output_dir, None if args.tiled else args.size,
+                              batch_size=1 if args.tiled else args.batch_size,
+                              decode_workers=args.decode_workers, encode_workers=args.encode_workers, store=store)
+    if store is not None:
+        store.close()
+        print ("=> Saved prediction store '{}'".format(store.path))
+    print ("Segmented {} images in {:.1f}s ({:.1f}s forward): {:.2f} images/sec".format(
+        stats['images'], stats['seconds'], stats['forward_seconds'], stats['images_per_sec']))
@@ -1,9 +1,10 @@
 import torch
 from torch.utils.data import DataLoader
-from train import Trainer
-from generator import get_generator
+from train import Trainer, EVAL_METRIC
+from generator import get_generator, load_generator
 from discriminator import GAN
-from dataset import CocoStuffDataSet
+from dataset import CocoStuffDataSet, ResumableRandomSampler
+from distill import cache_teacher_logits, TeacherLogitsDataSet
 import os, argparse, datetime, json
 
 SAVE_DIR = "../checkpoints" # Assuming this is launched from code/ subfolder.
@@ -28,6 +29,12 @@ if __name__ == "__main__":
                         help='load model from checkpoint ')
     parser.add_argument('--load_iter', '-li', type=int, default=None,
                         help='specify which iter to resume training from')
+    parser.add_argument('--load_last', type=bool, default=False,
+                        help='resume from the last snapshot instead of the best checkpoint')
+    parser.add_argument('--snapshot_every', default=0, type=int,
+                        metavar='N', help='frequency of cheap resumable snapshots (default: 0, disabled)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='seed of the training data order')
     parser.add_argument('--experiment_name', '-n', type=str, default=None,
                         help='name of experiment used for saving loading checkpoints')
     # GAN Hyperparameters
@@ -49,6 +56,15 @@ if __name__ == "__main__":
                         help='Name of generator model to run')
     parser.add_argument('--use_bn', default='True', type=bool,
                         help='Use batch norm in Decoder block')
+    # Distillation
+    parser.add_argument('--teacher', default=None, type=str,
+                        help='checkpoint of a trained generator (e.g. SegNet16) to distill from')
+    parser.add_argument('--distill_weight', default=0.5, type=float,
+                        help='weight of the distillation loss')
+    parser.add_argument('--distill_temperature', default=2.0, type=float,
+                        help='softmax temperature of the distillation loss')
+    parser.add_argument('--cache_teacher_logits', type=bool, default=False,
+                        help='run the teacher once over the train set and read its logits from disk')
    
     args = parser.parse_args()
 
@@ -75,6 +91,9 @@ if __name__ == "__main__":
             args_dict['gan_reg'] = args.gan_reg
             args_dict['disc_lr'] = args.disc_lr
             args_dict['gen_lr'] = args.gen_lr
+            args_dict['load_iter'] = args.load_iter
+            args_dict['load_last'] = args.load_last
+            args_dict['snapshot_every'] = args.snapshot_every
 
             current_dict = vars(args)
             for (key, value) in args_dict.items():
@@ -85,7 +104,18 @@ if __name__ == "__main__":
     val_dataset = CocoStuffDataSet(mode='val', supercategories=['animal'], height=HEIGHT, width=WIDTH, do_normalize=False)
     train_dataset = CocoStuffDataSet(mode='train', supercategories=['animal'], height=HEIGHT, width=WIDTH, do_normalize=False)
     val_loader = DataLoader(val_dataset, args.batch_size, shuffle=False)
-    train_loader = DataLoader(train_dataset, args.batch_size, shuffle=True)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    teacher = None
+    if args.teacher is not None:
+        teacher = load_generator(args.teacher, device=device)
+        if args.cache_teacher_logits:
+            logits_path = os.path.join(os.path.dirname(args.teacher), 'teacher_logits_train_{}.npy'.format(args.size))
+            if not os.path.exists(logits_path):
+                cache_teacher_logits(teacher, train_dataset, logits_path, args.batch_size, device)
+            train_dataset = TeacherLogitsDataSet(train_dataset, logits_path)
+            teacher = None
+    train_sampler = ResumableRandomSampler(train_dataset, seed=args.seed)
+    train_loader = DataLoader(train_dataset, args.batch_size, sampler=train_sampler)
     NUM_CLASSES = train_dataset.numClasses
     print ("Number of classes: {}".format(NUM_CLASSES))
     image_shape = (3, HEIGHT, WIDTH)
@@ -98,12 +128,29 @@ if __name__ == "__main__":
     trainer = Trainer(generator, discriminator, train_loader, val_loader, \
                     gan_reg=args.gan_reg, weight_clip=args.weight_clip, grad_clip=args.grad_clip, \
                     noise_scale=args.noise_scale, disc_lr=args.disc_lr, gen_lr=args.gen_lr, train_gan= args.train_gan, \
-                    experiment_dir=experiment_dir, resume=args.load_model, load_iter=args.load_iter)
+                    experiment_dir=experiment_dir, resume=args.load_model,
+                    load_iter='last' if args.load_last else args.load_iter, device=device,
+                    teacher=teacher, distill_weight=args.distill_weight,
+                    distill_temperature=args.distill_temperature)
 
     if args.mode == "train":
-        trainer.train(num_epochs=args.epochs, print_every=args.print_every, eval_every=args.eval_every)
+        trainer.train(num_epochs=args.epochs, print_every=args.print_every, eval_every=args.eval_every,
+                      snapshot_every=args.snapshot_every)
     elif args.mode == 'eval':
         assert(args.load_model), "Need to load model to evaluate it"
-        # just do evaluation
-        print (trainer.get_confusion_matrix(val_loader))
-        print ('mIOU {}'.format(trainer.evaluate_meanIOU(val_loader)))
+        # just do evaluation, every report from a single pass over the validation set
+        reports = ['metrics', 'confusion', 'second']
+        if trainer.train_gan:
+            reports.append('discriminator')
+        results = trainer.evaluate_reports(val_loader, reports)
+        print ("Confusion matrix")
+        print (results['confusion'])
+        print ("Runner-up class matrix")
+        print (results['second'])
+        print ("Metrics on the hard labels ({}), not comparable to those of the dataset masks".format(EVAL_METRIC))
+        print ('Pixel accuracy {}'.format(results['pixel_acc']))
+        print ('mIOU {}'.format(results['mIOU']))
+        print ('Per class accuracy {}'.format(results['per_class_acc']))
+        if trainer.train_gan:
+            print ('Discriminator true positive {}, true negative {}'.format(
+                results['true_positive'], results['true_negative']))
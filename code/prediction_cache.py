@@ -0,0 +1,183 @@
+import torch
+import numpy as np
+import hashlib, os, json, time
+
+from utils import inference_mode
+
+CACHE_DIR = "../cache/predictions" # Assuming this is launched from code/ subfolder.
+INDEX_VERSION = 2 # 1: entries keyed by image id
+
+_hashes = {} # (path, mtime, size) -> content hash, so that a checkpoint is read once per process
+
+
+def checkpoint_hash(checkpoint_path):
+    """ SHA-1 of the content of a checkpoint file """
+    stat = os.stat(checkpoint_path)
+    memo_key = (os.path.abspath(checkpoint_path), stat.st_mtime, stat.st_size)
+    if memo_key not in _hashes:
+        sha1 = hashlib.sha1()
+        with open(checkpoint_path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b''):
+                sha1.update(chunk)
+        _hashes[memo_key] = sha1.hexdigest()
+    return _hashes[memo_key]
+
+
+def input_hash(image):
+    """ SHA-1 of a decoded input tensor (values, shape and dtype) """
+    array = image.detach().cpu().contiguous().numpy()
+    sha1 = hashlib.sha1(array.tobytes())
+    sha1.update('{} {}'.format(array.shape, array.dtype).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class PredictionCache():
+    '''
+    Content addressed on-disk cache of generator outputs (logits, label maps, embeddings):
+    an entry is keyed by the hash of the checkpoint content, the hash of the input tensor,
+    the input size and the kind of output. Image ids are only recorded as labels, so two
+    files with the same name in different directories never share an entry. Retraining a checkpoint changes its hash, and the entries of
+    the previous content of the same checkpoint path are deleted when it is registered again.
+    The total size is bounded: the least recently used entries are evicted first.
+    '''
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb=2048):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_mb * 2 ** 20)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = {'checkpoints': {}, 'entries': {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as infile:
+                index = json.load(infile)
+            if index.get('version') == INDEX_VERSION:
+                self.index = index
+            else: # entries of an older key scheme are unreachable
+                for key in index['entries']:
+                    if os.path.exists(self._path(key)):
+                        os.remove(self._path(key))
+        self.index['version'] = INDEX_VERSION
+        self.total_bytes = sum(e['bytes'] for e in self.index['entries'].values())
+        self.hits = 0
+        self.misses = 0
+
+    def register_checkpoint(self, checkpoint_path):
+        """
+        Return: content hash of the checkpoint, after invalidating the entries computed
+        from a previous content of the same path
+        """
+        path = os.path.abspath(checkpoint_path)
+        content = checkpoint_hash(path)
+        previous = self.index['checkpoints'].get(path)
+        self.index['checkpoints'][path] = content
+        if previous is not None and previous != content and previous not in self.index['checkpoints'].values():
+            for key in [k for k, e in self.index['entries'].items() if e['checkpoint'] == previous]:
+                self._remove(key)
+        self._save_index()
+        return content
+
+    def _key(self, content, image_hash, size, kind):
+        if isinstance(size, (tuple, list)):
+            size = 'x'.join(str(s) for s in size)
+        return '{}/{}_{}_{}'.format(content[:16], kind, size, image_hash[:24])
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _remove(self, key):
+        self.total_bytes -= self.index['entries'].pop(key)['bytes']
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def _save_index(self):
+        with open(self.index_path + '.tmp', 'w') as outfile:
+            json.dump(self.index, outfile)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def get(self, content, image_hash, size, kind='logits'):
+        """ Return: cached numpy array for the input of hash image_hash (see input_hash), or None """
+        key = self._key(content, image_hash, size, kind)
+        entry = self.index['entries'].get(key)
+        if entry is None or not os.path.exists(self._path(key)):
+            self.misses += 1
+            return None
+        entry['last_access'] = time.time()
+        self.hits += 1
+        return np.load(self._path(key))
+
+    def put(self, content, image_hash, size, array, kind='logits', save_index=True, image_id=None):
+        key = self._key(content, image_hash, size, kind)
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        np.save(path, array)
+        if key in self.index['entries']:
+            self.total_bytes -= self.index['entries'][key]['bytes']
+        self.index['entries'][key] = {'checkpoint': content, 'bytes': os.path.getsize(path), 'last_access': time.time(),
+                                      'image_id': image_id}
+        self.total_bytes += self.index['entries'][key]['bytes']
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        if save_index:
+            self._save_index()
+
+    def _evict(self):
+        entries = self.index['entries']
+        for key in sorted(entries, key=lambda k: entries[k]['last_access']):
+            if self.total_bytes <= self.max_bytes:
+                break
+            self._remove(key)
+
+    def cached_forward(self, fn, content, image_ids, data, size, kind='logits', dtype=np.float16):
+        """
+        Outputs of fn for a batch, running fn only on the images missing from the cache.
+        The outputs are rounded to dtype on a miss as well, so that a first and a cached run agree.
+        Args:
+            fn: (callable) B x 3 x H x W tensor -> B x ... tensor (e.g. the generator)
+            content: checkpoint hash returned by register_checkpoint
+            image_ids: ids of the images of the batch, recorded in the index (or None)
+            data: B x 3 x H x W tensor, on the device of fn; the entries are keyed by its content
+        Return:
+            B x ... tensor on the device of data
+        """
+        hashes = [input_hash(image) for image in data]
+        image_ids = image_ids if image_ids is not None else [None] * len(hashes)
+        outputs = [self.get(content, image_hash, size, kind) for image_hash in hashes]
+        missing = [i for i, out in enumerate(outputs) if out is None]
+        if missing:
+            with inference_mode():
+                computed = fn(data[missing]).float().cpu().numpy()
+            for i, out in zip(missing, computed):
+                outputs[i] = out.astype(dtype)
+                self.put(content, hashes[i], size, outputs[i], kind, save_index=False, image_id=image_ids[i])
+        self._save_index()
+        return torch.from_numpy(np.stack(outputs).astype(np.float32)).to(data.device)
+
+    def stats(self):
+        return {'entries': len(self.index['entries']), 'bytes': self.total_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def predict_dataset(fn, loader, cache, checkpoint_path, kind='logits', device='cpu', number=None):
+    """
+    Outputs of fn (generator forward or get_feature_embedding) for the images of a
+    loader, read from the cache when possible
+    Args:
+        loader: DataLoader over a CocoStuffDataSet or CachedDataSet; with shuffle=False,
+            dataset.ids label the entries of the index
+        number: (int) stop after at least number images, None for the whole dataset
+    Return:
+        N x ... numpy array
+    """
+    dataset = loader.dataset
+    content = cache.register_checkpoint(checkpoint_path)
+    outputs = []
+    total = 0
+    for data, _, _ in loader:
+        image_ids = dataset.ids[total:total + data.size(0)] if hasattr(dataset, 'ids') else None
+        size = tuple(data.shape[2:])
+        outputs.append(cache.cached_forward(fn, content, image_ids, data.to(device), size, kind).cpu().numpy())
+        total += data.size(0)
+        if number is not None and total >= number:
+            break
+    return np.concatenate(outputs)
@@ -0,0 +1,177 @@
+import os, argparse, json, struct, zlib
+
+from utils import label_map_to_rle, rle_to_label_map
+
+MAGIC = b'SEGRLE01'
+FOOTER = struct.Struct('<Q8s') # offset of the index, magic
+
+
+def image_id_from_path(path):
+    """ COCO image id of a file name (000000123456.jpg -> 123456), the file name otherwise """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return int(name) if name.isdigit() else name
+
+
+class PredictionStoreWriter():
+    '''
+    Writes predicted label maps as per class COCO RLEs in a single file:
+        MAGIC | record 0 | record 1 | ... | index | FOOTER
+    Each record is the zlib compressed JSON {class: RLE} of one image, the index maps every
+    image id to the (offset, length) of its record. The file is written under a temporary
+    name and renamed on close, so that a store is either complete or absent.
+    '''
+    def __init__(self, path, meta=None):
+        """
+        Args:
+            path: (str) store file
+            meta: (dict) JSON serializable information kept with the store
+                (e.g. numClasses and catIds of the dataset, checkpoint)
+        """
+        self.path = path
+        self.meta = meta or {}
+        self.index = {}
+        self.file = open(path + '.tmp', 'wb')
+        self.file.write(MAGIC)
+
+    def add(self, image_id, label_map):
+        """ Encodes and appends a H x W uint8 label map """
+        self.add_encoded(image_id, label_map_to_rle(label_map))
+
+    def add_encoded(self, image_id, rles):
+        """ Appends the output of utils.label_map_to_rle (e.g. computed in a worker process) """
+        record = zlib.compress(json.dumps({str(c): rle for c, rle in rles.items()}).encode('utf-8'))
+        self.index[str(image_id)] = (self.file.tell(), len(record))
+        self.file.write(record)
+
+    def close(self):
+        offset = self.file.tell()
+        self.file.write(json.dumps({'meta': self.meta, 'index': self.index}).encode('utf-8'))
+        self.file.write(FOOTER.pack(offset, MAGIC))
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path + '.tmp')
+
+
+class PredictionStore():
+    '''
+    Random access reader of a PredictionStoreWriter file: only the footer and the index are
+    read when opening, each lookup reads a single record.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        assert self.file.read(len(MAGIC)) == MAGIC, "Not a prediction store: {}".format(path)
+        self.file.seek(-FOOTER.size, os.SEEK_END)
+        footer_start = self.file.tell()
+        offset, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        assert magic == MAGIC, "Truncated prediction store: {}".format(path)
+        self.file.seek(offset)
+        footer = json.loads(self.file.read(footer_start - offset).decode('utf-8'))
+        self.meta = footer['meta']
+        self.index = footer['index']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image_id):
+        return str(image_id) in self.index
+
+    def ids(self):
+        return [int(i) if i.isdigit() else i for i in self.index]
+
+    def get_rles(self, image_id):
+        """ Return: dict class index -> COCO RLE (counts as str) """
+        offset, length = self.index[str(image_id)]
+        self.file.seek(offset)
+        record = json.loads(zlib.decompress(self.file.read(length)).decode('utf-8'))
+        return {int(c): rle for c, rle in record.items()}
+
+    def __getitem__(self, image_id):
+        """ Return: H x W uint8 label map """
+        return rle_to_label_map(self.get_rles(image_id))
+
+    def close(self):
+        self.file.close()
+
+
+def coco_cat_ids(annotation_file, supercategories):
+    """ COCO category ids of the classes of a generator trained on supercategories (as CocoStuffDataSet.catIds) """
+    from pycocotools.coco import COCO
+    return COCO(annotation_file).getCatIds(supNms=supercategories)
+
+
+def to_coco_results(store, cat_ids, path=None):
+    '''
+    Converts a store to the COCO results format, one entry per image and predicted class.
+    Classes without a COCO category (the background, last class) are skipped.
+    Args:
+        cat_ids: list of COCO category ids of the classes (dataset.catIds)
+        path: (str) if given, the results are also written there as JSON
+    Return:
+        list of {'image_id', 'category_id', 'segmentation', 'score'}
+    '''
+    results = []
+    for image_id in store.ids():
+        for c, rle in sorted(store.get_rles(image_id).items()):
+            if c >= len(cat_ids):
+                continue
+            results.append({'image_id': image_id, 'category_id': cat_ids[c], 'segmentation': rle, 'score': 1.0})
+    if path is not None:
+        with open(path, 'w') as outfile:
+            json.dump(results, outfile)
+    return results
+
+
+def evaluate_coco(annotation_file, results, cat_ids):
+    '''
+    COCO segmentation evaluation (pycocotools COCOeval) of exported results, restricted to the
+    predicted images and the given categories. Each predicted class of an image counts as a
+    single instance with score 1, so the AP is an approximation for semantic segmentation.
+    Args:
+        results: list returned by to_coco_results, or the path of its JSON
+    Return:
+        the 12 COCOeval summary statistics (AP, AP50, ...)
+    '''
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+    coco = COCO(annotation_file)
+    detections = coco.loadRes(results)
+    evaluator = COCOeval(coco, detections, iouType='segm')
+    evaluator.params.imgIds = sorted(detections.getImgIds())
+    evaluator.params.catIds = list(cat_ids)
+    evaluator.evaluate()
+    evaluator.accumulate()
+    evaluator.summarize()
+    return [float(s) for s in evaluator.stats]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a prediction store to the COCO results format')
+    parser.add_argument('store', type=str, help='store written by infer.py --store')
+    parser.add_argument('--output', '-o', default=None, type=str,
+                        help='COCO results JSON (default: next to the store)')
+    parser.add_argument('--annotations', default=None, type=str,
+                        help='COCO annotation file (e.g. ../cocostuff/annotations/instances_val2017.json) to evaluate against')
+    parser.add_argument('--supercategories', nargs='+', default=['animal'],
+                        help='supercategories the generator was trained on, when the store does not record its catIds')
+    args = parser.parse_args()
+
+    store = PredictionStore(args.store)
+    cat_ids = store.meta.get('catIds')
+    if cat_ids is None:
+        assert args.annotations is not None, "The store does not record its catIds, --annotations is needed"
+        cat_ids = coco_cat_ids(args.annotations, args.supercategories)
+    output = args.output or os.path.splitext(args.store)[0] + '_results.json'
+    results = to_coco_results(store, cat_ids, output)
+    print ("=> Exported {} segments of {} images to '{}'".format(len(results), len(store), output))
+    if args.annotations is not None:
+        evaluate_coco(args.annotations, output, cat_ids)
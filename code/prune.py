@@ -0,0 +1,253 @@
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+import copy, os, argparse, json
+
+from generator import load_generator
+from train import Trainer
+from dataset import CocoStuffDataSet, ResumableRandomSampler
+from utils import evaluate_segmentation, inference_mode, time_fn, count_macs, random_subset
+
+SAVE_DIR = "../checkpoints" # Assuming this is launched from code/ subfolder.
+CONVS = (nn.Conv2d, nn.ConvTranspose2d)
+
+
+def _decoders(model):
+    """ Decoder blocks in forward order (dec5, dec4, ..., dec1) """
+    names = sorted((name for name in model._modules if name.startswith('dec')), reverse=True)
+    return [model._modules[name] for name in names]
+
+
+def _layers(decoder):
+    seq = getattr(decoder, 'decode', decoder)
+    return list(seq._modules.values()) # children() skips the repeated layers
+
+
+class _UnionFind():
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, key):
+        self.parent.setdefault(key, key)
+        while self.parent[key] != key:
+            self.parent[key] = self.parent[self.parent[key]]
+            key = self.parent[key]
+        return key
+
+    def union(self, a, b):
+        self.parent[self.find(a)] = self.find(b)
+
+
+def channel_groups(model):
+    """
+    Follows the tensors through the decoders and groups the channel dimensions that must be
+    pruned together: the outputs of a convolution, the BatchNorm after it, and the input slice
+    of its consumers. The output of a decoder is consumed by the next one after torch.cat with
+    the encoder features, i.e. at an offset in the input channels. A layer reused several times
+    (dec5 of SegNet16/SegNetSmall, dec3 of SegNetSmaller) ties the groups of all its inputs.
+    Return:
+        list of dicts with keys 'producers' (convs), 'norms' (BatchNorm2d),
+        'consumers' (list of (conv, offset)) and 'prunable' (False for the class scores)
+    """
+    groups = _UnionFind()
+    producers, norms, consumers = [], [], []
+    inputs = {} # id(conv) -> (group, offset) of its input channels
+    seen = set()
+    current = None # (group, offset) of the prunable channels of the running tensor
+    channels = None
+    for d, decoder in enumerate(_decoders(model)):
+        layers = _layers(decoder)
+        if d > 0:
+            first = next(m for m in layers if isinstance(m, CONVS))
+            # torch.cat([enc, dec], 1): the decoder channels come after the encoder ones
+            current = (current[0], first.in_channels - channels)
+        for module in layers:
+            if isinstance(module, CONVS):
+                assert module.groups == 1, "Pruning of grouped (depthwise) convolutions is not supported"
+                if current is not None:
+                    if id(module) in inputs:
+                        group, offset = inputs[id(module)]
+                        assert offset == current[1], "Reused layer with inputs at different offsets"
+                        groups.union(group, current[0])
+                    else:
+                        inputs[id(module)] = current
+                        consumers.append((current[0], module, current[1]))
+                if id(module) not in seen:
+                    producers.append((id(module), module))
+                current = (id(module), 0)
+                channels = module.out_channels
+            elif isinstance(module, nn.BatchNorm2d) and id(module) not in seen:
+                norms.append((current[0], module))
+            seen.add(id(module))
+    output_group = groups.find(current[0])
+
+    result = {}
+    def _group(key):
+        root = groups.find(key)
+        return result.setdefault(root, {'producers': [], 'norms': [], 'consumers': [],
+                                        'prunable': root != output_group})
+    for key, conv in producers:
+        _group(key)['producers'].append(conv)
+    for key, bn in norms:
+        _group(key)['norms'].append(bn)
+    for key, conv, offset in consumers:
+        _group(key)['consumers'].append((conv, offset))
+    return list(result.values())
+
+
+def channel_saliency(group):
+    """
+    Importance of each channel of a group: L1 norm of its filters in every producer
+    (normalized by the mean filter norm of the producer) times |gamma| of its BatchNorms
+    """
+    score = 0
+    for conv in group['producers']:
+        weight = conv.weight.data
+        if isinstance(conv, nn.ConvTranspose2d):
+            weight = weight.transpose(0, 1) # C_out x C_in x kH x kW
+        filter_norms = weight.abs().flatten(1).sum(1)
+        score = score + filter_norms / filter_norms.mean().clamp(min=1e-12)
+    for bn in group['norms']:
+        if bn.affine:
+            score = score * bn.weight.data.abs()
+    return score
+
+
+def _select_channels(conv, index, port):
+    transposed = isinstance(conv, nn.ConvTranspose2d)
+    if port == 'out':
+        conv.weight = nn.Parameter(conv.weight.data.index_select(1 if transposed else 0, index).clone())
+        if conv.bias is not None:
+            conv.bias = nn.Parameter(conv.bias.data[index].clone())
+        conv.out_channels = len(index)
+    else:
+        conv.weight = nn.Parameter(conv.weight.data.index_select(0 if transposed else 1, index).clone())
+        conv.in_channels = len(index)
+
+
+def _select_features(bn, index):
+    if bn.affine:
+        bn.weight = nn.Parameter(bn.weight.data[index].clone())
+        bn.bias = nn.Parameter(bn.bias.data[index].clone())
+    bn.running_mean = bn.running_mean[index].clone()
+    bn.running_var = bn.running_var[index].clone()
+    bn.num_features = len(index)
+
+
+def prune_decoders(model, ratio, round_to=8):
+    """
+    Returns a copy of the generator where a fraction of the channels of every decoder group,
+    those of lowest saliency, are physically removed (dense, smaller convolutions)
+    Args:
+        ratio: (float) fraction of the channels removed in each group
+        round_to: (int) the number of kept channels is a multiple of round_to (faster kernels)
+    """
+    model = copy.deepcopy(model)
+    for group in channel_groups(model):
+        if not group['prunable']:
+            continue
+        channels = group['producers'][0].out_channels
+        assert all(conv.out_channels == channels for conv in group['producers'])
+        num_kept = max(round_to, int(round(channels * (1.0 - ratio) / round_to)) * round_to)
+        if num_kept >= channels:
+            continue
+        kept = torch.sort(torch.topk(channel_saliency(group), num_kept)[1])[0]
+        for conv in group['producers']:
+            _select_channels(conv, kept.to(conv.weight.device), 'out')
+        for bn in group['norms']:
+            _select_features(bn, kept.to(bn.running_mean.device))
+        for conv, offset in group['consumers']:
+            index = torch.cat([torch.arange(offset), kept + offset,
+                               torch.arange(offset + channels, conv.in_channels)])
+            _select_channels(conv, index.to(conv.weight.device), 'in')
+    return model
+
+
+def pruning_report(models, eval_loader, num_classes, device, size=128, batch_size=16, repeat=10):
+    """
+    Args:
+        models: (dict) name -> generator
+    Return:
+        dict name -> parameters, GMACs per image, batch latency and mIoU
+    """
+    report = {}
+    example = torch.rand(batch_size, 3, size, size, device=device)
+    for name, model in models.items():
+        model = model.to(device).eval()
+        confusion = evaluate_segmentation(model, eval_loader, num_classes, device)
+        with inference_mode():
+            timing = time_fn(lambda: model(example), repeat=repeat)
+        report[name] = {
+            'params': sum(p.numel() for p in model.parameters()),
+            'gmacs': count_macs(model, size) / 1e9,
+            'latency_ms': timing['mean_ms'],
+            'mIOU': confusion.mean_IoU(),
+            'pixel_acc': confusion.pixel_accuracy(),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Structured channel pruning of the generator decoders')
+    parser.add_argument('checkpoint', type=str,
+                        help='checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('experiment_name', type=str,
+                        help='experiment of the pruned model, in ../checkpoints')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('--ratio', default=0.5, type=float,
+                        help='fraction of the decoder channels removed')
+    parser.add_argument('--round_to', default=8, type=int)
+    parser.add_argument('--epochs', default=1, type=int,
+                        help='fine-tuning epochs after pruning (0 to skip)')
+    parser.add_argument('--gen_lr', default=1e-4, type=float)
+    parser.add_argument('--eval_every', default=500, type=int)
+    parser.add_argument('-s', '--size', default=128, type=int)
+    parser.add_argument('-b', '--batch_size', default=32, type=int)
+    parser.add_argument('--num_eval', default=512, type=int,
+                        help='number of val images used for the report')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    args = parser.parse_args()
+
+    experiment_dir = os.path.join(SAVE_DIR, args.experiment_name)
+    if not os.path.exists(experiment_dir):
+        os.makedirs(experiment_dir)
+    args_path = os.path.join(os.path.dirname(args.checkpoint), 'args.json')
+    args_dict = {}
+    if os.path.exists(args_path):
+        with open(args_path, 'r') as infile:
+            args_dict = json.load(infile)
+    if args.generator_name is not None:
+        args_dict['generator_name'] = args.generator_name
+    args_dict.update({'experiment_name': args.experiment_name, 'pruned_from': os.path.abspath(args.checkpoint),
+                      'prune_ratio': args.ratio, 'gen_lr': args.gen_lr, 'size': args.size})
+    with open(os.path.join(experiment_dir, 'args.json'), 'w') as outfile:
+        json.dump(args_dict, outfile, sort_keys=True, indent=4)
+
+    model = load_generator(args.checkpoint, args.generator_name, device=args.device)
+    pruned = prune_decoders(model, args.ratio, args.round_to)
+
+    val_dataset = CocoStuffDataSet(mode='val', supercategories=['animal'], height=args.size, width=args.size)
+    eval_loader = DataLoader(random_subset(val_dataset, args.num_eval), args.batch_size)
+    models = {'original': model, 'pruned': pruned}
+    if args.epochs > 0:
+        train_dataset = CocoStuffDataSet(mode='train', supercategories=['animal'], height=args.size, width=args.size)
+        train_loader = DataLoader(train_dataset, args.batch_size, sampler=ResumableRandomSampler(train_dataset))
+        val_loader = DataLoader(val_dataset, args.batch_size, shuffle=False)
+        fine_tuned = copy.deepcopy(pruned)
+        trainer = Trainer(fine_tuned, None, train_loader, val_loader, gen_lr=args.gen_lr,
+                          experiment_dir=experiment_dir, device=args.device)
+        trainer.train(num_epochs=args.epochs, eval_every=args.eval_every)
+        if os.path.exists(trainer.best_path):
+            fine_tuned.load_state_dict(torch.load(trainer.best_path, map_location=args.device)['gen_dict'])
+        models['fine_tuned'] = fine_tuned
+    else:
+        torch.save({'gen_dict': pruned.state_dict()}, os.path.join(experiment_dir, 'best.pth.tar'))
+    print ("=> Pruned generator saved in '{}' (load it with generator.load_generator)".format(experiment_dir))
+
+    report = pruning_report(models, eval_loader, val_dataset.numClasses, args.device, args.size, args.batch_size)
+    with open(os.path.join(experiment_dir, 'prune_report.json'), 'w') as outfile:
+        json.dump(report, outfile, sort_keys=True, indent=4)
+    for name, r in report.items():
+        print ("{:>10}: {:6.2f}M params, {:6.2f} GMACs, {:7.1f}ms, mIOU {:.4f}".format(
+            name, r['params'] / 1e6, r['gmacs'], r['latency_ms'], r['mIOU']))
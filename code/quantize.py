@@ -0,0 +1,117 @@
+import torch
+from torch.utils.data import DataLoader
+import copy, io, os, argparse, json
+
+from generator import load_generator
+from dataset import CocoStuffDataSet
+from utils import evaluate_segmentation, inference_mode, time_fn, random_subset
+
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError: # torch < 1.13
+    prepare_fx = None
+
+
+def quantize_static(model, calibration_loader, backend='fbgemm', num_batches=None):
+    """
+    Post-training static int8 quantization (FX graph mode, which handles the torch.cat skip
+    connections and fuses Conv+BatchNorm+ReLU). Activation ranges are observed on the calibration data.
+    Args:
+        model: (nn.Module) fp32 generator
+        calibration_loader: (DataLoader) batches of (image, mask, mask_flat)
+        backend: (str) 'fbgemm' for x86 servers, 'qnnpack' for ARM
+    Return:
+        quantized copy of the model, on CPU
+    """
+    if prepare_fx is None:
+        raise RuntimeError("Static quantization needs torch >= 1.13 (FX graph mode), found torch {}".format(
+            torch.__version__))
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    example = next(iter(calibration_loader))[0]
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (example,))
+    with torch.no_grad():
+        for i, (data, _, _) in enumerate(calibration_loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            prepared(data)
+    return convert_fx(prepared)
+
+
+def save_quantized(model, example, path):
+    """ Saves a TorchScript artifact, loadable with torch.jit.load without generator.py """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    torch.jit.save(traced, path)
+    return traced
+
+
+def serialized_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2.0 ** 20
+
+
+def quantization_report(fp32_model, int8_model, eval_loader, num_classes, example, repeat=10):
+    """
+    mIoU delta (repo metrics, on CPU) and latency speedup of the quantized model
+    """
+    report = {}
+    for name, model in [('fp32', fp32_model.cpu().eval()), ('int8', int8_model)]:
+        confusion = evaluate_segmentation(model, eval_loader, num_classes, 'cpu')
+        with inference_mode():
+            timing = time_fn(lambda: model(example), repeat=repeat)
+        report[name] = {
+            'mIOU': confusion.mean_IoU(),
+            'pixel_acc': confusion.pixel_accuracy(),
+            'per_class_acc': confusion.per_class_accuracy(),
+            'latency_ms': timing['mean_ms'],
+            'size_mb': serialized_size_mb(model),
+        }
+    report['mIOU_delta'] = report['int8']['mIOU'] - report['fp32']['mIOU']
+    report['speedup'] = report['fp32']['latency_ms'] / report['int8']['latency_ms']
+    report['batch_size'] = example.size(0)
+    report['threads'] = torch.get_num_threads()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Int8 quantization of a trained generator for CPU inference')
+    parser.add_argument('checkpoint', type=str,
+                        help='checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('--output', '-o', default=None, type=str,
+                        help='quantized TorchScript artifact (default: <checkpoint dir>/quantized.pt)')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('--backend', default='fbgemm', type=str)
+    parser.add_argument('-s', '--size', default=128, type=int)
+    parser.add_argument('-b', '--batch_size', default=16, type=int)
+    parser.add_argument('--num_calibration', default=256, type=int,
+                        help='number of train images used for calibration')
+    parser.add_argument('--num_eval', default=512, type=int,
+                        help='number of val images used for the report')
+    parser.add_argument('--threads', default=None, type=int)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    output = args.output or os.path.join(os.path.dirname(args.checkpoint), 'quantized.pt')
+    model = load_generator(args.checkpoint, args.generator_name, device='cpu')
+
+    train_dataset = CocoStuffDataSet(mode='train', supercategories=['animal'], height=args.size, width=args.size)
+    val_dataset = CocoStuffDataSet(mode='val', supercategories=['animal'], height=args.size, width=args.size)
+    calibration_loader = DataLoader(random_subset(train_dataset, args.num_calibration), args.batch_size)
+    eval_loader = DataLoader(random_subset(val_dataset, args.num_eval), args.batch_size)
+    example = torch.rand(args.batch_size, 3, args.size, args.size)
+
+    quantized = quantize_static(model, calibration_loader, args.backend)
+    save_quantized(quantized, example, output)
+    print ("=> Saved quantized model '{}'".format(output))
+
+    report = quantization_report(model, quantized, eval_loader, val_dataset.numClasses, example)
+    with open(os.path.splitext(output)[0] + '_report.json', 'w') as outfile:
+        json.dump(report, outfile, sort_keys=True, indent=4)
+    print ("mIOU fp32 {:.4f} int8 {:.4f} (delta {:+.4f}), latency {:.1f}ms -> {:.1f}ms (x{:.2f})".format(
+        report['fp32']['mIOU'], report['int8']['mIOU'], report['mIOU_delta'],
+        report['fp32']['latency_ms'], report['int8']['latency_ms'], report['speedup']))
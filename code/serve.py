@@ -0,0 +1,194 @@
+import torch
+import torchvision.transforms as T
+from PIL import Image
+from collections import Counter
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import io, argparse, json, queue, threading, time
+
+from generator import load_generator
+from fuse import fold_batchnorm
+from infer import BatchSegmenter
+from utils import label_map_to_rle
+
+
+class DynamicBatcher():
+    """
+    Coalesces concurrent requests into batches: a worker thread waits for a first request,
+    then collects more until the batch is full or max_latency_ms has passed since the first one.
+    """
+    def __init__(self, segmenter, max_batch_size=16, max_latency_ms=10):
+        """
+        Args:
+            segmenter: (callable) segmenter(images, original_sizes) -> list of label maps,
+                as infer.BatchSegmenter
+            max_batch_size: (int) largest batch given to the segmenter
+            max_latency_ms: (float) longest time a request waits for others to join its batch
+        """
+        self.segmenter = segmenter
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.requests = queue.Queue()
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+        self.total_latency = 0.0
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, image, original_size):
+        """
+        Args:
+            image: 3 x size x size tensor
+            original_size: (height, width) of the label map to return
+        Return:
+            Future resolved with the H x W uint8 label map
+        """
+        future = Future()
+        self.requests.put((image, original_size, future, time.time()))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            images, original_sizes, futures, arrivals = zip(*batch)
+            try:
+                label_maps = self.segmenter(list(images), list(original_sizes))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            now = time.time()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.num_requests += len(batch)
+                self.total_latency += sum(now - arrival for arrival in arrivals)
+            for future, label_map in zip(futures, label_maps):
+                future.set_result(label_map)
+
+    def stats(self):
+        with self.lock:
+            num_batches = sum(self.batch_sizes.values())
+            return {
+                'queue_depth': self.requests.qsize(),
+                'requests': self.num_requests,
+                'batches': num_batches,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'mean_batch_size': self.num_requests / max(num_batches, 1),
+                'mean_latency_ms': 1000.0 * self.total_latency / max(self.num_requests, 1),
+            }
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    """
+    POST /segment[?format=png|rle] with an encoded image as body:
+        png (default): label map as a PNG, pixel value = class index
+        rle: JSON {'size': [H, W], 'rle': {class: COCO RLE}}
+    GET /stats: queue depth and batch size histogram
+    """
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj):
+        self._send(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self._send_json(200, self.server.batcher.stats())
+        elif path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/segment':
+            self._send_json(404, {'error': 'unknown path'})
+            return
+        output_format = parse_qs(url.query).get('format', ['png'])[0]
+        try:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            img = Image.open(io.BytesIO(body)).convert('RGB')
+        except Exception as e:
+            self._send_json(400, {'error': 'cannot decode image: {}'.format(e)})
+            return
+        original_size = (img.height, img.width)
+        size = self.server.image_size
+        image = T.functional.to_tensor(img.resize((size, size), Image.BILINEAR))
+        label_map = self.server.batcher.submit(image, original_size).result()
+        if output_format == 'rle':
+            self._send_json(200, {'size': list(original_size), 'rle': label_map_to_rle(label_map)})
+        else:
+            output = io.BytesIO()
+            Image.fromarray(label_map, mode='L').save(output, format='PNG')
+            self._send(200, output.getvalue(), 'image/png')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(model, device='cpu', host='127.0.0.1', port=8080, image_size=128,
+                max_batch_size=16, max_latency_ms=10, verbose=False):
+    """
+    Builds the HTTP server around a loaded generator (port=0 picks a free port)
+    Return:
+        server, call server.serve_forever() (server.server_address gives the bound port)
+    """
+    server = _ThreadingHTTPServer((host, port), SegmentationHandler)
+    server.batcher = DynamicBatcher(BatchSegmenter(model, device), max_batch_size, max_latency_ms)
+    server.image_size = image_size
+    server.verbose = verbose
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local segmentation service')
+    parser.add_argument('checkpoint', type=str,
+                        help='checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('-s', '--size', default=128, type=int,
+                        help='size of the generator input (default:128)')
+    parser.add_argument('--max_batch_size', default=16, type=int)
+    parser.add_argument('--max_latency_ms', default=10, type=float,
+                        help='longest time a request waits for a batch to fill')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--fold_bn', type=bool, default=False,
+                        help='fold BatchNorm layers into the convolutions before serving')
+    parser.add_argument('--verbose', type=bool, default=False)
+    args = parser.parse_args()
+
+    model = load_generator(args.checkpoint, args.generator_name, device=args.device)
+    if args.fold_bn:
+        model = fold_batchnorm(model)
+    server = make_server(model, args.device, args.host, args.port, args.size,
+                         args.max_batch_size, args.max_latency_ms, args.verbose)
+    print ("Serving on http://{}:{}".format(*server.server_address))
+    server.serve_forever()
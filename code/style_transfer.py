@@ -1,6 +1,7 @@
-import os, argparse
+import os, argparse, hashlib, time, weakref
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision
 import torchvision.transforms as T
 import PIL
@@ -11,24 +12,27 @@ from torch.utils.data import DataLoader
 from dataset import CocoStuffDataSet
 
 dtype = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor   
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def content_loss(content_weight, content_current, content_original):
+def content_loss(content_weight, content_current, content_original, per_image=False):
     """
     Compute the content loss for style transfer.
     
     Inputs:
     - content_weight: Scalar giving the weighting for the content loss.
-    - content_current: features of the current image; this is a PyTorch Tensor of shape
-      (1, C_l, H_l, W_l).
-    - content_target: features of the content image, Tensor with shape (1, C_l, H_l, W_l).
+    - content_current: features of the current images; this is a PyTorch Tensor of shape
+      (N, C_l, H_l, W_l).
+    - content_target: features of the content images, Tensor with shape (N, C_l, H_l, W_l).
+    - per_image: if True, return the loss of each image instead of their sum
     
     Returns:
-    - scalar content loss
+    - scalar content loss, or Tensor of shape (N,) if per_image
     """
-    _, C_l, H_l, W_l = content_current.size()
-    cc = content_current.view(C_l, H_l*W_l).cuda()
-    ct = content_original.view(C_l, H_l*W_l).cuda()
-    return content_weight * (cc-ct).pow(2).sum()
+    N, C_l, H_l, W_l = content_current.size()
+    cc = content_current.view(N, C_l*H_l*W_l)
+    ct = content_original.view(N, C_l*H_l*W_l)
+    loss = content_weight * (cc-ct).pow(2).sum(1)
+    return loss if per_image else loss.sum()
 
 def gram_matrix(features, feature_mask=None, normalize=True):
     """
@@ -45,10 +49,10 @@ def gram_matrix(features, feature_mask=None, normalize=True):
       (optionally normalized) Gram matrices for the N input images.
     """
     N, C, H, W = features.size()
-    F_0 = F_1 = features.view(N, C, -1).cuda()
+    F_0 = F_1 = features.view(N, C, -1)
 
     if feature_mask is not None:
-        T = feature_mask.view(*feature_mask.shape[:-2], -1).cuda()
+        T = feature_mask.view(*feature_mask.shape[:-2], -1)
 #         print("F shape: ", F_1.shape)
 #         print("T shape: ", T.shape)
         # print("Feature mask shape: ", feature_mask.shape)
@@ -58,13 +62,13 @@ def gram_matrix(features, feature_mask=None, normalize=True):
         G /= (C*H*W)
     return G
 
-def style_loss(feats, style_layers, style_targets, style_weights, feature_masks):
+def style_loss(feats, style_layers, style_targets, style_weights, feature_masks, per_image=False):
     """
     Computes the style loss at a set of layers.
     
     Inputs:
-    - feats: list of the features at every layer of the current image, as produced by
-      the extract_features function.
+    - feats: features of the current image indexed by layer, as produced by a
+      FeatureExtractor (or the list of the extract_features function).
     - style_layers: List of layer indices into feats giving the layers to include in the
       style loss.
     - style_targets: List of the same length as style_layers, where style_targets[i] is
@@ -72,9 +76,10 @@ def style_loss(feats, style_layers, style_targets, style_weights, feature_masks)
       layer style_layers[i].
     - style_weights: List of the same length as style_layers, where style_weights[i]
       is a scalar giving the weight for the style loss at layer style_layers[i].
+    - per_image: if True, return the loss of each image of the batch instead of their sum
       
     Returns:
-    - style_loss: A PyTorch Tensor holding a scalar giving the style loss.
+    - style_loss: A PyTorch Tensor holding a scalar giving the style loss (shape (N,) if per_image).
     """
 
     loss = 0
@@ -84,26 +89,72 @@ def style_loss(feats, style_layers, style_targets, style_weights, feature_masks)
             G = gram_matrix(feats[style_layers[i]], feature_masks[style_layers[i]])
         else:
             G = gram_matrix(feats[style_layers[i]])
-        loss += style_weights[i] * (style_targets[i].cuda() - G).pow(2).sum()
-    return loss
+        loss += style_weights[i] * (style_targets[i] - G).pow(2).view(G.size(0), -1).sum(1)
+    return loss if per_image else loss.sum()
 
-def tv_loss(img, tv_weight):
+def masked_gram_matrices(features, masks, normalize=True):
+    """
+    Compute the Gram matrices of K masked regions of the features with one batched matmul.
+    
+    Inputs:
+    - features: PyTorch Tensor of shape (N, C, H, W)
+    - masks: Tensor of shape (N, K, H, W) or (1, K, H, W), one soft mask per region
+    - normalize: optional, whether to divide the Gram matrices by H * W * C
+    
+    Returns:
+    - gram: Tensor of shape (N, K, C, C), gram[:, k] = gram_matrix(features, masks[:, k])
+    """
+    N, C, H, W = features.size()
+    F_0 = features.view(N, 1, C, H * W)
+    F_1 = F_0 * masks.view(masks.size(0), masks.size(1), 1, H * W)
+    G = torch.matmul(F_0, F_1.transpose(2, 3))
+    if normalize:
+        G = G / (C * H * W)
+    return G
+
+def region_style_loss(feats, style_layers, region_targets, style_weights, region_masks, per_image=False):
+    """
+    Computes the style loss of K styles, each restricted to its region of the image.
+    
+    Inputs:
+    - feats, style_layers, style_weights: as style_loss
+    - region_targets: List of the same length as style_layers, where region_targets[i] is a
+      Tensor of shape (K, C_i, C_i) stacking the Gram matrices of the K styles at style_layers[i]
+    - region_masks: dict layer index -> Tensor of shape (N, K, H_i, W_i) or (1, K, H_i, W_i),
+      as returned by get_region_masks, already on the device. If None, the unmasked Gram
+      matrix is compared to the K targets.
+    - per_image: if True, return the loss of each image of the batch instead of their sum
+    
+    Returns:
+    - style_loss: scalar Tensor (shape (N,) if per_image).
+    """
+    loss = 0
+    for i, layer in enumerate(style_layers):
+        if region_masks is not None:
+            G = masked_gram_matrices(feats[layer], region_masks[layer])
+        else:
+            G = gram_matrix(feats[layer]).unsqueeze(1)
+        loss = loss + style_weights[i] * (region_targets[i] - G).pow(2).view(G.size(0), -1).sum(1)
+    return loss if per_image else loss.sum()
+
+def tv_loss(img, tv_weight, per_image=False):
     """
     Compute total variation loss.
     
     Inputs:
-    - img: PyTorch Variable of shape (1, 3, H, W) holding an input image.
+    - img: PyTorch Variable of shape (N, 3, H, W) holding input images.
     - tv_weight: Scalar giving the weight w_t to use for the TV loss.
+    - per_image: if True, return the loss of each image instead of their sum
     
     Returns:
     - loss: PyTorch Variable holding a scalar giving the total variation loss
-      for img weighted by tv_weight.
+      for img weighted by tv_weight (shape (N,) if per_image).
     """
     N, C, H, W = img.size()
-    down = torch.cat((img[:,:,1:,:], img[:,:,-1,:].view(N, C, 1, W)), dim=2).cuda()
-    right = torch.cat((img[:,:,:,1:], img[:,:,:,-1].view(N, C, H, 1)), dim=3).cuda()
-    img = img.cuda()
-    return tv_weight * ((down - img).pow(2).sum() + (right - img).pow(2).sum())
+    down = torch.cat((img[:,:,1:,:], img[:,:,-1,:].view(N, C, 1, W)), dim=2)
+    right = torch.cat((img[:,:,:,1:], img[:,:,:,-1].view(N, C, H, 1)), dim=3)
+    loss = tv_weight * ((down - img).pow(2).view(N, -1).sum(1) + (right - img).pow(2).view(N, -1).sum(1))
+    return loss if per_image else loss.sum()
 
 # We provide this helper code which takes an image, a model (cnn), and returns a list of
 # feature maps, one per layer.
@@ -123,27 +174,204 @@ def extract_features(x, cnn):
       spatial dimensions (H_i, W_i).
     """
     features = []
-    prev_feat = x.cuda()
+    prev_feat = x.to(device)
     for i, module in enumerate(cnn._modules.values()):
         next_feat = module(prev_feat)
         features.append(next_feat)
         prev_feat = next_feat
     return features
 
+class FeatureExtractor():
+    """
+    Runs a sequential CNN only up to the deepest requested layer and keeps only the requested
+    activations, instead of every intermediate output as extract_features.
+    """
+    def __init__(self, cnn, layers):
+        """
+        Inputs:
+        - cnn: nn.Sequential (e.g. VGG features)
+        - layers: indices of the modules whose outputs are needed
+        """
+        self.layers = set(layers)
+        self.modules = list(cnn._modules.values())[:max(self.layers) + 1]
+
+    def __call__(self, x):
+        """
+        Returns:
+        - dict layer index -> Tensor of shape (N, C_i, H_i, W_i)
+        """
+        features = {}
+        x = x.to(device)
+        for i, module in enumerate(self.modules):
+            x = module(x)
+            if i in self.layers:
+                features[i] = x
+        return features
+
+STYLE_CACHE_DIR = "../cache/style_targets" # Assuming this is launched from code/ subfolder.
+
+_cnn_fingerprints = weakref.WeakKeyDictionary() # a freed model's id can be reused by a new one
+
+def cnn_fingerprint(cnn):
+    """ Hash of the architecture and weights of a CNN, computed once per model object """
+    if cnn not in _cnn_fingerprints:
+        sha1 = hashlib.sha1(str(cnn).encode('utf-8'))
+        for name, tensor in cnn.state_dict().items():
+            sha1.update(name.encode('utf-8'))
+            sha1.update(tensor.detach().cpu().numpy().tobytes())
+        _cnn_fingerprints[cnn] = sha1.hexdigest()
+    return _cnn_fingerprints[cnn]
+
+class StyleTargetCache():
+    """
+    Gram matrix targets of style images, in memory (on the device) and on disk, keyed by the
+    style image content, style_size, the style layers and the CNN, so that a batch job
+    computes the targets of each style once.
+    """
+    def __init__(self, cache_dir=STYLE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.memory = {}
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, cnn, style_img, style_size, style_layers):
+        sha1 = hashlib.sha1(style_img.tobytes())
+        sha1.update('{} {} {} {}'.format(style_img.mode, style_img.size, style_size, tuple(style_layers)).encode('utf-8'))
+        sha1.update(cnn_fingerprint(cnn).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def get(self, key):
+        if key not in self.memory and self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.pt')
+            if os.path.exists(path):
+                self.memory[key] = [g.to(device) for g in torch.load(path, map_location='cpu')]
+        return self.memory.get(key)
+
+    def put(self, key, style_targets):
+        self.memory[key] = style_targets
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.pt')
+            torch.save([g.cpu() for g in style_targets], path + '.tmp')
+            os.replace(path + '.tmp', path)
+
 # Extract features for the style image
-def prep_style(cnn, style_img, style_size, style_layers):
+def prep_style(cnn, style_img, style_size, style_layers, cache=None):
+    """
+    Returns the preprocessed style image and its Gram matrices at the style layers
+    - cache: (StyleTargetCache) reuses the Gram matrices computed for the same style image, size, layers and cnn
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(cnn, style_img, style_size, style_layers)
+        style_targets = cache.get(key)
+        if style_targets is not None:
+            return preprocess(style_img, size=style_size), style_targets
     style_img = preprocess(style_img, size=style_size)
-    feats = extract_features(style_img, cnn)
-    style_targets = []
-    for idx in style_layers:
-        style_targets.append(gram_matrix(feats[idx].clone()))
+    with torch.no_grad():
+        feats = FeatureExtractor(cnn, style_layers)(style_img)
+        style_targets = []
+        for idx in style_layers:
+            style_targets.append(gram_matrix(feats[idx].clone()))
+    if cache is not None:
+        cache.put(key, style_targets)
     return style_img, style_targets
 
-def style_transfer(cnn, content_image, style_image, content_mask, image_size, style_size, content_layer, content_weight,
-                   style_layers, style_weights, tv_weight, max_iters, init_random=False, mask_layer=False, second_style_image=None,
-                   display_masks=False):
+def _optimize_image(img, loss_fn, max_iters, optimizer='adam', lr=None, tol=None, check_every=20, target_loss=None,
+                    opt_state=None):
     """
-    Run style transfer!
+    Optimizes the pixels of a batch of images. The losses are kept on the device and only
+    copied to the host (a device synchronization) every check_every iterations.
+    
+    Inputs:
+    - img: Tensor of shape (N, 3, H, W), optimized in place
+    - loss_fn: function of img returning the Tensor of shape (N,) of the per image losses
+    - max_iters: maximum number of iterations
+    - optimizer: 'adam' (lr 3e-2 by default) or 'lbfgs' (lr 1, strong Wolfe line search,
+      several loss evaluations per iteration)
+    - tol: stop when the mean loss of the last check_every iterations improves by less than tol
+      (relative) on the previous window, for every image. None runs the max_iters iterations.
+    - target_loss: report the first iteration where the loss of every image is below target_loss
+    - opt_state: dict carrying the optimizer state (Adam moments, L-BFGS curvature pairs) across
+      calls on images of the same shape; loaded when present and updated on return
+    
+    Returns:
+    - history: Tensor of shape (iterations, N) of the losses, on the host; history[t] is the
+      loss of the iterate that step t starts from, for both optimizers
+    - stats: dict with the iterations and loss evaluations run, the elapsed time, whether the
+      loss plateaued, and the iteration and time at which target_loss was reached (the time
+      is measured at the synchronization that detected it)
+    """
+    img.requires_grad_()
+    if optimizer == 'adam':
+        opt = torch.optim.Adam([img], lr=lr or 3e-2)
+    elif optimizer == 'lbfgs':
+        opt = torch.optim.LBFGS([img], lr=lr or 1.0, max_iter=1, history_size=20, line_search_fn='strong_wolfe')
+    else:
+        raise ValueError("Unknown optimizer: {}".format(optimizer))
+    if opt_state is not None and opt_state.get('key') == (optimizer, tuple(img.shape)):
+        opt.load_state_dict(opt_state['state'])
+
+    current = {'evaluations': 0}
+    def closure():
+        opt.zero_grad()
+        losses = loss_fn(img)
+        loss = losses.sum()
+        loss.backward()
+        # The first evaluation of a step is at the current iterate; the next ones of L-BFGS
+        # are line search trial points, which may be rejected
+        if current['losses'] is None:
+            current['losses'] = losses.detach()
+        current['evaluations'] += 1
+        return loss
+
+    history = torch.zeros(max_iters, img.size(0), device=img.device)
+    windows = []
+    stats = {'optimizer': optimizer, 'plateaued': False, 'target_iteration': None, 'time_to_target_s': None}
+    previous = None
+    start = time.time()
+    t = synced = 0
+    while t < max_iters:
+        current['losses'] = None
+        opt.step(closure)
+        history[t] = current['losses']
+        t += 1
+        if t % check_every != 0 and t != max_iters:
+            continue
+        window = history[synced:t].cpu()
+        windows.append(window)
+        synced = t
+        elapsed = time.time() - start
+        if target_loss is not None and stats['target_iteration'] is None:
+            below = (window <= target_loss).all(1).nonzero()
+            if len(below) > 0:
+                stats['target_iteration'] = t - len(window) + int(below[0, 0]) + 1
+                stats['time_to_target_s'] = elapsed
+        mean = window.mean(0)
+        if tol is not None and previous is not None and ((previous - mean) / previous.abs().clamp(min=1e-12) < tol).all():
+            stats['plateaued'] = True
+            break
+        previous = mean
+    history = torch.cat(windows)
+    if opt_state is not None:
+        opt_state.update({'key': (optimizer, tuple(img.shape)), 'state': opt.state_dict()})
+    stats.update({'iterations': t, 'evaluations': current['evaluations'], 'time_s': time.time() - start,
+                  'final_loss': history[-1].tolist()})
+    return history, stats
+
+def _resize_mask(mask, size):
+    """ Bilinear resizing of a H x W mask to size (H', W'), a no-op when it already has that size """
+    if tuple(mask.shape[-2:]) == tuple(size):
+        return mask
+    return F.interpolate(mask.reshape(1, 1, *mask.shape[-2:]).float(), size=tuple(size), mode='bilinear',
+                         align_corners=False)[0, 0]
+
+def _style_transfer_image(cnn, content_image, style_image, content_mask, image_size, style_size, content_layer,
+                          content_weight, style_layers, style_weights, tv_weight, max_iters, init_random=False,
+                          mask_layer=False, second_style_image=None, display_masks=False, style_cache=None,
+                          init_img=None, optimizer='adam', lr=None, tol=None, check_every=20, target_loss=None,
+                          extractor=None, region_targets=None, opt_state=None):
+    """
+    Style transfer of one image, on preprocessed tensors
     
     Inputs:
     - cnn: cnn model 
@@ -156,92 +384,247 @@ def style_transfer(cnn, content_image, style_image, content_mask, image_size, st
     - style_layers: list of layers to use for style loss
     - style_weights: list of weights to use for each layer in style_layers
     - tv_weight: weight of total variation regularization term
-    - max_iters: number of iterations to run 
+    - max_iters: maximum number of iterations to run
     - init_random: initialize the starting image to uniform random noise
     - mask_layer: (bool) if True, use masking on gram matrices.
     - second_style_image: second style image to use on the foreground of image
+    - style_cache: (StyleTargetCache) reuses the style targets across calls
+    - init_img: PIL image to start from instead of the content image (e.g. a previous result),
+      or a preprocessed Tensor of shape (1, 3, H, W), resized to the content image
+    - optimizer, lr, tol, check_every, target_loss, opt_state: see _optimize_image
+    - extractor, region_targets: FeatureExtractor and _region_targets already built by the caller
+      (computed here when None)
+    
+    Returns:
+    - img: stylized image, preprocessed Tensor of shape (1, 3, H, W)
+    - history, stats: see _optimize_image
     """
     # Extract features for the content image
-    content_img = preprocess(content_image, size=image_size).cuda()
-    feats = extract_features(content_img, cnn)
-    content_target = feats[content_layer].clone().cuda()
-
-    style_image, style_targets = prep_style(cnn, style_image, style_size, style_layers)
-    if second_style_image is not None:
-        second_style_image, second_style_targets = prep_style(cnn, second_style_image, style_size, style_layers)
-
-    # Initialize output image to content image or noise
-    if init_random:
+    extractor = extractor or FeatureExtractor(cnn, [content_layer] + list(style_layers))
+    content_img = preprocess(content_image, size=image_size).to(device)
+    feats = extractor(content_img)
+    content_target = feats[content_layer].clone().to(device)
+
+    if region_targets is None:
+        region_targets = _region_targets(cnn, style_image, second_style_image, style_size, style_layers, style_cache)
+
+    # Initialize output image to content image, a given image or noise
+    if torch.is_tensor(init_img):
+        img = F.interpolate(init_img.detach().to(device), size=content_img.shape[2:], mode='bilinear', align_corners=False)
+    elif init_img is not None:
+        img = preprocess(init_img, size=image_size).type(dtype)
+    elif init_random:
         img = torch.Tensor(content_img.size()).uniform_(0, 1).type(dtype)
     else:
         img = content_img.clone().type(dtype)
-
-    img = img.cuda()
-    # We do want the gradient computed on our image!
-    img.requires_grad_()
-    
-    # Set up optimization hyperparameters
-    initial_lr = 3e-2
-
-    # Note that we are optimizing the pixel values of the image by passing
-    # in the img Torch tensor, whose requires_grad flag is set to True
-    optimizer = torch.optim.Adam([img], lr=initial_lr)
+    img = img.to(device)
         
-    feature_masks = None
+    region_masks = None
     if mask_layer:
-        feature_masks = get_soft_masks(content_mask, cnn, style_layers, style_size)
+        content_mask = _resize_mask(content_mask, content_img.shape[2:])
+        region_masks = get_region_masks(_region_stack(content_mask, second_style_image is not None), cnn, style_layers)
         if display_masks:
             plt.axis('off')
             plt.imshow(content_image)
             plt.savefig("original_mask.png")
             plt.show()
             plt.close()
-            for i, m in enumerate(feature_masks):
-                if m is None:
-                    continue
-                m = m.detach().numpy().reshape(*(m.shape)[-2:])
+            for i, m in region_masks.items():
+                m = m[0, 0].detach().cpu().numpy()
                 plt.axis('off')
                 plt.imshow(m, cmap='gray')
                 plt.savefig("feature_mask_{}.png".format(i))
                 plt.show()
                 plt.close()
-        second_feature_masks = get_soft_masks(1.0 - content_mask, cnn, style_layers, style_size)
-    loss_list = []
-    for t in range(max_iters):
-#         if t < 390:
-#             img.data.clamp_(-1.5, 1.5)
-        optimizer.zero_grad()
-
-        feats = extract_features(img, cnn)
-        
-        # Compute loss
-        c_loss = content_loss(content_weight, feats[content_layer], content_target)
-        s_loss = style_loss(feats, style_layers, style_targets, style_weights, feature_masks)
-        if second_style_image is not None:
-#             second_style_weights = [x / 10 for x in style_weights]
-            second_style_weights = style_weights
-            second_s_loss = style_loss(feats, style_layers, second_style_targets, second_style_weights, second_feature_masks)
-            s_loss += second_s_loss
-        t_loss = tv_loss(img, tv_weight)
-        loss = c_loss + s_loss + t_loss
-        loss_list.append(loss.item())
-        loss.backward()
 
-        # Perform gradient descents on our image values
-#         if t == decay_lr_at:
-#             optimizer = torch.optim.Adam([img], lr=decayed_lr)
-        optimizer.step()
+    def loss_fn(img):
+        feats = extractor(img)
+        c_loss = content_loss(content_weight, feats[content_layer], content_target, per_image=True)
+        s_loss = region_style_loss(feats, style_layers, region_targets, style_weights, region_masks, per_image=True)
+        t_loss = tv_loss(img, tv_weight, per_image=True)
+        return c_loss + s_loss + t_loss
 
-#         if t % 100 == 0:
-#             print("Iteration {},\tLoss: {},\tContent: {},\tStyle: {},\tTV: {}".format(t, loss, c_loss, s_loss, t_loss))
+    history, stats = _optimize_image(img, loss_fn, max_iters, optimizer, lr, tol, check_every, target_loss, opt_state)
+    return img.detach(), history, stats
 
-    img = np.asarray(deprocess(img.data.cpu()), dtype=np.uint8)
-#     content_img = np.asarray(deprocess(content_img.cpu()), dtype=np.uint8)
-#     content_mask = np.expand_dims(content_mask, axis=-1)
+def style_transfer(cnn, content_image, style_image, content_mask, image_size, style_size, content_layer, content_weight,
+                   style_layers, style_weights, tv_weight, max_iters, init_random=False, mask_layer=False, second_style_image=None,
+                   display_masks=False, style_cache=None, init_img=None, optimizer='adam', lr=None, tol=None,
+                   check_every=20, target_loss=None, return_stats=False):
+    """
+    Run style transfer!
+    
+    Inputs: see _style_transfer_image
+    - return_stats: also return the statistics of the optimization
+    
+    Returns:
+    - final_img: stylized PIL image
+    - loss: final loss
+    - loss_list: loss at each iteration
+    - stats (if return_stats): dict of iterations, loss evaluations, time, plateau and time to target_loss
+    """
+    img, history, stats = _style_transfer_image(cnn, content_image, style_image, content_mask, image_size, style_size,
+                                                content_layer, content_weight, style_layers, style_weights, tv_weight,
+                                                max_iters, init_random, mask_layer, second_style_image, display_masks,
+                                                style_cache, init_img, optimizer, lr, tol, check_every, target_loss)
+    loss = history[-1, 0]
+    loss_list = history[:, 0].tolist()
+
+    img = np.asarray(deprocess(img.cpu()), dtype=np.uint8)
     final_img = img.astype(np.uint8)
     final_img = PIL.Image.fromarray(final_img)
+    if return_stats:
+        return final_img, loss, loss_list, stats
     return final_img, loss, loss_list
 
+def style_transfer_pyramid(cnn, content_image, style_image, content_mask, image_size, style_size, content_layer,
+                           content_weight, style_layers, style_weights, tv_weight, max_iters, scales=(0.25, 0.5, 1.0),
+                           iters_per_scale=None, init_random=False, mask_layer=False, second_style_image=None,
+                           style_cache=None, optimizer='adam', lr=None, tol=None, check_every=20, return_stats=False):
+    """
+    Coarse-to-fine style transfer: the image is optimized at the smallest scale first, and each
+    result is upsampled to initialize the next scale. The content image, the style image size
+    and the content mask (hence its feature masks) are resized to every scale, so that most
+    iterations run at the cheap resolutions.
+    
+    Inputs: as style_transfer, except
+    - scales: increasing fractions of image_size (and style_size), ending with 1.0
+    - iters_per_scale: maximum number of iterations at each scale. By default, max_iters at
+      the coarsest scale, halved at each finer scale.
+    
+    Returns:
+    - final_img, loss, loss_list (concatenated over the scales) as style_transfer
+    - stats (if return_stats): totals, with the stats of each scale in 'scales'
+    """
+    if iters_per_scale is None:
+        iters_per_scale = [max(1, max_iters // 2 ** i) for i in range(len(scales))]
+    img = None
+    histories, scale_stats = [], []
+    for i, (scale, iters) in enumerate(zip(scales, iters_per_scale)):
+        img, history, stats = _style_transfer_image(cnn, content_image, style_image, content_mask, int(round(image_size * scale)),
+                                                    int(round(style_size * scale)), content_layer, content_weight, style_layers,
+                                                    style_weights, tv_weight, iters, init_random and i == 0, mask_layer,
+                                                    second_style_image, False, style_cache, img, optimizer, lr, tol, check_every)
+        histories.append(history[:, 0])
+        stats['scale'] = scale
+        scale_stats.append(stats)
+    history = torch.cat(histories)
+
+    final_img = PIL.Image.fromarray(np.asarray(deprocess(img.cpu()), dtype=np.uint8))
+    if return_stats:
+        stats = {'iterations': sum(st['iterations'] for st in scale_stats),
+                 'evaluations': sum(st['evaluations'] for st in scale_stats),
+                 'time_s': sum(st['time_s'] for st in scale_stats),
+                 'final_loss': scale_stats[-1]['final_loss'], 'scales': scale_stats}
+        return final_img, history[-1], history.tolist(), stats
+    return final_img, history[-1], history.tolist()
+
+def style_transfer_sequence(cnn, frames, style_image, image_size, style_size, content_layer, content_weight, style_layers,
+                            style_weights, tv_weight, max_iters, frame_iters=None, mask_layer=False, second_style_image=None,
+                            style_cache=None, optimizer='adam', lr=None, tol=None, check_every=20):
+    """
+    Style transfer of a sequence of frames (e.g. extracted from a video): the first frame starts
+    from its content image, every next frame from the stylized previous frame, which is already
+    close to its result, so it runs far fewer iterations. The feature extractor and the style
+    targets are built once, and the optimizer state carries over from frame to frame.
+    
+    Inputs: as style_transfer, except
+    - frames: iterable of (content PIL image, content mask or None) pairs, in order
+    - max_iters: maximum number of iterations of the first frame
+    - frame_iters: maximum number of iterations of the next frames (default: max_iters // 4)
+    
+    Yields:
+    - (stylized PIL image, stats) for each frame, stats as _optimize_image with the index of the
+      frame in 'frame' and its latency (setup, optimization and conversion) in 'latency_s'
+    """
+    style_cache = style_cache or StyleTargetCache(cache_dir=None)
+    frame_iters = frame_iters or max(1, max_iters // 4)
+    extractor = FeatureExtractor(cnn, [content_layer] + list(style_layers))
+    region_targets = _region_targets(cnn, style_image, second_style_image, style_size, style_layers, style_cache)
+    opt_state = {}
+    img = None
+    for t, (content_image, content_mask) in enumerate(frames):
+        start = time.time()
+        img, history, stats = _style_transfer_image(cnn, content_image, style_image, content_mask, image_size, style_size,
+                                                    content_layer, content_weight, style_layers, style_weights, tv_weight,
+                                                    max_iters if img is None else frame_iters, False, mask_layer,
+                                                    second_style_image, False, style_cache, img, optimizer, lr, tol, check_every,
+                                                    extractor=extractor, region_targets=region_targets,
+                                                    opt_state=opt_state)
+        final_img = PIL.Image.fromarray(np.asarray(deprocess(img.cpu()), dtype=np.uint8))
+        stats.update({'frame': t, 'latency_s': time.time() - start})
+        yield final_img, stats
+
+def _region_targets(cnn, style_image, second_style_image, style_size, style_layers, style_cache=None):
+    """ Gram targets of the background (and foreground) styles, stacked per layer: list of (K, C_i, C_i) """
+    _, style_targets = prep_style(cnn, style_image, style_size, style_layers, style_cache)
+    if second_style_image is None:
+        return style_targets
+    _, second_style_targets = prep_style(cnn, second_style_image, style_size, style_layers, style_cache)
+    return [torch.cat([g, second_g]) for g, second_g in zip(style_targets, second_style_targets)]
+
+def _region_stack(mask, two_regions):
+    """ (K, H, W) region masks of an H x W mask: the mask and, for a second style, its complement """
+    mask = torch.as_tensor(mask, dtype=torch.float32)
+    return torch.stack([mask, 1.0 - mask]) if two_regions else mask[None]
+
+def style_transfer_batch(cnn, content_images, style_image, content_masks, image_size, style_size, content_layer,
+                         content_weight, style_layers, style_weights, tv_weight, max_iters, init_random=False,
+                         mask_layer=False, second_style_image=None, style_cache=None, init_imgs=None, optimizer='adam',
+                         lr=None, tol=None, check_every=20, target_loss=None, return_stats=False):
+    """
+    Run style transfer on N content images at once, against the same style targets.
+    The loss of each image only depends on its own pixels (the VGG features have no batch
+    statistics) and Adam is element-wise, so optimizing the sum of the per image losses is
+    equivalent to N independent style_transfer runs (L-BFGS couples the images through its
+    line search). With tol, the optimization stops once every image has plateaued.
+    
+    Inputs: as style_transfer, except
+    - content_images: list of N PIL images of the same size
+    - content_masks: list of N masks (H x W Tensors, resized to the preprocessed images) if mask_layer, else None
+    - init_imgs: list of N PIL images to start from instead of the content images
+    
+    Returns:
+    - list of N stylized PIL images
+    - final loss of each image, Tensor of shape (N,)
+    - loss_list: list of per image loss arrays, one per iteration
+    - stats (if return_stats): see _optimize_image
+    """
+    extractor = FeatureExtractor(cnn, [content_layer] + list(style_layers))
+    content_img = torch.cat([preprocess(img, size=image_size) for img in content_images]).to(device)
+    feats = extractor(content_img)
+    content_target = feats[content_layer].clone()
+
+    region_targets = _region_targets(cnn, style_image, second_style_image, style_size, style_layers, style_cache)
+
+    if init_imgs is not None:
+        img = torch.cat([preprocess(init, size=image_size) for init in init_imgs]).to(device)
+    elif init_random:
+        img = torch.Tensor(content_img.size()).uniform_(0, 1).to(device)
+    else:
+        img = content_img.clone()
+
+    region_masks = None
+    if mask_layer:
+        content_masks = [_resize_mask(torch.as_tensor(m), content_img.shape[2:]) for m in content_masks]
+        region_masks = get_region_masks(torch.stack([_region_stack(m, second_style_image is not None) for m in content_masks]),
+                                        cnn, style_layers)
+
+    def loss_fn(img):
+        feats = extractor(img)
+        losses = content_loss(content_weight, feats[content_layer], content_target, per_image=True)
+        losses = losses + region_style_loss(feats, style_layers, region_targets, style_weights, region_masks, per_image=True)
+        return losses + tv_loss(img, tv_weight, per_image=True)
+
+    history, stats = _optimize_image(img, loss_fn, max_iters, optimizer, lr, tol, check_every, target_loss)
+    loss_list = list(history.numpy())
+
+    final_imgs = [PIL.Image.fromarray(np.asarray(deprocess(img.data[i:i + 1].cpu()), dtype=np.uint8))
+                  for i in range(img.size(0))]
+    if return_stats:
+        return final_imgs, history[-1], loss_list, stats
+    return final_imgs, history[-1], loss_list
+
 # The setup functions
 # SQUEEZENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
 # SQUEEZENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
@@ -289,22 +672,39 @@ def corresponding_filter(layer):
     else:
         return None
 
+def mask_filter_network(cnn):
+    """
+    Network with the spatial operations of cnn, to follow a mask through it: average pooling
+    with the geometry of each convolution, the max pooling layers, identity otherwise
+    """
+    return nn.Sequential(*[corresponding_filter(module) or nn.Sequential() for module in cnn._modules.values()])
+
 def get_soft_masks(mask, cnn, layer_indices, style_size):
-    #first reshape the mask to be (style_size, style_size) in shape
+    """
+    Soft masks at the resolution of the features of the given layers
+    Returns:
+    - dict layer index -> Tensor of shape (1, 1, H_i, W_i), on the device
+    """
     x = torch.Tensor(mask.reshape((1, 1, *mask.size())))
-#     x = nn.functional.upsample(x, size=(style_size, style_size))
-    
-    soft_masks = []
-    for i, module in enumerate(cnn._modules.values()):
-        next_module = corresponding_filter(module)
-        if next_module:
-            x = next_module(x)
-            x.requires_grad = False
-        if i in layer_indices:
-            soft_masks.append(x)
-        else:
-            soft_masks.append(None)
-    return soft_masks
+    with torch.no_grad():
+        return FeatureExtractor(mask_filter_network(cnn), layer_indices)(x)
+
+def get_region_masks(masks, cnn, layer_indices):
+    """
+    Soft masks of K regions at the resolution of the features of the given layers, computed in
+    a single pass of the mask filter network
+    Inputs:
+    - masks: Tensor of shape (K, H, W) or (N, K, H, W)
+    Returns:
+    - dict layer index -> Tensor of shape (N, K, H_i, W_i) (N = 1 for a (K, H, W) input), on the device
+    """
+    masks = torch.as_tensor(masks, dtype=torch.float32)
+    if masks.dim() == 3:
+        masks = masks[None]
+    N, K, H, W = masks.size()
+    with torch.no_grad():
+        feature_masks = FeatureExtractor(mask_filter_network(cnn), layer_indices)(masks.reshape(N * K, 1, H, W))
+    return {i: m.reshape(N, K, *m.shape[-2:]) for i, m in feature_masks.items()}
 
 def display_style_transfer(img, savename):
     plt.figure()
@@ -327,12 +727,17 @@ if __name__ == "__main__":
                         help='desired size of input images')
     parser.add_argument('-i', '--content_index', default=417, type=int,
                         help='index of context image in coco dataset')
+    parser.add_argument('--max_iters', default=200, type=int,
+                        help='maximum number of iterations')
+    parser.add_argument('--optimizer', default='adam', type=str, help='adam / lbfgs')
+    parser.add_argument('--tol', default=0, type=float,
+                        help='relative loss improvement below which the optimization stops (0 to run max_iters)')
     # suggested indices: 417, 77, 1011, 913, 55
     args = parser.parse_args()
 
     HEIGHT = WIDTH = args.im_size
     val_dataset = CocoStuffDataSet(mode='val', supercategories=['animal'], height=HEIGHT, width=WIDTH, do_normalize=False)
-    content_image, background_mask = get_image(val_dataset, args.content_index)
+    content_image, background_mask = get_image_from_dataset(val_dataset, args.content_index)
     foreground_mask = 1.0 - background_mask
 
     cnn = torchvision.models.vgg16(pretrained=True).features
@@ -360,6 +765,7 @@ if __name__ == "__main__":
         'style_image' : style_background_image,
         'content_mask': background_mask,
         'image_size' : HEIGHT,
+        'style_size' : HEIGHT,
         'content_layer' : 12,
         'content_weight' : 1e-3,
         'style_layers' : style_layers,
@@ -368,9 +774,14 @@ if __name__ == "__main__":
         'tv_weight' : 0,
         'init_random' : False,
         'mask_layer' : True,
-        'second_style_image' : style_foreground_image 
+        'second_style_image' : style_foreground_image,
+        'max_iters' : args.max_iters,
+        'optimizer' : args.optimizer,
+        'tol' : args.tol or None,
+        'return_stats' : True,
     }
 
-    final_img = style_transfer(**transfer_params)
+    final_img, final_loss, loss_list, stats = style_transfer(**transfer_params)
+    print ("{} iterations in {:.1f}s, final loss {:.4g}".format(stats['iterations'], stats['time_s'], float(final_loss)))
     display_style_transfer(final_img, 'test.png')
     
\ No newline at end of file
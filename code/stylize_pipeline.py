@@ -0,0 +1,257 @@
+import torch
+import torchvision
+import torchvision.transforms as T
+import numpy as np
+import PIL.Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os, argparse, json, time
+
+from generator import load_generator, num_classes_from_state_dict
+from infer import BatchSegmenter, list_images
+from prediction_cache import PredictionCache
+from prediction_store import image_id_from_path
+from style_transfer import style_transfer_batch, style_transfer_sequence, StyleTargetCache, device
+
+STYLE_DIR = "../styles/"
+TRANSFER_PARAMS = {
+    'content_layer': 12,
+    'content_weight': 1e-3,
+    'style_layers': (0, 5, 10, 17, 24),
+    'style_weights': [1.0] * 5,
+    'tv_weight': 0,
+}
+
+
+def load_content(path, seg_size, im_size):
+    """
+    Decodes an image (run in a thread pool). Style transfer runs on square images, the
+    original size is returned to resize the stylized image back when it is saved.
+    Return:
+        (path, 3 x seg_size x seg_size tensor in [0, 1] for the generator, im_size x im_size PIL content image,
+         (width, height) of the original image)
+    """
+    img = PIL.Image.open(path).convert('RGB')
+    seg_image = T.functional.to_tensor(img.resize((seg_size, seg_size), PIL.Image.BILINEAR))
+    return path, seg_image, img.resize((im_size, im_size), PIL.Image.BILINEAR), img.size
+
+
+def save_image(img, path, size=None):
+    """ Saves a stylized image, resized to size = (width, height) if given """
+    if size is not None and img.size != tuple(size):
+        img = img.resize(tuple(size), PIL.Image.BICUBIC)
+    img.save(path)
+    return path
+
+
+def stylize_directory(segmenter, background_class, cnn, paths, output_dir, style_image, second_style_image=None,
+                      seg_size=128, im_size=256, style_size=256, batch_size=4, max_iters=200, optimizer='adam', tol=None,
+                      style_cache=None, decode_workers=4, write_workers=2, prefetch_batches=2, transfer_params=TRANSFER_PARAMS):
+    """
+    Segments images with the generator and stylizes them with masked style transfer: the background
+    class gets style_image, the rest second_style_image (the content is kept without it).
+    The stages overlap: JPEG decode in a thread pool and segmentation of the next batches in a
+    background thread, batched style transfer in the calling thread, writes in a thread pool.
+    Outputs keep the input file names and sizes.
+    Args:
+        segmenter: infer.BatchSegmenter (with a PredictionCache, masks of known images are not recomputed)
+        background_class: (int) index of the background class (the last one)
+        cnn: VGG features used by style_transfer
+        style_cache: style_transfer.StyleTargetCache, the style targets are computed once
+    Return:
+        dict of timings and throughput
+    """
+    start = time.time()
+    stylize_time = 0.0
+    iterations = []
+    decode_pool = ThreadPoolExecutor(decode_workers)
+    segment_pool = ThreadPoolExecutor(1)
+    write_pool = ThreadPoolExecutor(write_workers)
+    style_cache = style_cache or StyleTargetCache()
+
+    def segment(batch_paths):
+        loaded = list(decode_pool.map(lambda path: load_content(path, seg_size, im_size), batch_paths))
+        _, seg_images, contents, sizes = zip(*loaded)
+        label_maps = segmenter(list(seg_images), [(im_size, im_size)] * len(batch_paths),
+                               [image_id_from_path(path) for path in batch_paths])
+        masks = [torch.from_numpy((label_map == background_class).astype(np.float32)) for label_map in label_maps]
+        return batch_paths, list(contents), masks, sizes
+
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    segmenting = deque(segment_pool.submit(segment, batch) for batch in batches[:prefetch_batches])
+    next_batch = len(segmenting)
+    writing = deque()
+    num_done = 0
+    while segmenting:
+        batch_paths, contents, masks, sizes = segmenting.popleft().result()
+        if next_batch < len(batches):
+            segmenting.append(segment_pool.submit(segment, batches[next_batch]))
+            next_batch += 1
+        stylize_start = time.time()
+        stylized, _, _, stats = style_transfer_batch(cnn, contents, style_image, masks, im_size, style_size,
+                                                     max_iters=max_iters, mask_layer=True,
+                                                     second_style_image=second_style_image, style_cache=style_cache,
+                                                     optimizer=optimizer, tol=tol, return_stats=True, **transfer_params)
+        stylize_time += time.time() - stylize_start
+        iterations.append(stats['iterations'])
+        for path, img, size in zip(batch_paths, stylized, sizes):
+            writing.append(write_pool.submit(save_image, img, os.path.join(output_dir, os.path.basename(path)), size))
+        # Bound the number of images waiting to be written
+        while len(writing) > prefetch_batches * batch_size:
+            writing.popleft().result()
+            num_done += 1
+    for future in writing:
+        future.result()
+        num_done += 1
+    decode_pool.shutdown()
+    segment_pool.shutdown()
+    write_pool.shutdown()
+    total_time = time.time() - start
+    return {
+        'images': num_done,
+        'seconds': total_time,
+        'stylize_seconds': stylize_time,
+        'mean_iterations': float(np.mean(iterations)) if iterations else 0.0,
+        'images_per_sec': num_done / max(total_time, 1e-12),
+    }
+
+
+def stylize_sequence(segmenter, background_class, cnn, paths, output_dir, style_image, second_style_image=None,
+                     seg_size=128, im_size=256, style_size=256, max_iters=200, frame_iters=None, optimizer='adam',
+                     tol=None, style_cache=None, decode_workers=2, write_workers=2, prefetch_frames=4,
+                     transfer_params=TRANSFER_PARAMS):
+    """
+    Segments and stylizes the frames of a sequence (paths in temporal order) with
+    style_transfer.style_transfer_sequence: each frame is initialized with the stylized previous
+    one. Frames are decoded ahead in a thread pool and written in another.
+    Return:
+        dict of timings, with the latency of every frame (segmentation and style transfer)
+    """
+    start = time.time()
+    decode_pool = ThreadPoolExecutor(decode_workers)
+    write_pool = ThreadPoolExecutor(write_workers)
+    decoding = deque(decode_pool.submit(load_content, path, seg_size, im_size) for path in paths[:prefetch_frames])
+    paths_iter = iter(paths[prefetch_frames:])
+    segment_times = []
+    sizes = []
+
+    def frames():
+        while decoding:
+            path, seg_image, content, size = decoding.popleft().result()
+            sizes.append(size)
+            next_path = next(paths_iter, None)
+            if next_path is not None:
+                decoding.append(decode_pool.submit(load_content, next_path, seg_size, im_size))
+            segment_start = time.time()
+            label_map = segmenter([seg_image], [(im_size, im_size)], [image_id_from_path(path)])[0]
+            segment_times.append(time.time() - segment_start)
+            yield content, torch.from_numpy((label_map == background_class).astype(np.float32))
+
+    sequence = style_transfer_sequence(cnn, frames(), style_image, im_size, style_size, max_iters=max_iters,
+                                       frame_iters=frame_iters, mask_layer=True, second_style_image=second_style_image,
+                                       style_cache=style_cache, optimizer=optimizer, tol=tol, **transfer_params)
+    writing = []
+    frame_stats = []
+    for path, (img, stats) in zip(paths, sequence):
+        writing.append(write_pool.submit(save_image, img, os.path.join(output_dir, os.path.basename(path)),
+                                         sizes[stats['frame']]))
+        frame_stats.append({'frame': path, 'iterations': stats['iterations'],
+                            'latency_ms': 1000.0 * (segment_times[stats['frame']] + stats['latency_s'])})
+        print ("Frame {}: {} iterations, {:.0f}ms".format(stats['frame'], stats['iterations'], frame_stats[-1]['latency_ms']))
+    for future in writing:
+        future.result()
+    decode_pool.shutdown()
+    write_pool.shutdown()
+    latencies = [f['latency_ms'] for f in frame_stats]
+    total_time = time.time() - start
+    return {
+        'frames': len(frame_stats),
+        'seconds': total_time,
+        'first_frame_ms': latencies[0] if latencies else 0.0,
+        'mean_frame_ms': float(np.mean(latencies[1:])) if len(latencies) > 1 else 0.0,
+        'p95_frame_ms': float(np.percentile(latencies[1:], 95)) if len(latencies) > 1 else 0.0,
+        'frames_per_sec': len(frame_stats) / max(total_time, 1e-12),
+        'per_frame': frame_stats,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Segment a directory of images and stylize the background and the foreground')
+    parser.add_argument('checkpoint', type=str,
+                        help='generator checkpoint saved by the Trainer (e.g. ../checkpoints/exp/best.pth.tar)')
+    parser.add_argument('input_dir', type=str, help='directory of JPEG/PNG images')
+    parser.add_argument('output_dir', type=str, help='directory of the stylized images')
+    parser.add_argument('-b', '--background_style', default='starry_night.jpg', type=str,
+                        help='filename for the background style, in ../styles')
+    parser.add_argument('-f', '--foreground_style', default=None, type=str,
+                        help='filename for the foreground style (default: keep the foreground content)')
+    parser.add_argument('--generator_name', default=None, type=str,
+                        help='generator architecture (default: from args.json next to the checkpoint)')
+    parser.add_argument('--seg_size', default=128, type=int,
+                        help='size of the generator input (default:128)')
+    parser.add_argument('-s', '--im_size', default=256, type=int,
+                        help='size of the style transfer (images are stylized as im_size x im_size squares and '
+                             'saved resized back to their original size)')
+    parser.add_argument('--style_size', default=None, type=int,
+                        help='size of the style images (default: im_size)')
+    parser.add_argument('--batch_size', default=4, type=int,
+                        help='images stylized together')
+    parser.add_argument('--max_iters', default=200, type=int)
+    parser.add_argument('--optimizer', default='adam', type=str, help='adam / lbfgs')
+    parser.add_argument('--tol', default=1e-3, type=float,
+                        help='relative loss improvement below which a batch stops early (0 to run max_iters)')
+    parser.add_argument('--sequence', type=bool, default=False,
+                        help='input_dir holds the frames of a sequence (in file name order): each frame starts from the previous result '
+                             '(the prediction cache is not used)')
+    parser.add_argument('--frame_iters', default=None, type=int,
+                        help='maximum iterations of the frames after the first one (default: max_iters / 4)')
+    parser.add_argument('--decode_workers', default=4, type=int)
+    parser.add_argument('--write_workers', default=2, type=int)
+    parser.add_argument('--no_cache', dest='cache', action='store_false',
+                        help='do not reuse the logits of images already segmented with the same checkpoint')
+    parser.add_argument('--cache_size_mb', default=2048, type=float)
+    parser.add_argument('--no_skip_existing', dest='skip_existing', action='store_false',
+                        help='stylize again the images already in output_dir (by default they are skipped, '
+                             'to resume an interrupted run)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(os.path.join(args.output_dir, 'args.json'), 'w') as outfile:
+        json.dump(vars(args), outfile, sort_keys=True, indent=4)
+
+    model = load_generator(args.checkpoint, args.generator_name, device=device)
+    background_class = num_classes_from_state_dict(model.state_dict()) - 1
+    # The frames of a sequence are new images: caching their logits would only write them to disk
+    cache = PredictionCache(max_size_mb=args.cache_size_mb) if args.cache and not args.sequence else None
+    segmenter = BatchSegmenter(model, device, cache=cache, checkpoint_path=args.checkpoint)
+
+    cnn = torchvision.models.vgg16(pretrained=True).features.to(device).eval()
+    for param in cnn.parameters():
+        param.requires_grad = False
+    style_image = PIL.Image.open(os.path.join(STYLE_DIR, args.background_style)).convert('RGB')
+    second_style_image = None
+    if args.foreground_style:
+        second_style_image = PIL.Image.open(os.path.join(STYLE_DIR, args.foreground_style)).convert('RGB')
+
+    paths = list_images(args.input_dir)
+    if args.sequence:
+        print ("Stylizing a sequence of {} frames".format(len(paths)))
+        stats = stylize_sequence(segmenter, background_class, cnn, paths, args.output_dir, style_image, second_style_image,
+                                 seg_size=args.seg_size, im_size=args.im_size, style_size=args.style_size or args.im_size,
+                                 max_iters=args.max_iters, frame_iters=args.frame_iters, optimizer=args.optimizer,
+                                 tol=args.tol or None, style_cache=StyleTargetCache())
+        with open(os.path.join(args.output_dir, 'latency.json'), 'w') as outfile:
+            json.dump(stats, outfile, indent=4)
+        print ("Stylized {} frames in {:.1f}s: first frame {:.0f}ms, next frames {:.0f}ms on average ({:.0f}ms p95)".format(
+            stats['frames'], stats['seconds'], stats['first_frame_ms'], stats['mean_frame_ms'], stats['p95_frame_ms']))
+    else:
+        if args.skip_existing:
+            paths = [p for p in paths if not os.path.exists(os.path.join(args.output_dir, os.path.basename(p)))]
+        print ("Stylizing {} images".format(len(paths)))
+        stats = stylize_directory(segmenter, background_class, cnn, paths, args.output_dir, style_image, second_style_image,
+                                  seg_size=args.seg_size, im_size=args.im_size, style_size=args.style_size or args.im_size,
+                                  batch_size=args.batch_size, max_iters=args.max_iters, optimizer=args.optimizer,
+                                  tol=args.tol or None, decode_workers=args.decode_workers, write_workers=args.write_workers)
+        print ("Stylized {} images in {:.1f}s ({:.1f}s style transfer, {:.0f} iterations per batch): {:.2f} images/sec".format(
+            stats['images'], stats['seconds'], stats['stylize_seconds'], stats['mean_iterations'], stats['images_per_sec']))
@@ -0,0 +1,257 @@
+import torch
+from torch.utils.data import DataLoader
+import numpy as np
+import multiprocessing as mp
+import os, argparse, datetime, itertools, json, random, time
+
+from train import Trainer
+from generator import get_generator
+from discriminator import GAN
+from dataset import CocoStuffDataSet, CachedDataSet, ResumableRandomSampler, cache_dataset
+
+SAVE_DIR = "../checkpoints" # Assuming this is launched from code/ subfolder.
+CACHE_DIR = "../cache"
+
+# Hyperparameters that can be swept, with the defaults of main.py
+DEFAULTS = {
+    'gen_lr': 1e-4,
+    'disc_lr': 1e-4,
+    'gan_reg': 5e-4,
+    'noise_scale': 1e-2,
+    'generator_name': 'SegNet16',
+    'use_bn': True,
+    'train_gan': False,
+    'weight_clip': 0.01,
+    'grad_clip': 0.1,
+    'batch_size': 32,
+    'seed': 0,
+}
+
+
+def expand_spec(spec, num_samples=None, seed=0):
+    """
+    Turns a sweep specification into a list of trial configurations
+    Args:
+        spec: (dict) hyperparameter name -> list of values, or -> {'min': a, 'max': b, 'log': bool}
+            for a continuous range (random search only)
+        num_samples: (int) if None, the full grid over the lists is returned,
+            otherwise num_samples random configurations
+    Return:
+        list of dicts
+    """
+    rng = random.Random(seed)
+    if num_samples is None:
+        for name, values in spec.items():
+            assert isinstance(values, list), "Grid search needs a list of values for '{}'".format(name)
+        names = sorted(spec)
+        return [dict(zip(names, values)) for values in itertools.product(*[spec[n] for n in names])]
+    trials = []
+    for _ in range(num_samples):
+        params = {}
+        for name, values in sorted(spec.items()):
+            if isinstance(values, list):
+                params[name] = rng.choice(values)
+            elif values.get('log', False):
+                params[name] = float(np.exp(rng.uniform(np.log(values['min']), np.log(values['max']))))
+            else:
+                params[name] = rng.uniform(values['min'], values['max'])
+        trials.append(params)
+    return trials
+
+
+class MedianStopping():
+    """
+    Stops a trial whose val mIoU at one of the first few evaluations is below the median
+    of the other trials at the same evaluation. State is shared between trial processes.
+    """
+    def __init__(self, manager, eval_every, num_early_evals=3, min_trials=3):
+        self.history = manager.dict() # eval index -> list of mIoU
+        self.lock = manager.Lock()
+        self.eval_every = eval_every
+        self.num_early_evals = num_early_evals
+        self.min_trials = min_trials
+
+    def __call__(self, total_iters, val_mIOU):
+        rung = total_iters // self.eval_every
+        if rung == 0 or rung > self.num_early_evals:
+            return False # iteration 0 is evaluated before any training
+        with self.lock:
+            others = list(self.history.get(rung, []))
+            self.history[rung] = others + [val_mIOU]
+        return len(others) >= self.min_trials and val_mIOU < np.median(others)
+
+
+_worker = {}
+
+def _init_worker(device_queue, num_threads):
+    """
+    Binds the pool process to one device slot. CUDA_VISIBLE_DEVICES is set before
+    CUDA is initialized in this process so that each trial only sees its own GPU.
+    """
+    device = device_queue.get()
+    if device.startswith('cuda'):
+        index = device.split(':')[1] if ':' in device else '0'
+        os.environ['CUDA_VISIBLE_DEVICES'] = index
+        device = 'cuda'
+    torch.set_num_threads(num_threads)
+    _worker['device'] = device
+
+
+def run_trial(trial_id, params, config):
+    """
+    Trains one configuration on the shared dataset cache
+    Return:
+        dict with the trial parameters and its results
+    """
+    device = _worker.get('device', 'cuda' if torch.cuda.is_available() else 'cpu')
+    hparams = dict(DEFAULTS, **params)
+    experiment_dir = os.path.join(config['sweep_dir'], 'trial_{:03d}'.format(trial_id))
+    if not os.path.exists(experiment_dir):
+        os.makedirs(experiment_dir)
+    with open(os.path.join(experiment_dir, 'args.json'), 'w') as outfile:
+        json.dump(dict(hparams, size=config['size']), outfile, sort_keys=True, indent=4)
+    torch.manual_seed(hparams['seed'])
+
+    train_dataset = CachedDataSet(config['train_cache'])
+    val_dataset = CachedDataSet(config['val_cache'])
+    train_loader = DataLoader(train_dataset, hparams['batch_size'],
+                              sampler=ResumableRandomSampler(train_dataset, seed=hparams['seed']))
+    val_loader = DataLoader(val_dataset, hparams['batch_size'], shuffle=False)
+    num_classes = train_dataset.numClasses
+    size = config['size']
+
+    generator = get_generator(hparams['generator_name'], num_classes, hparams['use_bn'])
+    discriminator = None
+    if hparams['train_gan']:
+        discriminator = GAN(num_classes, (num_classes, size, size), (3, size, size))
+    trainer = Trainer(generator, discriminator, train_loader, val_loader,
+                      gan_reg=hparams['gan_reg'], weight_clip=hparams['weight_clip'], grad_clip=hparams['grad_clip'],
+                      noise_scale=hparams['noise_scale'], disc_lr=hparams['disc_lr'], gen_lr=hparams['gen_lr'],
+                      train_gan=hparams['train_gan'], experiment_dir=experiment_dir, device=device)
+
+    stopped = []
+    def eval_callback(total_iters, val_mIOU):
+        if config['early_stopping'](total_iters, val_mIOU):
+            stopped.append(total_iters)
+            return True
+        return False
+
+    start = time.time()
+    trainer.train(num_epochs=config['epochs'], print_every=config['print_every'],
+                  eval_every=config['eval_every'], eval_callback=eval_callback)
+    result = dict(params)
+    result.update({
+        'trial': trial_id,
+        'device': device,
+        'best_mIOU': trainer.best_mIOU,
+        'stopped_at': stopped[0] if stopped else None,
+        'minutes': (time.time() - start) / 60.0,
+    })
+    with open(os.path.join(experiment_dir, 'result.json'), 'w') as outfile:
+        json.dump(result, outfile, sort_keys=True, indent=4)
+    return result
+
+
+def _run_trial(args):
+    trial_id, params, config = args
+    try:
+        return run_trial(trial_id, params, config)
+    except Exception as e:
+        print ("Trial {} failed: {}".format(trial_id, e))
+        return dict(params, trial=trial_id, best_mIOU=None, error=str(e))
+
+
+def write_table(results, path):
+    """
+    Writes all trial results, best first, to a tab-separated file and prints it
+    """
+    results = sorted(results, key=lambda r: -1.0 if r.get('best_mIOU') is None else r['best_mIOU'], reverse=True)
+    columns = ['trial'] + sorted(set(k for r in results for k in r) - {'trial'})
+    lines = ['\t'.join(columns)]
+    for r in results:
+        lines.append('\t'.join(str(r.get(c, '')) for c in columns))
+    with open(path, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+    print ('\n'.join(lines))
+
+
+def get_dataset_caches(size, cache_dir):
+    """
+    Builds (once) the train and val caches for the animal super-category at the given size
+    """
+    caches = []
+    for mode in ['train', 'val']:
+        path = os.path.join(cache_dir, 'animal_{}_{}'.format(mode, size))
+        if not CachedDataSet.exists(path):
+            dataset = CocoStuffDataSet(mode=mode, supercategories=['animal'], height=size, width=size, do_normalize=False)
+            cache_dataset(dataset, path)
+        caches.append(path)
+    return caches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep')
+    parser.add_argument('spec', type=str,
+                        help='JSON file: hyperparameter -> list of values, or -> {"min", "max", "log"} for random search')
+    parser.add_argument('--num_samples', default=None, type=int,
+                        help='number of random configurations (default: full grid)')
+    parser.add_argument('--sweep_name', '-n', type=str, default=None,
+                        help='name of the sweep directory in the checkpoints folder')
+    parser.add_argument('--devices', nargs='+', default=None,
+                        help='devices to run trials on, e.g. cuda:0 cuda:1 cpu (default: all GPUs, or cpu)')
+    parser.add_argument('--trials_per_device', default=1, type=int,
+                        help='number of concurrent trials on each device')
+    parser.add_argument('--epochs', default=5, type=int)
+    parser.add_argument('-s', '--size', default=128, type=int)
+    parser.add_argument('--print_every', '-p', default=100, type=int)
+    parser.add_argument('--eval_every', '-e', default=300, type=int)
+    parser.add_argument('--early_evals', default=3, type=int,
+                        help='number of first evaluations at which poor trials are stopped')
+    parser.add_argument('--min_trials', default=3, type=int,
+                        help='number of other trials needed at an evaluation before stopping one')
+    parser.add_argument('--cache_dir', default=CACHE_DIR, type=str,
+                        help='directory of the shared preprocessed dataset')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    with open(args.spec, 'r') as infile:
+        spec = json.load(infile)
+    trials = expand_spec(spec, args.num_samples, args.seed)
+
+    sweep_name = args.sweep_name or 'sweep_' + datetime.datetime.now().strftime("%m_%d_%H%M")
+    sweep_dir = os.path.join(SAVE_DIR, sweep_name)
+    if not os.path.exists(sweep_dir):
+        os.makedirs(sweep_dir)
+    with open(os.path.join(sweep_dir, 'trials.json'), 'w') as outfile:
+        json.dump(trials, outfile, sort_keys=True, indent=4)
+
+    # The dataset is parsed and preprocessed once; every trial memory-maps the same files
+    train_cache, val_cache = get_dataset_caches(args.size, args.cache_dir)
+
+    devices = args.devices
+    if devices is None:
+        devices = ['cuda:{}'.format(i) for i in range(torch.cuda.device_count())] or ['cpu']
+    slots = [d for d in devices for _ in range(args.trials_per_device)]
+    num_threads = max(1, mp.cpu_count() // len(slots))
+    print ("Running {} trials on {} slots ({} threads each)".format(len(trials), len(slots), num_threads))
+
+    ctx = mp.get_context('spawn')
+    manager = ctx.Manager()
+    device_queue = manager.Queue()
+    for slot in slots:
+        device_queue.put(slot)
+    config = {
+        'sweep_dir': sweep_dir,
+        'train_cache': train_cache,
+        'val_cache': val_cache,
+        'size': args.size,
+        'epochs': args.epochs,
+        'print_every': args.print_every,
+        'eval_every': args.eval_every,
+        'early_stopping': MedianStopping(manager, args.eval_every, args.early_evals, args.min_trials),
+    }
+    pool = ctx.Pool(len(slots), initializer=_init_worker, initargs=(device_queue, num_threads))
+    results = pool.map(_run_trial, [(i, params, config) for i, params in enumerate(trials)], chunksize=1)
+    pool.close()
+    pool.join()
+    write_table(results, os.path.join(sweep_dir, 'results.tsv'))
@@ -0,0 +1,106 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+from utils import inference_mode
+
+ALIGN = 32 # The generators downsample 5 times: tiles and strides are multiples of 32
+
+
+def _ramp(length, overlap):
+    """
+    1D blending weights: linear ramp over the overlap at each end of a tile, 1 in the middle.
+    Strictly positive so that the image border (covered by a single tile) keeps its logits.
+    """
+    x = torch.arange(length, dtype=torch.float32) + 0.5
+    ramp = torch.min(x / overlap, (length - x) / overlap) if overlap > 0 else torch.ones(length)
+    return ramp.clamp(min=1e-3, max=1.0)
+
+
+def _tile_starts(length, tile, stride):
+    """ Start offsets covering [0, length) once the input is padded to the returned length """
+    num_tiles = 1 + max(0, int(np.ceil(float(length - tile) / stride)))
+    return [i * stride for i in range(num_tiles)], tile + (num_tiles - 1) * stride
+
+
+def estimate_tile_bytes(model, tile_size, in_channels=3, device='cpu'):
+    """
+    Upper bound of the activation memory of one tile: sum of the outputs of every leaf module
+    during a probe forward (the skip connections keep most of them alive until the end).
+    """
+    total = [in_channels * tile_size * tile_size * 4]
+    def hook(module, input, output):
+        if isinstance(output, torch.Tensor):
+            total[0] += output.numel() * output.element_size()
+    handles = [m.register_forward_hook(hook) for m in model.modules() if len(list(m.children())) == 0]
+    try:
+        with inference_mode():
+            model(torch.zeros(1, in_channels, tile_size, tile_size, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total[0]
+
+
+class TiledPredictor():
+    """
+    Full resolution inference with any get_generator model: the image is cut into overlapping
+    tiles on a 32 pixel grid, tiles are batched through the network within a memory budget and
+    the logits are blended with linear ramps in the overlaps.
+    """
+    def __init__(self, model, tile_size=256, overlap=64, memory_budget_mb=512, device=None):
+        """
+        Args:
+            model: (nn.Module) generator returning B x C x H x W logits
+            tile_size: (int) side of the square tiles, multiple of 32
+            overlap: (int) overlap between neighbouring tiles, multiple of 32 and < tile_size
+            memory_budget_mb: (float) memory allowed for the activations of in-flight tiles
+            device: device of the model (default: device of its parameters)
+        """
+        assert tile_size % ALIGN == 0 and overlap % ALIGN == 0, "Tiles must be aligned on {} pixels".format(ALIGN)
+        assert 0 <= overlap < tile_size
+        self.model = model.eval()
+        if device is None:
+            device = next(model.parameters()).device
+        self.device = torch.device(device)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.stride = tile_size - overlap
+        ramp = _ramp(tile_size, overlap)
+        self.window = (ramp.view(-1, 1) * ramp.view(1, -1)).to(self.device) # T x T
+        self.tile_bytes = estimate_tile_bytes(model, tile_size, device=self.device)
+        self.tiles_per_batch = max(1, int(memory_budget_mb * 2 ** 20 // self.tile_bytes))
+
+    def predict(self, image):
+        """
+        Args:
+            image: (torch.Tensor) 3 x H x W image, preprocessed as for the generator
+        Return:
+            (torch.Tensor) C x H x W blended logits, on the model device
+        """
+        _, H, W = image.size()
+        T = self.tile_size
+        row_starts, H_pad = _tile_starts(H, T, self.stride)
+        col_starts, W_pad = _tile_starts(W, T, self.stride)
+        image = image.to(self.device).unsqueeze(0)
+        if H_pad > H or W_pad > W:
+            image = F.pad(image, (0, W_pad - W, 0, H_pad - H), mode='replicate')
+        positions = [(r, c) for r in row_starts for c in col_starts]
+
+        logits = None
+        weights = torch.zeros(H_pad, W_pad, device=self.device)
+        with inference_mode():
+            for i in range(0, len(positions), self.tiles_per_batch):
+                batch_positions = positions[i:i + self.tiles_per_batch]
+                tiles = torch.cat([image[:, :, r:r + T, c:c + T] for r, c in batch_positions], 0)
+                out = self.model(tiles) # B x C x T x T
+                if logits is None:
+                    logits = torch.zeros(out.size(1), H_pad, W_pad, device=self.device)
+                for (r, c), tile_logits in zip(batch_positions, out):
+                    logits[:, r:r + T, c:c + T] += tile_logits * self.window
+                    weights[r:r + T, c:c + T] += self.window
+        return (logits / weights)[:, :H, :W]
+
+    def predict_labels(self, image):
+        """ Returns the H x W map of predicted classes """
+        return torch.argmax(self.predict(image), 0)
@@ -6,13 +6,20 @@ import numpy as np
 import os
 import shutil
 from utils import *
+from distill import distillation_loss
 from tensorboardX import SummaryWriter
 
+# Evaluation metric the saved best_mIOU was computed with: 'hard_labels' counts the argmax labels
+# (gt_visual) in a ConfusionMatrix. Checkpoints without it used the calc_* metrics on the resized
+# dataset masks, whose values are not comparable.
+EVAL_METRIC = 'hard_labels'
+
 
 class Trainer():
     def __init__(self, generator, discriminator, train_loader, val_loader, \
             gan_reg=1.0, weight_clip=1e-2, grad_clip=1e-1, noise_scale=1e-2, disc_lr=1e-5, gen_lr=1e-2, 
-            train_gan=False, experiment_dir='./', resume=False, load_iter=None):
+            train_gan=False, experiment_dir='./', resume=False, load_iter=None, device='cuda',
+            teacher=None, distill_weight=0.5, distill_temperature=2.0):
         """
         Training class for a specified model
         Args:
@@ -22,14 +29,19 @@ class Trainer():
             gan_reg: Hyperparameter for the GAN loss (\lambda in the paper)
             experiment_dir: path to directory that saves everything
             resume: load from last saved checkpoint ?
+            device: (str or torch.device) device to train on
+            teacher: (model) frozen generator whose soft predictions also supervise the generator.
+                Not needed if the train loader yields cached teacher logits (distill.TeacherLogitsDataSet)
+            distill_weight: weight of the distillation loss added to the segmentation loss
+            distill_temperature: softmax temperature of the distillation loss
         """
-       
-        self._gen = generator.cuda()
+        self.device = torch.device(device)
+        self._gen = generator.to(self.device)
         self.train_gan = train_gan and discriminator is not None
         beta1 = 0.5
         if self.train_gan:
             print ("Training GAN")
-            self._disc = discriminator.cuda()
+            self._disc = discriminator.to(self.device)
             self._discoptimizer = optim.Adam(self._disc.parameters(), lr=disc_lr, betas=(beta1, 0.999)) # Discriminator optimizer (needs to be separate)
             self._BCEcriterion = nn.BCEWithLogitsLoss()
         else:
@@ -39,6 +51,14 @@ class Trainer():
         self._train_loader = train_loader
         self._val_loader = val_loader
 
+        self._teacher = None
+        if teacher is not None:
+            self._teacher = teacher.to(self.device).eval()
+            for param in self._teacher.parameters():
+                param.requires_grad = False
+        self.distill_weight = distill_weight
+        self.distill_temperature = distill_temperature
+
         self._MCEcriterion = nn.CrossEntropyLoss() # self._train_loader.dataset.weights.cuda()) # Criterion for segmentation loss
 
         self._genoptimizer = optim.Adam(self._gen.parameters(), lr=gen_lr, betas=(beta1, 0.999)) # Generator optimizer
@@ -52,10 +72,20 @@ class Trainer():
         self.noise_scale = noise_scale
         self.experiment_dir = experiment_dir
         self.best_path = os.path.join(experiment_dir, 'best.pth.tar')
+        self.checkpoint_path = None # checkpoint the weights were loaded from
         if resume:
             self.load_model(load_iter)
 
-    def _train_batch(self, mini_batch_data, mini_batch_labels, mini_batch_labels_flat):
+    def _distillation_loss(self, data, gen_out, teacher_logits):
+        """ Distillation loss of the generator output, None when not distilling """
+        if teacher_logits is None:
+            if self._teacher is None:
+                return None
+            with torch.no_grad():
+                teacher_logits = self._teacher(data)
+        return distillation_loss(gen_out, teacher_logits.to(self.device).float(), self.distill_temperature)
+
+    def _train_batch(self, mini_batch_data, mini_batch_labels, mini_batch_labels_flat, teacher_logits=None):
         """
         Performs one gradient step on a minibatch of data
         Args:
@@ -65,34 +95,42 @@ class Trainer():
                 a batch of (H, W) binary masks for each of C_out classes
             mini_batch_labels_flat: (torch.Tensor) shape (N, H, W)
                 a batch of (H, W) binary masks for each of C_out classes
+            teacher_logits: (torch.Tensor) shape (N, C_out, H, W) cached teacher output, or None
         Return:
             d_loss: (float) discriminator loss
             g_loss: (float) generator loss
             segmentation_loss: (float) segmentation loss
+            distill_loss: (float) distillation loss, None when not distilling
         """
-        data = mini_batch_data.cuda() # Input image (B, 3, H, W)
-        labels = mini_batch_labels.cuda().type(dtype=torch.float32) # Ground truth mask (B, C, H, W)
-        labels_flat = mini_batch_labels_flat.cuda() # Ground truth mask flattened (B, H, W)
+        data = mini_batch_data.to(self.device) # Input image (B, 3, H, W)
+        labels = mini_batch_labels.to(self.device).type(dtype=torch.float32) # Ground truth mask (B, C, H, W)
+        labels_flat = mini_batch_labels_flat.to(self.device) # Ground truth mask flattened (B, H, W)
         self._gen.train()
         gen_out = self._gen(data) # Segmentation output from generator (B, C, H , W)              
+        distill_loss = self._distillation_loss(data, gen_out, teacher_logits)
 
         if not self.train_gan:
             self._genoptimizer.zero_grad()
             segmentation_loss = self._MCEcriterion(gen_out, labels_flat)
-            segmentation_loss.backward()
+            gen_loss = segmentation_loss
+            if distill_loss is not None:
+                gen_loss = gen_loss + self.distill_weight * distill_loss
+            gen_loss.backward()
             g_grad_norm = torch.nn.utils.clip_grad_norm_(self._gen.parameters(), self.grad_clip)
             self._genoptimizer.step()
-            return segmentation_loss, g_grad_norm
+            return segmentation_loss, g_grad_norm, distill_loss
         else:
             # First backprop through gen_loss = mce(gen(data), label)) + reg * bce(disc(g(data), data), 1)
             self._disc.train()
             self._genoptimizer.zero_grad()
             converted_mask = nn.functional.sigmoid(gen_out.detach())
-            _, smooth_true_labels = smooth_labels(data.size()[0])
+            _, smooth_true_labels = smooth_labels(data.size()[0], self.device)
             false_scores = self._disc(data, converted_mask)
             segmentation_loss = self._MCEcriterion(gen_out, labels_flat)
             g_loss = self._BCEcriterion(false_scores, smooth_true_labels)
             gen_loss = segmentation_loss + self.gan_reg * g_loss
+            if distill_loss is not None:
+                gen_loss = gen_loss + self.distill_weight * distill_loss
             gen_loss.backward()
             g_grad_norm = torch.nn.utils.clip_grad_norm_(self._gen.parameters(), self.grad_clip)
             self._genoptimizer.step()
@@ -103,22 +141,26 @@ class Trainer():
             jittered_labels = labels + self.noise_scale * torch.randn_like(labels)
             true_scores = self._disc(data, jittered_labels) # (B,)
             # true_scores = self._disc(data, labels) # (B,)
-            smooth_false_labels, smooth_true_labels = smooth_labels(data.size()[0])
+            smooth_false_labels, smooth_true_labels = smooth_labels(data.size()[0], self.device)
             self._discoptimizer.zero_grad()      
             d_loss = self._BCEcriterion(false_scores, smooth_false_labels) + self._BCEcriterion(true_scores, smooth_true_labels)
             d_loss.backward()
             d_grad_norm = torch.nn.utils.clip_grad_norm_(self._disc.parameters(), self.grad_clip)
             self._discoptimizer.step()
-            return segmentation_loss, g_loss, d_loss, g_grad_norm, d_grad_norm
+            return segmentation_loss, g_loss, d_loss, g_grad_norm, d_grad_norm, distill_loss
     
 
-    def train(self, num_epochs, print_every=100, eval_every=500):
+    def train(self, num_epochs, print_every=100, eval_every=500, snapshot_every=0, eval_callback=None):
         """
         Trains the model for a specified number of epochs
         Args:
             num_epochs: (int) number of epochs to train
             print_every: (int) number of minibatches to process before
                 printing loss. default=100
+            snapshot_every: (int) number of minibatches between cheap snapshots
+                (last.pth.tar, no evaluation) used to resume after a preemption. 0 disables.
+            eval_callback: (callable) called as eval_callback(total_iters, val_mIOU)
+                after each evaluation; training stops early if it returns True.
         """
         writer = SummaryWriter(self.experiment_dir)
 
@@ -133,20 +175,27 @@ class Trainer():
         if total_iters is None:
             total_iters = iter + epoch_len * self.start_epoch
             print ("Total_iters starts at {}".format(total_iters))
+        sampler = self._train_loader.sampler
         for epoch in range(self.start_epoch, num_epochs):
             print ("Starting epoch {}".format(epoch))
-            for mini_batch_data, mini_batch_labels, mini_batch_labels_flat in self._train_loader:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+            for batch in self._train_loader:
+                mini_batch_data, mini_batch_labels, mini_batch_labels_flat = batch[:3]
+                teacher_logits = batch[3] if len(batch) > 3 else None # distill.TeacherLogitsDataSet
                 if self.train_gan:
-                    segmentation_loss, g_loss, d_loss, g_grad_norm, d_grad_norm = self._train_batch(
-                            mini_batch_data, mini_batch_labels, mini_batch_labels_flat)
+                    segmentation_loss, g_loss, d_loss, g_grad_norm, d_grad_norm, distill_loss = self._train_batch(
+                            mini_batch_data, mini_batch_labels, mini_batch_labels_flat, teacher_logits)
                     writer.add_scalar('Train/DiscriminatorLoss', d_loss, total_iters)
                     writer.add_scalar('Train/DiscriminatorTotalGradNorm', d_grad_norm, total_iters)
                     writer.add_scalar('Train/GeneratorLoss', g_loss, total_iters)
                     writer.add_scalar('Train/GanLoss', d_loss + g_loss, total_iters)
                     writer.add_scalar('Train/TotalLoss', self.gan_reg * (d_loss + g_loss) + segmentation_loss, total_iters)
                 else:
-                    segmentation_loss, g_grad_norm = self._train_batch(
-                            mini_batch_data, mini_batch_labels, mini_batch_labels_flat)
+                    segmentation_loss, g_grad_norm, distill_loss = self._train_batch(
+                            mini_batch_data, mini_batch_labels, mini_batch_labels_flat, teacher_logits)
+                if distill_loss is not None:
+                    writer.add_scalar('Train/DistillationLoss', distill_loss, total_iters)
                 writer.add_scalar('Train/GeneratorTotalGradNorm', g_grad_norm, total_iters)
                 writer.add_scalar('Train/SegmentationLoss', segmentation_loss, total_iters)
                 
@@ -158,12 +207,13 @@ class Trainer():
                         print ('Loss at iteration {}/{}: {}'.format(iter, epoch_len - 1, segmentation_loss))
 
                 if eval_every > 0 and total_iters % eval_every == 0:
+                    reports = ['metrics', 'discriminator'] if self.train_gan else ['metrics']
+                    results = self.evaluate_reports(self._val_loader, reports, ignore_background=True)
                     if self.train_gan:
-                        true_positive, true_negative = self.true_positive_and_negative_rates(self._val_loader)
-                        writer.add_scalar('Val/DiscriminatorTruePositive', true_positive, total_iters)
-                        writer.add_scalar('Val/DiscriminatorTrueNegative', true_negative, total_iters)
+                        writer.add_scalar('Val/DiscriminatorTruePositive', results['true_positive'], total_iters)
+                        writer.add_scalar('Val/DiscriminatorTrueNegative', results['true_negative'], total_iters)
 
-                    val_pixel_acc, val_mIOU, per_class_accuracy = self.evaluate(self._val_loader, total_iters, ignore_background=True)
+                    val_pixel_acc, val_mIOU, per_class_accuracy = results['pixel_acc'], results['mIOU'], results['per_class_acc']
                     if self.best_mIOU < val_mIOU:
                         self.best_mIOU = val_mIOU
                     self.save_model(iter, total_iters, epoch, self.best_mIOU, self.best_mIOU == val_mIOU)
@@ -171,7 +221,12 @@ class Trainer():
                     writer.add_scalar('Val/MeanIOU', val_mIOU, total_iters)
                     writer.add_scalar('Val/PerClassAcc', per_class_accuracy, total_iters)
                     print("Validation Mean IOU at iteration {}/{}: {}".format(iter, epoch_len - 1, val_mIOU))
-                    
+                    if eval_callback is not None and eval_callback(total_iters, val_mIOU):
+                        print ("Stopping early at iteration {}".format(total_iters))
+                        return
+                elif snapshot_every > 0 and total_iters % snapshot_every == 0:
+                    self.save_model(iter, total_iters, epoch, self.best_mIOU, False)
+
                 iter += 1
                 total_iters += 1
             iter = 0
@@ -184,14 +239,20 @@ class Trainer():
             'total_iters': total_iters + 1,
             'gen_dict': self._gen.state_dict(),
             'best_mIOU': mIOU,
+            'eval_metric': EVAL_METRIC,
             'gen_opt' : self._genoptimizer.state_dict()
         }
         if self._disc is not None:
             save_dict['disc_dict'] = self._disc.state_dict()
             save_dict['disc_opt'] = self._discoptimizer.state_dict()
             save_dict['gan_reg'] = self.gan_reg
+        sampler = self._train_loader.sampler
+        if hasattr(sampler, 'state_dict'):
+            save_dict['sampler'] = sampler.state_dict(epoch, (iter + 1) * self._train_loader.batch_size)
         save_path = os.path.join(self.experiment_dir, 'last.pth.tar')
-        torch.save(save_dict, save_path)
+        # Write then rename so that a preemption during the save never leaves a truncated checkpoint
+        torch.save(save_dict, save_path + '.tmp')
+        os.replace(save_path + '.tmp', save_path)
         print ("=> Saved checkpoint '{}'".format(save_path))
         if is_best:
             shutil.copyfile(save_path, self.best_path)
@@ -200,15 +261,22 @@ class Trainer():
     def load_model(self, load_iters):
         if load_iters is None:
             save_path = os.path.join(self.experiment_dir, 'best.pth.tar')
+        elif load_iters == 'last':
+            save_path = os.path.join(self.experiment_dir, 'last.pth.tar')
         else:
             save_path = os.path.join(self.experiment_dir, str(load_iters) + '.pth.tar')
         if os.path.isfile(save_path):
             print("=> loading checkpoint '{}'".format(save_path))
-            checkpoint = torch.load(save_path)
+            checkpoint = torch.load(save_path, map_location=self.device)
+            self.checkpoint_path = save_path
             self.start_iter = checkpoint['iter']
             self.start_total_iters = checkpoint.get('total_iters', None)
             self.start_epoch = checkpoint['epoch']
             self.best_mIOU = checkpoint['best_mIOU']
+            if checkpoint.get('eval_metric') != EVAL_METRIC:
+                # The best mIOU of an older metric would decide which checkpoint is the best one
+                print ("=> best mIOU {} was computed with an older metric, it is reset".format(self.best_mIOU))
+                self.best_mIOU = 0
             self._gen.load_state_dict(checkpoint['gen_dict'])
             self._genoptimizer.load_state_dict(checkpoint['gen_opt'])
             if self._disc is not None:
@@ -216,6 +284,9 @@ class Trainer():
                   self._disc.load_state_dict(checkpoint['disc_dict'])
                   self._discoptimizer.load_state_dict(checkpoint['disc_opt'])
                   self.gan_reg = checkpoint['gan_reg']
+            sampler = self._train_loader.sampler
+            if 'sampler' in checkpoint and hasattr(sampler, 'load_state_dict'):
+                sampler.load_state_dict(checkpoint['sampler'])
 
             print("=> loaded checkpoint '{}' (iter {})".format(save_path, checkpoint['iter']))
         else:
@@ -225,85 +296,84 @@ class Trainer():
     '''
     Evaluation methods
     '''
-    def evaluate(self, loader, curr_iter, ignore_background=True, num_batches=None):
-        num_iters = 0
+    def evaluate_reports(self, loader, reports=('metrics',), ignore_background=True, num_batches=None):
+        '''
+        Computes every requested report from a single generator pass over the loader
+        Args:
+            reports: subset of
+                'metrics': pixel accuracy, mean IoU and per class pixel accuracy
+                'confusion': C x C confusion matrix (rows are ground truth classes)
+                'second': C x C matrix of the runner-up predicted class
+                'discriminator': true positive and true negative rates of the discriminator
+        Return:
+            dict with keys 'pixel_acc', 'mIOU', 'per_class_acc', 'confusion', 'second',
+            'true_positive', 'true_negative' depending on the reports
+        '''
         num_classes = loader.dataset.numClasses
-        metrics = [calc_pixel_accuracy, calc_mean_IoU, per_class_pixel_acc]
-        states = [None] * len(metrics)
+        confusion = ConfusionMatrix(num_classes, self.device)
+        second = ConfusionMatrix(num_classes, self.device)
+        use_disc = 'discriminator' in reports
+        if use_disc:
+            assert self._disc is not None, "Discriminator report needs a discriminator"
+            self._disc.eval()
+        true_positive = torch.zeros(1, device=self.device)
+        true_negative = torch.zeros(1, device=self.device)
+        total = 0
+        num_iters = 0
         self._gen.eval()
-        for data, labels, gt_visual in loader:
-            data = data.cuda()
-            labels = labels.float().cuda()
-            preds = convert_to_mask(self._gen(data)).cuda() # B x C x H x W
-            if ignore_background:
-                labels = labels.narrow(1, 0, num_classes-1)
-                preds = preds.narrow(1, 0, num_classes-1)
-            for i, metric in enumerate(metrics):
-                states[i] = metric(labels, preds, states[i])
-            num_iters += 1
-            if num_batches is not None and num_iters >= num_batches:
-                break
-        return (s['final'] for s in states)
+        with inference_mode():
+            for data, mask_gt, gt_visual in loader:
+                data = data.to(self.device)
+                gen_out = self._gen(data) # B x C x H x W
+                if 'second' in reports:
+                    top2 = torch.topk(gen_out, 2, dim=1)[1] # B x 2 x H x W
+                    confusion.update(top2[:, 0], gt_visual)
+                    second.update(top2[:, 1], gt_visual)
+                elif 'metrics' in reports or 'confusion' in reports:
+                    confusion.update(gen_out.argmax(1), gt_visual)
+                if use_disc:
+                    mask_gt = mask_gt.float().to(self.device) # Ground truth mask (B, C, H, W)
+                    false_scores = self._disc(data, torch.sigmoid(gen_out))
+                    true_scores = self._disc(data, mask_gt) # (B,)
+                    true_positive += (true_scores > 0.5).sum().float()
+                    true_negative += (false_scores > 0.5).sum().float()
+                total += data.size(0)
+                num_iters += 1
+                if num_batches is not None and num_iters >= num_batches:
+                    break
+        results = {}
+        if 'metrics' in reports:
+            results['pixel_acc'] = confusion.pixel_accuracy(ignore_background)
+            results['mIOU'] = confusion.mean_IoU(ignore_background)
+            results['per_class_acc'] = confusion.per_class_accuracy(ignore_background)
+        if 'confusion' in reports:
+            results['confusion'] = confusion.numpy().astype(np.float64)
+        if 'second' in reports:
+            results['second'] = second.numpy().astype(np.float64)
+        if use_disc:
+            results['true_positive'] = true_positive.item() / total
+            results['true_negative'] = 1.0 - (true_negative.item() / total)
+        return results
+
+    def evaluate(self, loader, curr_iter, ignore_background=True, num_batches=None):
+        '''
+        Returns pixel accuracy, mean IoU and per class pixel accuracy, counted on the hard labels
+        (gt_visual). The former calc_* evaluation weighted the pixels by the resized dataset
+        masks (0/255 values, background of 1 - their sum), so these values are not comparable
+        to those of runs before EVAL_METRIC.
+        '''
+        results = self.evaluate_reports(loader, ['metrics'], ignore_background, num_batches)
+        return results['pixel_acc'], results['mIOU'], results['per_class_acc']
 
     def get_confusion_matrix(self, loader):
-        ''' Method to get confusion matrix,
-        Assumes gt_visual is of size B x H x W
-        mask_pred is of size B x C x H x W
-        returns C x C numpy array '''
-        self._gen.eval()
-        numClasses = loader.dataset.numClasses
-        confusion_mat = np.zeros((numClasses, numClasses))
-        for data, mask_gt, gt_visual in loader:
-            data = data.cuda()
-            mask_pred = convert_to_mask(self._gen(data)).numpy()
-            mask_pred = np.transpose(mask_pred, (1, 0, 2, 3)) # C x B x H x W
-            pred_labels = np.argmax(mask_pred, axis=0).reshape((-1,))
-            gt_labels = gt_visual.numpy().reshape((-1,))
-            x = pred_labels + numClasses * gt_labels
-            bincount_2d = np.bincount(x.astype(np.int32),
-                                  minlength=numClasses ** 2)
-            assert bincount_2d.size == numClasses ** 2
-            conf = bincount_2d.reshape((numClasses, numClasses))
-            confusion_mat += conf
-        return confusion_mat
-    
+        ''' Method to get confusion matrix, returns C x C numpy array
+        (rows are ground truth classes, columns predicted classes) '''
+        return self.evaluate_reports(loader, ['confusion'])['confusion']
+
     def get_second_matrix(self, loader):
-        ''' Method to get matrix of second largest classes,
-        Assumes gt_visual is of size B x H x W
-        mask_pred is of size B x C x H x W
-        returns C x C numpy array '''
-        self._gen.eval()
-        numClasses = loader.dataset.numClasses
-        confusion_mat = np.zeros((numClasses, numClasses))
-        for data, mask_gt, gt_visual in loader:
-            data = data.cuda()
-            mask_pred = convert_to_mask(self._gen(data)).numpy()
-            mask_pred = np.transpose(mask_pred, (1, 0, 2, 3)) # C x B x H x W
-            second_largest = np.argsort(mask_pred, axis=0)[1].reshape((-1,))
-            gt_labels = gt_visual.numpy().reshape((-1,))
-            x = second_largest + numClasses * gt_labels
-            bincount_2d = np.bincount(x.astype(np.int32),
-                                  minlength=numClasses ** 2)
-            assert bincount_2d.size == numClasses ** 2
-            conf = bincount_2d.reshape((numClasses, numClasses))
-            confusion_mat += conf
-        return confusion_mat
-        
+        ''' Method to get matrix of second largest classes, returns C x C numpy array '''
+        return self.evaluate_reports(loader, ['second'])['second']
+
     def true_positive_and_negative_rates(self, loader):
-        true_positive = 0.0
-        true_negative = 0.0
-        total = 0.0
-        for data, mask_gt, gt_visual in loader:
-            data = data.cuda()
-            mask_gt = mask_gt.float().cuda() # Ground truth mask (B, C, H, W)
-            self._gen.eval()
-            self._disc.eval()
-            gen_out = self._gen(data) # Segmentation output from generator (B, C, H , W)              
-            converted_mask = nn.functional.sigmoid(gen_out)
-            false_scores = self._disc(data, converted_mask).detach().cpu().numpy()
-            true_scores = self._disc(data, mask_gt).detach().cpu().numpy() # (B,)
-            
-            true_positive += (np.where(true_scores > 0.5, 1, 0)).sum()
-            true_negative += (np.where(false_scores > 0.5, 1, 0)).sum()
-            total += data.size()[0]
-        return true_positive / total, 1.0 - (true_negative / total)
+        results = self.evaluate_reports(loader, ['discriminator'])
+        return results['true_positive'], results['true_negative']
@@ -1,10 +1,12 @@
-import os
+import os, time
 import torch
 import torch.nn as nn
+from torch.utils.data import Subset
 import torchvision.transforms as T
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
+from pycocotools import mask as mask_utils
 
 '''
     Converts a prediction Tensor (scores) into a masks
@@ -21,6 +23,16 @@ def convert_to_mask(prediction):
     return out # B x C x H x W where C is the number of classes
 
 
+def inference_mode():
+    '''
+    Context manager disabling autograd for evaluation: torch.inference_mode when available,
+    torch.no_grad otherwise
+    '''
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
 """
 Flattens input x while maintaining the batch dimension
 """
@@ -64,32 +76,48 @@ def de_normalize(images):
     std = torch.Tensor(COCO_ANIMAL_STD).view(-1, 1, 1)
     return (images * std) + mean
 
-def smooth_labels(n):
+def smooth_labels(n, device='cuda'):
     """
     produces smoothed 'real' and 'fake' labels close to 1.0 and 0.0, respecitively
 
     Input:
     n: (int) number of real and fake labels to produce
+    device: device on which the labels are created
     Return:
     false_labels: (n,1) shape Tensor of labels from 0.0 to factor
     true_labels: (n,1) shape Tensor of labels from 1.0-factor to 1.0
     """
     factor = 0.1
     assert factor < 0.5
-    false_labels = factor * torch.rand(n, 1).cuda()
-    true_labels = 1.0 - factor * torch.rand(n, 1).cuda()
+    false_labels = factor * torch.rand(n, 1, device=device)
+    true_labels = 1.0 - factor * torch.rand(n, 1, device=device)
     return false_labels, true_labels
 
 
-def visualize_mask(trainer, loader, number):
+def visualize_mask(trainer, loader, number, cache=None):
+    '''
+    Displays the predictions of the generator of a trainer next to the ground truth
+    cache: (prediction_cache.PredictionCache) reuses the logits of the same inputs computed
+        with the same checkpoint
+    '''
     total = 0
     to_return = []
+    num_classes = loader.dataset.numClasses
+    content = None
+    if cache is not None and trainer.checkpoint_path is not None:
+        content = cache.register_checkpoint(trainer.checkpoint_path)
+    trainer._gen.eval()
     for data, mask_gt, gt_visual in loader:
         if total < number:
-            data = data.cuda()
+            data = data.to(trainer.device)
             batch_size = data.size()[0]
+            if content is not None:
+                logits = cache.cached_forward(trainer._gen, content, None, data, tuple(data.shape[2:]))
+            else:
+                with inference_mode():
+                    logits = trainer._gen(data)
             total += batch_size
-            mask_pred = convert_to_mask(trainer._gen(data))
+            mask_pred = convert_to_mask(logits)
             for i in range(len(data)):
                 img = de_normalize(data[i].detach().cpu().numpy())
                 gt_mask = gt_visual[i].detach().cpu().numpy()
@@ -103,8 +131,8 @@ def visualize_mask(trainer, loader, number):
                 plt.axis('off')
                 plt.title('original image')
 
-                cmap = discrete_cmap(NUM_CLASSES, 'Paired')
-                norm = colors.NoNorm(vmin=0, vmax=NUM_CLASSES)
+                cmap = discrete_cmap(num_classes, 'Paired')
+                norm = colors.NoNorm(vmin=0, vmax=num_classes)
 
                 plt.subplot(132)
                 plt.imshow(display_image)
@@ -239,6 +267,153 @@ def per_class_pixel_acc(labels, preds, state):
     state['final'] = np.mean(state['true_pos'] / (state['total_pix'] + 1e-12))
     return state
 
+class ConfusionMatrix():
+    '''
+    Streaming confusion matrix accumulated on the device of the predictions with one bincount
+    per batch. conf[i, j] counts the pixels of ground truth class i predicted as class j.
+    The metrics are derived at the end and match calc_pixel_accuracy, calc_mean_IoU and
+    per_class_pixel_acc on one-hot masks, without building dense masks or syncing per batch.
+    They count hard labels (mask_flat), whereas the calc_* metrics on the dataset masks weight
+    every pixel by the 0-255 misc.imresize masks (and a background of 1 - their sum), so the
+    values of the two are not comparable (see train.EVAL_METRIC). The last class is the background.
+    '''
+    def __init__(self, num_classes, device='cpu'):
+        self.num_classes = num_classes
+        self.conf = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+        # Sum over images of the per-image mean IoU, without / with the background class
+        self.image_IoU_sum = torch.zeros(2, dtype=torch.float64, device=device)
+        self.num_images = 0
+
+    def update(self, preds, labels):
+        '''
+        preds: B x H x W predicted classes (argmax of the scores)
+        labels: B x H x W ground truth classes
+        '''
+        B = preds.size(0)
+        C = self.num_classes
+        device = self.conf.device
+        preds = preds.to(device).view(B, -1).long()
+        labels = labels.to(device).view(B, -1).long()
+        image_index = torch.arange(B, device=device).view(B, 1)
+        x = (image_index * C + labels) * C + preds
+        per_image = torch.bincount(x.view(-1), minlength=B * C * C).view(B, C, C)
+        self.conf += per_image.sum(0)
+        self.image_IoU_sum[0] += self._image_IoU(per_image, C).sum()
+        self.image_IoU_sum[1] += self._image_IoU(per_image, C - 1).sum()
+        self.num_images += B
+
+    @staticmethod
+    def _image_IoU(per_image, n):
+        ''' Mean IoU of each image over its first n classes present in the ground truth '''
+        per_image = per_image.double()
+        true_positive = torch.diagonal(per_image, dim1=1, dim2=2)[:, :n]
+        total_pix = per_image.sum(2)[:, :n]
+        false_positive = per_image.sum(1)[:, :n] - true_positive
+        class_present = (total_pix > 0).double()
+        numerator = torch.sum(class_present * (true_positive / (total_pix + false_positive + 1e-12)), 1)
+        denominator = class_present.sum(1)
+        return torch.where(denominator > 0, numerator / denominator.clamp(min=1), torch.zeros_like(numerator))
+
+    def _classes(self, ignore_background):
+        return self.num_classes - 1 if ignore_background else self.num_classes
+
+    def pixel_accuracy(self, ignore_background=True):
+        n = self._classes(ignore_background)
+        conf = self.conf.double()
+        return (torch.diagonal(conf)[:n].sum() / (conf[:n].sum() + 1e-12)).item()
+
+    def per_class_accuracy(self, ignore_background=True):
+        n = self._classes(ignore_background)
+        conf = self.conf.double()
+        return (torch.diagonal(conf)[:n] / (conf[:n].sum(1) + 1e-12)).mean().item()
+
+    def mean_IoU(self, ignore_background=True):
+        ''' Mean over images of the per-image mean IoU (as calc_mean_IoU) '''
+        return self.image_IoU_sum[int(ignore_background)].item() / max(self.num_images, 1)
+
+    def class_IoU(self, ignore_background=True):
+        ''' Dataset-level IoU of each class, C numpy array (nan for absent classes) '''
+        n = self._classes(ignore_background)
+        conf = self.conf.double()
+        true_positive = torch.diagonal(conf)[:n]
+        union = conf.sum(1)[:n] + conf.sum(0)[:n] - true_positive
+        return (true_positive / union).cpu().numpy()
+
+    def dataset_mean_IoU(self, ignore_background=True):
+        ''' Mean over classes of the dataset-level IoU '''
+        return float(np.nanmean(self.class_IoU(ignore_background)))
+
+    def numpy(self):
+        return self.conf.cpu().numpy()
+
+
+def evaluate_segmentation(model, loader, num_classes, device='cpu', num_batches=None):
+    '''
+    Evaluates a generator on a loader of (image, mask, mask_flat) batches
+    Return:
+        ConfusionMatrix accumulated over the loader
+    '''
+    confusion = ConfusionMatrix(num_classes, device)
+    model.eval()
+    with inference_mode():
+        for i, (data, _, gt_visual) in enumerate(loader):
+            if num_batches is not None and i >= num_batches:
+                break
+            confusion.update(torch.argmax(model(data.to(device)), 1), gt_visual)
+    return confusion
+
+
+def random_subset(dataset, num_images, seed=0):
+    """ Fixed random subset of a dataset (calibration and evaluation subsets) """
+    indices = np.random.RandomState(seed).permutation(len(dataset))[:num_images]
+    return Subset(dataset, indices.tolist())
+
+
+def time_fn(fn, warmup=2, repeat=10):
+    """
+    Times a callable on CPU
+    Args:
+        fn: (callable) function taking no argument
+        warmup: (int) number of untimed calls
+        repeat: (int) number of timed calls
+    Return:
+        dict with mean/std/min time in milliseconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(1000.0 * (time.perf_counter() - start))
+    times = np.array(times)
+    return {
+        'mean_ms': float(times.mean()),
+        'std_ms': float(times.std()),
+        'min_ms': float(times.min()),
+        'repeat': repeat,
+    }
+
+
+def count_macs(model, size=128):
+    """ Multiply-accumulates of the convolutions for one size x size image """
+    macs = [0]
+    def hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        if isinstance(module, nn.ConvTranspose2d):
+            macs[0] += inputs[0].numel() * module.out_channels // module.groups * kernel
+        else:
+            macs[0] += output.numel() * module.in_channels // module.groups * kernel
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+    device = next(model.parameters()).device
+    with inference_mode():
+        model.eval()(torch.rand(1, 3, size, size, device=device))
+    for handle in handles:
+        handle.remove()
+    return macs[0]
+
+
 def Conv2d_BatchNorm2d(in_channels, out_channels, kernel_size, padding, use_bn):
     layers = [nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size, padding=padding)]
     if use_bn:
@@ -275,6 +450,35 @@ def save_to_file(pred_mask, display_image, gt_mask, i, save_dir):
     plt.savefig(os.path.join(save_dir, str(i) + '.png'))
     plt.clf()
     
+def label_map_to_rle(label_map):
+    '''
+    Encodes a H x W map of classes as COCO run-length encodings, one per class present
+    Return:
+        dict class index -> {'size': [H, W], 'counts': str} (JSON serializable)
+    '''
+    rles = {}
+    for c in np.unique(label_map):
+        rle = mask_utils.encode(np.asfortranarray((label_map == c).astype(np.uint8)))
+        rle['counts'] = rle['counts'].decode('ascii')
+        rles[int(c)] = rle
+    return rles
+
+def rle_to_label_map(rles, background=0):
+    '''
+    Inverse of label_map_to_rle
+    Args:
+        rles: dict class index -> COCO RLE
+        background: class of the pixels covered by no RLE
+    '''
+    label_map = None
+    for c, rle in rles.items():
+        rle = {'size': rle['size'], 'counts': rle['counts'].encode('ascii') if isinstance(rle['counts'], str) else rle['counts']}
+        mask = mask_utils.decode(rle).astype(bool)
+        if label_map is None:
+            label_map = np.full(mask.shape, background, dtype=np.uint8)
+        label_map[mask] = int(c)
+    return label_map
+
 def get_category_name_array(loader):
     dataset = loader.dataset
     coco = dataset.coco
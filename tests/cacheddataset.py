@@ -0,0 +1,42 @@
+import numpy as np
+import torch
+import tempfile
+from torch.utils.data import Dataset
+
+from code.dataset import cache_dataset
+
+class FakeCocoStuff(Dataset):
+    ''' Items in the format of CocoStuffDataSet: 0-255 class masks, background of 1 - their sum '''
+    def __init__(self, num_images=5, num_classes=4, height=8, width=8):
+        self.numClasses = num_classes
+        self.catIds = list(range(1, num_classes))
+        self.ids = list(range(100, 100 + num_images))
+        self.height = height
+        self.width = width
+        rng = np.random.RandomState(0)
+        self.images = rng.randint(0, 256, (num_images, 3, height, width)) / 255.0
+        self.masks = np.zeros((num_images, num_classes, width, height))
+        for i in range(num_images):
+            for c in range(num_classes - 1):
+                self.masks[i, c] = rng.choice([0, 128, 255], (width, height), p=[0.6, 0.1, 0.3])
+            self.masks[i, 0, :2, :2] += 255 # Overlapping annotations of the same category
+            self.masks[i, -1] = 1 - np.sum(self.masks[i, :-1], 0)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        masks = self.masks[index]
+        return torch.FloatTensor(self.images[index]), masks, np.argmax(masks, axis=0)
+
+''' CachedDataSet items should be those of the source dataset '''
+source = FakeCocoStuff()
+cached = cache_dataset(source, tempfile.mkdtemp(), batch_size=2, num_workers=0)
+for i in range(len(source)):
+    img, masks, mask_flat = source[i]
+    cached_img, cached_masks, cached_mask_flat = cached[i]
+    print ("Image", i, "max abs difference", (img - cached_img).abs().max().item(),
+           "masks equal", np.array_equal(masks, cached_masks), "labels equal", np.array_equal(mask_flat, cached_mask_flat))
+    assert (img - cached_img).abs().max().item() < 1e-6
+    assert np.array_equal(masks, cached_masks) and cached_masks.dtype == masks.dtype
+    assert np.array_equal(mask_flat, cached_mask_flat)
@@ -0,0 +1,46 @@
+import torch
+
+from code.utils import ConfusionMatrix, convert_to_mask, calc_pixel_accuracy, calc_mean_IoU, per_class_pixel_acc
+
+''' ConfusionMatrix should match the dense one-hot metrics '''
+B, C, H, W = 4, 5, 16, 16
+torch.manual_seed(0)
+confusion = ConfusionMatrix(C)
+states = [None] * 3
+metrics = [calc_pixel_accuracy, calc_mean_IoU, per_class_pixel_acc]
+for _ in range(3):
+    scores = torch.randn(B, C, H, W)
+    labels = torch.randint(0, C, (B, H, W), dtype=torch.long)
+    labels[0] = C - 1 # One image with background only
+    confusion.update(torch.argmax(scores, 1), labels)
+
+    one_hot_labels = torch.zeros(B, C, H, W).scatter_(1, labels.unsqueeze(1), 1)
+    preds = convert_to_mask(scores)
+    for i, metric in enumerate(metrics):
+        states[i] = metric(one_hot_labels.narrow(1, 0, C - 1), preds.narrow(1, 0, C - 1), states[i])
+
+print (confusion.numpy())
+print ("Pixel accuracy", confusion.pixel_accuracy(), states[0]['final'])
+print ("Mean IoU", confusion.mean_IoU(), states[1]['final'])
+print ("Per class accuracy", confusion.per_class_accuracy(), states[2]['final'])
+print ("Dataset mean IoU", confusion.dataset_mean_IoU())
+assert abs(confusion.pixel_accuracy() - states[0]['final']) < 1e-6
+assert abs(confusion.mean_IoU() - states[1]['final']) < 1e-6
+assert abs(confusion.per_class_accuracy() - states[2]['final']) < 1e-6
+
+''' The former evaluation weighted the pixels by the 0/255 resized dataset masks: its values are not comparable '''
+labels = torch.full((1, H, W), C - 1, dtype=torch.long)
+labels[0, 4:12, 4:12] = 0
+soft = torch.zeros(1, C, H, W)
+soft[0, 0, 4:12, 4:12] = 255.0 # misc.imresize scales a binary mask to 0-255
+soft[0, 0, 3, 4:12] = soft[0, 0, 12, 4:12] = 128.0 # bilinear boundary
+soft[0, -1] = 1 - soft[0, :-1].sum(0)
+scores = torch.zeros(1, C, H, W)
+scores[0, 0, 3:13, 3:13] = 1.0 # prediction slightly larger than the object
+scores[0, -1] = 0.5
+confusion = ConfusionMatrix(C)
+confusion.update(torch.argmax(scores, 1), labels)
+preds = convert_to_mask(scores)
+old = calc_pixel_accuracy(soft.narrow(1, 0, C - 1), preds.narrow(1, 0, C - 1), None)['final']
+print ("Pixel accuracy on hard labels", confusion.pixel_accuracy(), "on resized masks", old)
+assert abs(confusion.pixel_accuracy() - old) > 1e-3
@@ -0,0 +1,10 @@
+import torch
+
+from code.distill import distillation_loss
+
+''' The distillation loss is zero when the student matches the teacher and positive otherwise '''
+torch.manual_seed(0)
+teacher = torch.randn(2, 5, 16, 16)
+print ("Same logits", distillation_loss(teacher.clone(), teacher).item(), "expected 0")
+print ("Shifted logits", distillation_loss(teacher + 3.0, teacher).item(), "expected 0 (softmax is shift invariant)")
+print ("Random logits", distillation_loss(torch.randn(2, 5, 16, 16), teacher).item(), "expected > 0")
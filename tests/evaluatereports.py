@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+import numpy as np
+from torch.utils.data import Dataset, DataLoader
+
+from code.train import Trainer
+
+class RandomSegmentation(Dataset):
+    ''' (image, mask, mask_flat) items as CocoStuffDataSet '''
+    def __init__(self, num_images=6, num_classes=4, size=8):
+        self.numClasses = num_classes
+        self.images = torch.rand(num_images, 3, size, size)
+        self.labels = torch.randint(0, num_classes, (num_images, size, size), dtype=torch.long)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        mask_flat = self.labels[index]
+        mask = torch.zeros(self.numClasses, *mask_flat.shape).scatter_(0, mask_flat[None], 1)
+        return self.images[index], mask, mask_flat
+
+class TinyGenerator(nn.Module):
+    def __init__(self, num_classes):
+        super().__init__()
+        self.conv = nn.Conv2d(3, num_classes, 3, padding=1)
+
+    def forward(self, x):
+        return self.conv(x)
+
+class TinyDiscriminator(nn.Module):
+    def __init__(self, num_classes):
+        super().__init__()
+        self.linear = nn.Linear(3 + num_classes, 1)
+
+    def forward(self, x, mask):
+        return torch.sigmoid(self.linear(torch.cat([x, mask], 1).mean((2, 3)))).view(-1)
+
+''' The legacy evaluation wrappers keep their return structures, from a single evaluate_reports pass '''
+torch.manual_seed(0)
+dataset = RandomSegmentation()
+C = dataset.numClasses
+loader = DataLoader(dataset, batch_size=4)
+trainer = Trainer(TinyGenerator(C), TinyDiscriminator(C), loader, loader, train_gan=True, device='cpu')
+
+with torch.no_grad():
+    preds = torch.cat([trainer._gen(data) for data, _, _ in loader])
+order = torch.argsort(preds, dim=1, descending=True)
+labels = dataset.labels.numpy().reshape(-1)
+expected_confusion = np.bincount(labels * C + order[:, 0].numpy().reshape(-1), minlength=C * C).reshape(C, C)
+expected_second = np.bincount(labels * C + order[:, 1].numpy().reshape(-1), minlength=C * C).reshape(C, C)
+
+metrics = tuple(trainer.evaluate(loader, 0))
+print ("evaluate", metrics)
+assert len(metrics) == 3 and all(isinstance(m, float) for m in metrics)
+
+confusion = trainer.get_confusion_matrix(loader)
+print ("get_confusion_matrix", confusion.shape, confusion.dtype)
+assert isinstance(confusion, np.ndarray) and confusion.shape == (C, C) and confusion.dtype == np.float64
+assert np.array_equal(confusion, expected_confusion)
+
+second = trainer.get_second_matrix(loader)
+print ("get_second_matrix", second.shape, second.dtype)
+assert isinstance(second, np.ndarray) and second.shape == (C, C) and second.dtype == np.float64
+assert np.array_equal(second, expected_second)
+
+true_positive, true_negative = trainer.true_positive_and_negative_rates(loader)
+print ("true_positive_and_negative_rates", true_positive, true_negative)
+assert 0 <= true_positive <= 1 and 0 <= true_negative <= 1
+
+results = trainer.evaluate_reports(loader, ['metrics'])
+assert sorted(results) == ['mIOU', 'per_class_acc', 'pixel_acc']
@@ -0,0 +1,15 @@
+import torch
+
+from code.fast_style import TransformerNet, MaskedStylizer
+from code.generator import get_generator
+
+''' The style network keeps the size of its input, and the composite is in [0, 1] '''
+images = torch.rand(2, 3, 64, 64)
+net = TransformerNet(channels=8, num_residual=1).eval()
+with torch.no_grad():
+    print ("stylized", tuple(net(images).size()), "expected", (2, 3, 64, 64))
+stylizer = MaskedStylizer(get_generator('SegNetSmaller', 3, pretrained=False), net, TransformerNet(channels=8, num_residual=1))
+out = stylizer(images)
+print ("composite", tuple(out.size()), "in [0, 1]:", bool(out.min() >= 0 and out.max() <= 1))
+stylizer.hard_mask = True
+print ("hard mask composite", tuple(stylizer(images).size()))
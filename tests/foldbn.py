@@ -0,0 +1,42 @@
+import torch
+import torch.nn as nn
+
+from code.discriminator import GAN
+from code.generator import SegNetSmaller, MobileSegNet, SeparableSegNet
+from code.fuse import fold_batchnorm
+
+''' Folding BatchNorm into the convolutions should not change the outputs '''
+def randomize_bn(model):
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 2)
+            module.bias.data.uniform_(-1, 1)
+    return model.eval()
+
+torch.manual_seed(0)
+images = torch.rand(2, 3, 64, 64)
+masks = torch.rand(2, 5, 64, 64)
+
+disc = randomize_bn(GAN(5, (5, 64, 64), (3, 64, 64)))
+fused_disc = fold_batchnorm(disc)
+print (fused_disc)
+with torch.no_grad():
+    print ("Discriminator max abs difference", (disc(images, masks) - fused_disc(images, masks)).abs().max().item())
+
+gen = randomize_bn(SegNetSmaller(5, pretrained=False))
+fused_gen = fold_batchnorm(gen)
+with torch.no_grad():
+    print ("Generator max abs difference", (gen(images) - fused_gen(images)).abs().max().item())
+
+''' The Conv -> BatchNorm -> ReLU6 blocks of the MobileNetV2 generators fold as well '''
+for gen in [MobileSegNet(5, pretrained=False), SeparableSegNet(5, pretrained=False)]:
+    gen = randomize_bn(gen)
+    fused_gen = fold_batchnorm(gen)
+    remaining = sum(isinstance(m, nn.BatchNorm2d) for m in fused_gen.modules())
+    with torch.no_grad():
+        diff = (gen(images) - fused_gen(images)).abs().max().item()
+    print (type(gen).__name__, "max abs difference", diff, "BatchNorm layers left", remaining)
+    assert remaining == 0 and diff < 1e-3
+    assert all(m.inplace for m in fused_gen.modules() if isinstance(m, nn.ReLU6))
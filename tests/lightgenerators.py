@@ -0,0 +1,17 @@
+import torch
+
+from code.generator import get_generator
+from code.utils import count_macs
+
+''' The lightweight generators keep the B x C x H x W logits contract of SegNet16 '''
+images = torch.rand(2, 3, 64, 64)
+for name in ['SegNet16', 'MobileSegNet', 'SeparableSegNet']:
+    model = get_generator(name, 5, pretrained=False).eval()
+    with torch.no_grad():
+        print (name, tuple(model(images).size()), "expected", (2, 5, 64, 64))
+    print ("{:.2f}M parameters, {:.3f} GMACs".format(sum(p.numel() for p in model.parameters()) / 1e6,
+                                                  count_macs(model, 64) / 1e9))
+
+''' use_bn=False removes every BatchNorm of the separable network '''
+model = get_generator('SeparableSegNet', 5, use_bn=False, pretrained=False)
+print ("BatchNorm layers:", sum(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules()), "expected 0")
@@ -0,0 +1,13 @@
+import torch
+
+from code.style_transfer import gram_matrix, masked_gram_matrices
+
+''' The K masked Gram matrices of one batched matmul match K separate gram_matrix calls '''
+features = torch.rand(2, 8, 6, 5)
+masks = torch.rand(2, 3, 6, 5)
+G = masked_gram_matrices(features, masks)
+print ("shape", tuple(G.size()), "expected", (2, 3, 8, 8))
+for k in range(3):
+    print ("region", k, "max difference", float((G[:, k] - gram_matrix(features, masks[:, k:k + 1])).abs().max()))
+shared = masked_gram_matrices(features, masks[:1])
+print ("shared masks max difference", float((shared[1, 0] - gram_matrix(features[1:], masks[:1, :1])[0]).abs().max()))
@@ -0,0 +1,35 @@
+import torch
+import os, tempfile
+
+from code.prediction_cache import PredictionCache
+
+''' The cache runs the model only on new images and forgets a checkpoint whose content changed '''
+root = tempfile.mkdtemp()
+checkpoint = os.path.join(root, 'best.pth.tar')
+torch.save({'gen_dict': {'w': torch.ones(1)}}, checkpoint)
+calls = []
+def model(data):
+    calls.append(data.size(0))
+    return data.mean(1, keepdim=True)
+
+data = torch.rand(4, 3, 8, 8)
+cache = PredictionCache(os.path.join(root, 'cache'), max_size_mb=1)
+content = cache.register_checkpoint(checkpoint)
+out = cache.cached_forward(model, content, [1, 2, 3, 4], data, 8)
+out_again = cache.cached_forward(model, content, [3, 4, 5, 6], torch.cat([data[2:], data[:2]]), 8)
+print ("Images forwarded", calls, "expected [4, 2]")
+print ("Cached output max abs difference", (out[2:] - out_again[:2]).abs().max().item(), "expected 0 (misses rounded as hits)")
+
+calls.clear()
+cache.cached_forward(model, content, [1, 2], torch.rand(2, 3, 8, 8), 8)
+print ("Images forwarded for new content under known ids", calls, "expected [2]")
+
+torch.save({'gen_dict': {'w': torch.zeros(1)}}, checkpoint)
+cache = PredictionCache(os.path.join(root, 'cache'), max_size_mb=1)
+new_content = cache.register_checkpoint(checkpoint)
+print ("Entries after retraining", cache.stats()['entries'], "expected 0")
+
+cache = PredictionCache(os.path.join(root, 'cache'), max_size_mb=1e-3)
+for image_id in range(10):
+    cache.cached_forward(model, new_content, [image_id], data[:1], 8)
+print ("Cache bytes {} within budget {}".format(cache.stats()['bytes'], cache.max_bytes))
@@ -0,0 +1,25 @@
+import numpy as np
+import os, tempfile
+
+from code.prediction_store import PredictionStoreWriter, PredictionStore, to_coco_results
+
+''' Label maps read back from the store should be identical, in any order '''
+rng = np.random.RandomState(0)
+label_maps = {}
+for image_id in [139, 285, 632]:
+    label_map = np.full((48, 64), 3, dtype=np.uint8) # background
+    label_map[rng.randint(0, 24):rng.randint(24, 48), rng.randint(0, 32):rng.randint(32, 64)] = rng.randint(0, 3)
+    label_maps[image_id] = label_map
+
+path = os.path.join(tempfile.mkdtemp(), 'predictions.segrle')
+with PredictionStoreWriter(path, {'catIds': [17, 18, 19]}) as writer:
+    for image_id, label_map in label_maps.items():
+        writer.add(image_id, label_map)
+
+store = PredictionStore(path)
+print ("Images in store", sorted(store.ids()), "expected", sorted(label_maps))
+for image_id in [632, 139, 285]:
+    print (image_id, "identical:", np.array_equal(store[image_id], label_maps[image_id]))
+results = to_coco_results(store, store.meta['catIds'])
+print ("COCO results", len(results), "category ids", sorted(set(r['category_id'] for r in results)))
+print ("Store size {} bytes, dense size {} bytes".format(os.path.getsize(path), sum(m.nbytes for m in label_maps.values())))
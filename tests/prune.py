@@ -0,0 +1,22 @@
+import torch
+
+from code.generator import SegNetSmall, SegNetSmaller, resize_to_state_dict
+from code.prune import prune_decoders, count_macs
+
+''' Pruned generators should keep their output shape and reload from their state dict '''
+torch.manual_seed(0)
+images = torch.rand(2, 3, 64, 64)
+for Generator in [SegNetSmaller, SegNetSmall]:
+    model = Generator(5, pretrained=False).eval()
+    pruned = prune_decoders(model, 0.5).eval()
+    with torch.no_grad():
+        print (Generator.__name__, "output", tuple(pruned(images).size()), "expected", (2, 5, 64, 64))
+    print ("Parameters {} -> {}".format(sum(p.numel() for p in model.parameters()),
+                                        sum(p.numel() for p in pruned.parameters())))
+    print ("MACs {} -> {}".format(count_macs(model, 64), count_macs(pruned, 64)))
+
+    reloaded = Generator(5, pretrained=False).eval()
+    resize_to_state_dict(reloaded, pruned.state_dict())
+    reloaded.load_state_dict(pruned.state_dict())
+    with torch.no_grad():
+        print ("Reloaded max abs difference", (reloaded(images) - pruned(images)).abs().max().item())
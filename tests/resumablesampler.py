@@ -0,0 +1,25 @@
+from code.dataset import ResumableRandomSampler
+
+''' Saving mid-epoch and reloading should yield exactly the indices left in the epoch '''
+data = list(range(23))
+sampler = ResumableRandomSampler(data, seed=3)
+sampler.set_epoch(2)
+full_epoch = list(sampler)
+num_seen = 10
+state = sampler.state_dict(2, num_seen)
+
+resumed = ResumableRandomSampler(data)
+resumed.load_state_dict(state)
+resumed.set_epoch(2) # Trainer.train calls it at the start of the resumed epoch
+print ("Remaining", list(resumed), "expected", full_epoch[num_seen:])
+assert list(resumed) == full_epoch[num_seen:]
+
+''' Iterating again or asking the length does not drop the fast-forward '''
+assert len(resumed) == len(data) - num_seen
+assert list(resumed) == full_epoch[num_seen:]
+assert len(resumed) == len(data) - num_seen
+
+''' The next epoch is complete '''
+resumed.set_epoch(3)
+print ("Next epoch length", len(resumed), "expected", len(data))
+assert len(resumed) == len(data) and sorted(resumed) == data
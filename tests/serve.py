@@ -0,0 +1,32 @@
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen, Request
+
+import numpy as np
+from PIL import Image
+
+from code.generator import VerySmallNet
+from code.serve import make_server
+
+''' Concurrent requests to the local service on CPU should be batched together '''
+server = make_server(VerySmallNet(11), device='cpu', port=0, image_size=64, max_batch_size=8, max_latency_ms=50)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = 'http://{}:{}'.format(*server.server_address)
+
+image = Image.fromarray(np.random.randint(0, 256, (100, 150, 3)).astype(np.uint8))
+body = io.BytesIO()
+image.save(body, format='JPEG')
+
+def segment(output_format):
+    request = Request(url + '/segment?format=' + output_format, data=body.getvalue(), method='POST')
+    return urlopen(request).read()
+
+with ThreadPoolExecutor(16) as pool:
+    label_maps = list(pool.map(lambda _: np.array(Image.open(io.BytesIO(segment('png')))), range(16)))
+print ("Label map shape", label_maps[0].shape, "classes", np.unique(label_maps[0]))
+rle = json.loads(segment('rle').decode('utf-8'))
+print ("RLE size", rle['size'], "classes", sorted(rle['rle']))
+print (json.loads(urlopen(url + '/stats').read().decode('utf-8')))
+server.shutdown()
@@ -0,0 +1,48 @@
+import torch
+import torch.nn as nn
+import numpy as np
+import PIL.Image
+
+from code.style_transfer import (style_transfer_batch, style_transfer_pyramid, style_transfer_sequence,
+                                 StyleTargetCache, device)
+
+''' Batched, pyramid and sequence style transfer on a small random CNN '''
+torch.manual_seed(0)
+rng = np.random.RandomState(0)
+cnn = nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+                    nn.Conv2d(8, 16, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+                    nn.Conv2d(16, 16, 3, padding=1), nn.ReLU()).to(device).eval()
+for param in cnn.parameters():
+    param.requires_grad = False
+params = {'content_layer': 6, 'content_weight': 1e-3, 'style_layers': (0, 3, 6), 'style_weights': [1.0] * 3, 'tv_weight': 0}
+
+def random_image(size=32):
+    return PIL.Image.fromarray(rng.randint(0, 256, (size, size, 3)).astype(np.uint8))
+
+contents = [random_image() for _ in range(3)]
+style, second_style = random_image(), random_image()
+masks = [(torch.rand(16, 16) > 0.5).float() for _ in contents] # smaller than the 32 x 32 images: resized
+cache = StyleTargetCache(cache_dir=None)
+
+images, final_loss, loss_list, stats = style_transfer_batch(cnn, contents, style, masks, 32, 32, max_iters=30, mask_layer=True,
+                                                            second_style_image=second_style, style_cache=cache,
+                                                            return_stats=True, **params)
+print ("Batch sizes", [img.size for img in images], "final loss", final_loss.tolist(), "first", loss_list[0].tolist())
+assert [img.size for img in images] == [(32, 32)] * 3
+assert tuple(final_loss.shape) == (3,) and len(loss_list) == stats['iterations'] == 30
+assert np.isfinite(loss_list[-1]).all() and (loss_list[-1] < loss_list[0]).all()
+
+img, loss, loss_list, stats = style_transfer_pyramid(cnn, contents[0], style, masks[0], 32, 32, max_iters=20, scales=(0.5, 1.0),
+                                                     mask_layer=True, second_style_image=second_style, style_cache=cache,
+                                                     return_stats=True, **params)
+print ("Pyramid size", img.size, "iterations per scale", [st['iterations'] for st in stats['scales']], "final loss", float(loss))
+assert img.size == (32, 32) and [st['scale'] for st in stats['scales']] == [0.5, 1.0]
+assert len(loss_list) == stats['iterations'] == 30 and np.isfinite(loss_list).all()
+
+frames = [(content, mask) for content, mask in zip(contents, masks)]
+results = list(style_transfer_sequence(cnn, frames, style, 32, 32, max_iters=20, frame_iters=5, mask_layer=True,
+                                       second_style_image=second_style, style_cache=cache, **params))
+print ("Sequence iterations", [st['iterations'] for _, st in results], "final losses", [st['final_loss'] for _, st in results])
+assert [st['frame'] for _, st in results] == [0, 1, 2] and [img.size for img, _ in results] == [(32, 32)] * 3
+assert [st['iterations'] for _, st in results] == [20, 5, 5]
+assert all(np.isfinite(st['final_loss']).all() for _, st in results)
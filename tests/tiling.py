@@ -0,0 +1,18 @@
+import torch
+
+from code.generator import VerySmallNet
+from code.tiling import TiledPredictor
+
+''' Tiled inference of a fully convolutional model should match the full image forward '''
+torch.manual_seed(0)
+model = VerySmallNet(5)
+image = torch.rand(3, 200, 330)
+predictor = TiledPredictor(model, tile_size=64, overlap=32, memory_budget_mb=1)
+print ("Tile bytes {}, tiles per batch {}".format(predictor.tile_bytes, predictor.tiles_per_batch))
+
+tiled = predictor.predict(image)
+with torch.no_grad():
+    full = model(image.unsqueeze(0))[0]
+print (tiled.size(), full.size())
+print ("Max abs difference", (tiled - full).abs().max().item())
+print ("Label agreement", (tiled.argmax(0) == full.argmax(0)).float().mean().item())